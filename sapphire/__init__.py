@@ -78,7 +78,8 @@ from .analysis.process_events import (ProcessEvents, ProcessEventsFromSource,
                                       ProcessEventsFromSourceWithTriggerOffset,
                                       ProcessWeather, ProcessWeatherFromSource,
                                       ProcessSingles, ProcessSinglesFromSource)
-from .analysis.process_traces import (TraceObservables, MeanFilter,
+from .analysis.process_traces import (TraceObservables,
+                                      BatchTraceObservables, MeanFilter,
                                       DataReduction)
 from .analysis.reconstructions import (ReconstructESDEvents,
                                        ReconstructESDEventsFromSource,
@@ -123,7 +124,8 @@ __all__ = ['analysis',
            'ProcessEventsFromSourceWithTriggerOffset',
            'ProcessWeather', 'ProcessWeatherFromSource',
            'ProcessSingles', 'ProcessSinglesFromSource',
-           'TraceObservables', 'MeanFilter', 'DataReduction',
+           'TraceObservables', 'BatchTraceObservables', 'MeanFilter',
+           'DataReduction',
            'ReconstructESDEvents', 'ReconstructESDEventsFromSource',
            'ReconstructESDCoincidences', 'ReconstructSimulatedEvents',
            'ReconstructSimulatedCoincidences',
@@ -2,11 +2,20 @@ import re
 import itertools
 import warnings
 
+import numpy as np
 import tables
 
 from .. import api
 
 
+#: Number of coincidences for which the membership index is processed at
+#: once, this limits the memory use of queries on very large datasets.
+INDEX_CHUNK_SIZE = 1000000
+
+#: Number of coincidences for which the events are read at once.
+EVENTS_BLOCK_SIZE = 10000
+
+
 class CoincidenceQuery(object):
 
     """Perform queries on an ESD file where coincidences have been analysed.
@@ -24,6 +33,11 @@ class CoincidenceQuery(object):
     An exception will occur when you include a station in a query that
     does not occur in the datafile.
 
+    Queries on datasets with many stations can be sped up by storing a
+    station membership index next to the coincidences, see
+    :func:`create_membership_index`.  If the index is present it is used
+    automatically.
+
     Example usage::
 
         >>> from sapphire import CoincidenceQuery
@@ -68,6 +82,18 @@ class CoincidenceQuery(object):
         except tables.NoSuchNodeError:
             self.reconstructed = False
 
+        try:
+            self.membership_index = self.data.get_node(coincidence_group,
+                                                       'membership_index')
+        except tables.NoSuchNodeError:
+            self.membership_index = None
+        else:
+            n_indexed = self.membership_index.stations.nrows
+            if n_indexed != self.coincidences.nrows:
+                warnings.warn('Membership index is out of date with the '
+                              'coincidences, it will not be used.')
+                self.membership_index = None
+
     def finish(self):
         """Clean-up after using
 
@@ -101,6 +127,9 @@ class CoincidenceQuery(object):
         if len(s_columns) == 0:
             # no stations would result in a bad query string
             return []
+        if self.membership_index is not None:
+            return self._query_membership_index(s_columns, 1, start, stop,
+                                                iterator)
         query = '(%s)' % ' | '.join(s_columns)
         query = self._add_timestamp_filter(query, start, stop)
         filtered_coincidences = self.perform_query(query, iterator)
@@ -119,6 +148,9 @@ class CoincidenceQuery(object):
             # Not all requested stations exist in the data so it's
             # impossible to find a coincidence with all stations.
             return []
+        if self.membership_index is not None:
+            return self._query_membership_index(s_columns, len(s_columns),
+                                                start, stop, iterator)
         query = '(%s)' % ' & '.join(s_columns)
         query = self._add_timestamp_filter(query, start, stop)
         filtered_coincidences = self.perform_query(query, iterator)
@@ -137,6 +169,9 @@ class CoincidenceQuery(object):
         if len(s_columns) < n:
             # No combinations possible because there are to few stations
             return []
+        if self.membership_index is not None:
+            return self._query_membership_index(s_columns, n, start, stop,
+                                                iterator)
         s_combinations = ['(%s)' % (' & '.join(combo))
                           for combo in itertools.combinations(s_columns, n)]
         query = '(%s)' % ' | '.join(s_combinations)
@@ -185,6 +220,89 @@ class CoincidenceQuery(object):
             filtered_coincidences = self.coincidences.read_where(query)
         return filtered_coincidences
 
+    def _query_membership_index(self, s_columns, n, start=None, stop=None,
+                                iterator=False):
+        """Filter coincidences using the station membership index
+
+        Instead of evaluating a query string the membership bits of the
+        chosen stations are counted for each coincidence.
+
+        :param s_columns: column titles of the stations to look for.
+        :param n: minimum number of the given stations to be in a
+                  coincidence.
+        :param start: timestamp from which to look for coincidences.
+        :param stop: end timestamp for coincidences.
+        :return: coincidences matching the query.
+
+        """
+        ids = self._membership_query_ids(s_columns, n, start, stop)
+        if iterator:
+            filtered_coincidences = self.coincidences.itersequence(ids)
+        else:
+            filtered_coincidences = self.coincidences.read_coordinates(ids)
+        return filtered_coincidences
+
+    def _membership_query_ids(self, s_columns, n, start=None, stop=None):
+        """Get ids of coincidences with at least n of the given stations
+
+        :param s_columns: column titles of the stations to look for.
+        :param n: minimum number of the given stations to be in a
+                  coincidence.
+        :param start: timestamp from which to look for coincidences.
+        :param stop: end timestamp for coincidences.
+        :return: sorted array of matching coincidence ids.
+
+        """
+        stations = self.membership_index.stations
+        bits = _membership_bits(stations.attrs.columns, s_columns)
+
+        if start or stop:
+            ids = self._timerange_ids(start, stop)
+            if not len(ids):
+                return ids
+            first, last = ids[0], ids[-1] + 1
+        else:
+            ids = None
+            first, last = 0, stations.nrows
+
+        matches = []
+        for chunk_start in range(first, last, INDEX_CHUNK_SIZE):
+            chunk_stop = min(chunk_start + INDEX_CHUNK_SIZE, last)
+            match = _count_members(stations[chunk_start:chunk_stop],
+                                   bits) >= n
+            if ids is not None:
+                in_range = np.zeros(len(match), dtype=bool)
+                chunk_ids = ids[(ids >= chunk_start) & (ids < chunk_stop)]
+                in_range[chunk_ids - chunk_start] = True
+                match &= in_range
+            matches.append(np.flatnonzero(match) + chunk_start)
+        if not matches:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(matches)
+
+    def _timerange_ids(self, start=None, stop=None):
+        """Get ids of coincidences within a timerange
+
+        Uses the sorted timestamps of the membership index.
+
+        :param start: timestamp from which to look for coincidences.
+        :param stop: end timestamp for coincidences.
+        :return: sorted array of coincidence ids.
+
+        """
+        timestamps = self.membership_index.timestamps
+        if start:
+            first = timestamps.read().searchsorted(start, side='left')
+        else:
+            first = 0
+        if stop:
+            last = timestamps.read().searchsorted(stop, side='left')
+        else:
+            last = timestamps.nrows
+        ids = self.membership_index.timestamp_order[first:last]
+        ids.sort()
+        return ids
+
     def _get_allowed_s_columns(self, stations):
         """Get column names for given stations
 
@@ -209,45 +327,81 @@ class CoincidenceQuery(object):
         """
         return ['s%d' % station for station in stations]
 
-    def _get_events(self, coincidence):
-        """Get events belonging to a coincidence
+    def _iter_events_in_blocks(self, coincidences, table='events'):
+        """Get rows belonging to coincidences, reading blocks at once
 
-        :param coincidence: A coincidence row.
-        :return: list of tuples containing station numbers and events.
+        :param coincidences: list of coincidence rows.
+        :param table: name of the station table from which to get rows,
+                      i.e. 'events' or 'reconstructions'.
+        :return: generator yielding a list of tuples containing station
+                 numbers and rows for each coincidence.
 
         """
-        events = []
-        c_idx = self.c_index[coincidence['id']]
-        for s_idx, e_idx in c_idx:
-            station_number = self.s_numbers[s_idx]
+        coincidences = iter(coincidences)
+        while True:
+            # Only keep the ids, rows from an iterator are reused
+            ids = [coincidence['id'] for coincidence
+                   in itertools.islice(coincidences, EVENTS_BLOCK_SIZE)]
+            if not ids:
+                break
+            for events in self._get_events_batch(ids, table):
+                yield events
+
+    def _get_events_batch(self, ids, table='events'):
+        """Get rows belonging to a block of coincidences
+
+        Instead of reading the rows one by one, the required rows are
+        read using a single sorted read for each station.
+
+        :param ids: list of coincidence ids.
+        :param table: name of the station table from which to get rows,
+                      i.e. 'events' or 'reconstructions'.
+        :return: list of tuples containing station numbers and rows for
+                 each coincidence.
+
+        """
+        c_idxs = self._get_c_indexes(ids)
+
+        # Gather the requested event indexes for each station
+        e_idxs = {}
+        for c_idx in c_idxs:
+            for s_idx, e_idx in c_idx.tolist():
+                e_idxs.setdefault(s_idx, []).append(e_idx)
+
+        rows = {}
+        for s_idx, station_e_idxs in e_idxs.items():
             s_node = self.s_nodes[s_idx]
             if s_node is None:
                 warnings.warn('Missing station group for station id %d. '
-                              'Events from it are excluded.' % s_idx)
+                              'Rows from it are excluded.' % s_idx)
                 continue
-            events.append((station_number, s_node.events[e_idx]))
-        return events
+            unique_idxs = np.unique(station_e_idxs)
+            station_rows = s_node._f_get_child(table).read_coordinates(
+                unique_idxs)
+            rows[s_idx] = dict(zip(unique_idxs.tolist(), station_rows))
 
-    def _get_reconstructions(self, coincidence):
-        """Get event reconstructions belonging to a coincidence
+        coincidence_events = []
+        for c_idx in c_idxs:
+            events = [(self.s_numbers[s_idx], rows[s_idx][e_idx])
+                      for s_idx, e_idx in c_idx.tolist() if s_idx in rows]
+            coincidence_events.append(events)
+        return coincidence_events
 
-        :param coincidence: A coincidence row.
-        :return: list of tuples containing station numbers and
-                 reconstructed events.
+    def _get_c_indexes(self, ids):
+        """Get the c_index entries for coincidences
+
+        When the ids are (mostly) contiguous a range is read at once.
+
+        :param ids: list of coincidence ids.
+        :return: list of c_index arrays.
 
         """
-        reconstructions = []
-        c_idx = self.c_index[coincidence['id']]
-        for s_idx, e_idx in c_idx:
-            station_number = self.s_numbers[s_idx]
-            s_node = self.s_nodes[s_idx]
-            if s_node is None:
-                warnings.warn('Missing station group for station id %d.'
-                              'Reconstructions from it are excluded.' % s_idx)
-                continue
-            rec_table = s_node.reconstructions
-            reconstructions.append((station_number, rec_table[e_idx]))
-        return reconstructions
+        first, last = min(ids), max(ids) + 1
+        if last - first <= 2 * len(ids):
+            c_idxs = self.c_index.read(first, last)
+            return [c_idxs[c_id - first] for c_id in ids]
+        else:
+            return [self.c_index[c_id] for c_id in ids]
 
     def _get_reconstruction(self, coincidence):
         """Get coincidence reconstruction belonging to a coincidence
@@ -272,8 +426,7 @@ class CoincidenceQuery(object):
         :return: list of events for each coincidence.
 
         """
-        coincidence_events = (self._get_events(coincidence)
-                              for coincidence in coincidences)
+        coincidence_events = self._iter_events_in_blocks(coincidences)
         return self.minimum_events_for_coincidence(coincidence_events, n)
 
     def all_reconstructions(self, coincidences, n=0):
@@ -284,8 +437,8 @@ class CoincidenceQuery(object):
         :return: list of reconstructed events for each coincidence.
 
         """
-        coincidence_recs = (self._get_reconstructions(coincidence)
-                            for coincidence in coincidences)
+        coincidence_recs = self._iter_events_in_blocks(coincidences,
+                                                       'reconstructions')
         return self.minimum_events_for_coincidence(coincidence_recs, n)
 
     def minimum_events_for_coincidence(self, coincidences_events, n=2):
@@ -308,12 +461,31 @@ class CoincidenceQuery(object):
         :return: list of filtered events for each coincidence.
 
         """
-        events_iterator = (self._get_events(coincidence)
-                           for coincidence in coincidences)
+        if self.membership_index is not None and n > 0:
+            coincidences = self._with_members(coincidences, stations)
+        events_iterator = self._iter_events_in_blocks(coincidences)
         coincidences_events = (self._events_from_stations(events, stations)
                                for events in events_iterator)
         return self.minimum_events_for_coincidence(coincidences_events, n)
 
+    def _with_members(self, coincidences, stations):
+        """Skip coincidences without any of the given stations
+
+        Uses the membership index to determine which coincidences do not
+        contain any of the stations, the events of those do not need to
+        be read.
+
+        :param coincidences: list of coincidence rows.
+        :param stations: list of station numbers.
+        :return: coincidences which contain any of the stations.
+
+        """
+        s_columns = self._get_allowed_s_columns(stations)
+        has_member = np.zeros(self.coincidences.nrows, dtype=bool)
+        has_member[self._membership_query_ids(s_columns, 1)] = True
+        return (coincidence for coincidence in coincidences
+                if has_member[coincidence['id']])
+
     def reconstructions_from_stations(self, coincidences, stations, n=2):
         """Only get reconstructions for specific stations for coincidences.
 
@@ -322,8 +494,8 @@ class CoincidenceQuery(object):
         :return: list of filtered reconstructed events for each coincidence.
 
         """
-        reconstructions_iterator = (self._get_reconstructions(coincidence)
-                                    for coincidence in coincidences)
+        reconstructions_iterator = self._iter_events_in_blocks(
+            coincidences, 'reconstructions')
         coincidences_recs = (self._events_from_stations(recs, stations)
                              for recs in reconstructions_iterator)
         return self.minimum_events_for_coincidence(coincidences_recs, n)
@@ -374,3 +546,83 @@ class CoincidenceQuery(object):
                                    self.coincidences._v_parent._v_pathname)
         except AttributeError:
             return "<finished %s>" % self.__class__.__name__
+
+
+def create_membership_index(data, coincidence_group='/coincidences',
+                            overwrite=False):
+    """Store a station membership index for the coincidences
+
+    For each coincidence the participating stations are stored as packed
+    bits in one or more uint64 words, bit ``i`` corresponds to the
+    ``i``-th station column of the coincidences table.  The timestamps of
+    the coincidences are stored sorted, together with the sorting order,
+    to quickly find the coincidences within a timerange.
+
+    The index is stored in a ``membership_index`` group in the coincidence
+    group and is automatically used by :class:`CoincidenceQuery`.  It
+    should be recreated when coincidences are added.
+
+    :param data: the PyTables datafile.
+    :param coincidence_group: path to the coincidences group.
+    :param overwrite: if True, replace an existing index.
+
+    """
+    group = data.get_node(coincidence_group)
+    coincidences = group.coincidences
+    if 'membership_index' in group:
+        if not overwrite:
+            raise RuntimeError("Membership index already exists for %s, "
+                               "use overwrite=True" % group._v_pathname)
+        data.remove_node(group, 'membership_index', recursive=True)
+
+    s_columns = [column for column in coincidences.colnames
+                 if re.match('s[0-9]+$', column)]
+    n_words = max(1, (len(s_columns) + 63) // 64)
+
+    index = data.create_group(group, 'membership_index',
+                              'Station membership index')
+    stations = data.create_earray(index, 'stations', tables.UInt64Atom(),
+                                  shape=(0, n_words),
+                                  expectedrows=coincidences.nrows)
+    stations.attrs.columns = s_columns
+
+    for start in range(0, coincidences.nrows, INDEX_CHUNK_SIZE):
+        chunk = coincidences.read(start, start + INDEX_CHUNK_SIZE)
+        words = np.zeros((len(chunk), n_words), dtype=np.uint64)
+        for i, column in enumerate(s_columns):
+            member = chunk[column].astype(np.uint64)
+            words[:, i // 64] |= member << np.uint64(i % 64)
+        stations.append(words)
+
+    timestamps = coincidences.col('timestamp')
+    order = timestamps.argsort(kind='mergesort')
+    data.create_array(index, 'timestamps', timestamps[order])
+    data.create_array(index, 'timestamp_order', order.astype(np.int64))
+    data.flush()
+
+
+def _membership_bits(columns, s_columns):
+    """Get word and bit positions of station columns in the index
+
+    :param columns: station columns of the membership index.
+    :param s_columns: the station columns to look up.
+    :return: list of tuples with the word and bit for each column.
+
+    """
+    columns = list(columns)
+    positions = [columns.index(column) for column in s_columns]
+    return [(i // 64, np.uint64(i % 64)) for i in positions]
+
+
+def _count_members(words, bits):
+    """Count the number of set bits for each row of packed words
+
+    :param words: array with the packed membership bits for coincidences.
+    :param bits: list of tuples with word and bit positions to count.
+    :return: array with the number of set bits for each coincidence.
+
+    """
+    count = np.zeros(len(words), dtype=np.int64)
+    for word, bit in bits:
+        count += ((words[:, word] >> bit) & np.uint64(1)).astype(np.int64)
+    return count
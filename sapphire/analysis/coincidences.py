@@ -33,15 +33,28 @@
 from __future__ import print_function
 
 import os.path
+from bisect import bisect_left, bisect_right
 
 import tables
 import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
 from progressbar import ProgressBar, ETA, Bar, Percentage
 from six.moves import range
 
 from . import process_events
 from .. import storage
-from ..utils import pbar
+from ..utils import pbar, get_process_pool
+
+
+#: Number of coincidences which are stored at once.
+STORE_CHUNK_SIZE = 100000
+
+#: Data type of the sorted event timestamps of all stations, as used in the
+#: coincidence search: the timestamp in nanoseconds, an index into the list
+#: of stations and an index into that station's event table.
+TIMESTAMPS_DTYPE = np.dtype([('timestamp', np.uint64),
+                             ('station_idx', np.uint16),
+                             ('event_idx', np.uint32)])
 
 
 class Coincidences(object):
@@ -137,22 +150,32 @@ class Coincidences(object):
             self.data = data
             self.opened = False
         if coincidence_group is not None:
-            if coincidence_group in self.data:
-                if overwrite:
-                    self.data.remove_node(coincidence_group, recursive=True)
-                else:
-                    raise RuntimeError("Group %s already exists in datafile, "
-                                       "and overwrite is False" %
-                                       coincidence_group)
-            head, tail = os.path.split(coincidence_group)
-            self.coincidence_group = self.data.create_group(head, tail,
-                                                            createparents=True)
+            self.coincidence_group = self._create_coincidence_group(
+                coincidence_group, overwrite)
         self.station_groups = station_groups
 
         self.trig_threshold = 0.5
         self.overwrite = overwrite
         self.progress = progress
 
+    def _create_coincidence_group(self, coincidence_group, overwrite):
+        """Create the destination group, optionally removing an existing one
+
+        :param coincidence_group: path of the destination group.
+        :param overwrite: if True overwrite a previous coincidences group.
+        :return: the new group.
+
+        """
+        if coincidence_group in self.data:
+            if overwrite:
+                self.data.remove_node(coincidence_group, recursive=True)
+            else:
+                raise RuntimeError("Group %s already exists in datafile, "
+                                   "and overwrite is False" %
+                                   coincidence_group)
+        head, tail = os.path.split(coincidence_group)
+        return self.data.create_group(head, tail, createparents=True)
+
     def __enter__(self):
         return self
 
@@ -181,7 +204,8 @@ class Coincidences(object):
         self.process_events()
         self.store_coincidences()
 
-    def search_coincidences(self, window=10000, shifts=None, limit=None):
+    def search_coincidences(self, window=10000, shifts=None, limit=None,
+                            vectorized=True):
         """Search for coincidences.
 
         Search all data in the station_groups for coincidences, and store
@@ -194,10 +218,10 @@ class Coincidences(object):
         _src_c_index and _src_timestamps.  The former is a list of
         coincidences, which each consist of a list with indexes into the
         timestamps array as a pointer to the events making up the
-        coincidence. The latter is a list of tuples.  Each tuple consists
-        of a timestamp followed by an index into the stations list which
-        designates the detector station which measured the event, and
-        finally an index into that station's event table.
+        coincidence. The latter is an array with a row for each event.  Each
+        row consists of a timestamp followed by an index into the stations
+        list which designates the detector station which measured the event,
+        and finally an index into that station's event table.
 
         :param window: the coincidence time window in nanoseconds. All events
             with delta t's smaller than this window will be considered a
@@ -208,11 +232,14 @@ class Coincidences(object):
             Use 'None' for no shift.
         :param limit: optionally limit the search for this number of
             events.
+        :param vectorized: if True (default) use the NumPy search engine,
+            otherwise use the (slow) pure Python search. Both give
+            identical results.
 
         """
         c_index, timestamps = \
-            self._search_coincidences(window, shifts, limit)
-        timestamps = np.array(timestamps, dtype=np.uint64)
+            self._search_coincidences(window, shifts, limit, vectorized)
+        timestamps = structured_to_unstructured(timestamps, dtype=np.uint64)
         self.data.create_array(self.coincidence_group, '_src_timestamps',
                                timestamps)
         src_c_index = self.data.create_vlarray(self.coincidence_group,
@@ -347,7 +374,8 @@ class Coincidences(object):
         self.observables.flush()
         return event_id
 
-    def _search_coincidences(self, window=10000, shifts=None, limit=None):
+    def _search_coincidences(self, window=10000, shifts=None, limit=None,
+                             vectorized=True):
         """Search for coincidences
 
         Search for coincidences in a set of PyTables event tables, optionally
@@ -363,29 +391,33 @@ class Coincidences(object):
         :param shifts: a list of time shifts in seconds, use 'None' for no
             shift.
         :param limit: limit the number of events which are processed.
+        :param vectorized: if True use the NumPy search engine
+            :meth:`_do_search_coincidences_vectorized`.
 
         :return: coincidences, timestamps. First a list of coincidences, which
             each consist of a list with indexes into the timestamps array as a
-            pointer to the events making up the coincidence. Then, a list of
-            tuples.  Each tuple consists of a timestamp followed by an index
-            into the stations list which designates the detector
-            station which measured the event, and finally an index into that
-            station's event table.
+            pointer to the events making up the coincidence. Then, a
+            structured array (see :meth:`_retrieve_timestamps`).  Each row
+            consists of a timestamp followed by an index into the stations
+            list which designates the detector station which measured the
+            event, and finally an index into that station's event table.
 
         """
-        # get the 'events' tables from the groups or groupnames
-        event_tables = []
-        for station_group in self.station_groups:
-            station_group = self.data.get_node(station_group)
-            if 'events' in station_group:
-                event_tables.append(self.data.get_node(station_group,
-                                                       'events'))
-
+        event_tables = self._get_event_tables()
         timestamps = self._retrieve_timestamps(event_tables, shifts, limit)
-        coincidences = self._do_search_coincidences(timestamps, window)
+        if vectorized:
+            coincidences = self._do_search_coincidences_vectorized(timestamps,
+                                                                   window)
+        else:
+            coincidences = self._do_search_coincidences(timestamps, window)
 
         return coincidences, timestamps
 
+    def _get_event_tables(self):
+        """Get the 'events' tables from the groups or groupnames"""
+
+        return _get_event_tables(self.data, self.station_groups)
+
     def _retrieve_timestamps(self, event_tables, shifts=None, limit=None):
         """Retrieve all timestamps from all stations, optionally shifting them
 
@@ -394,44 +426,35 @@ class Coincidences(object):
         necessary when one wants to compare the timestamps of stations who use
         a different time (as in GPS, UTC or local time).
 
+        The event tables are normally already sorted by timestamp, so the
+        timestamps of all stations are merged using a stable sort, which
+        makes use of the existing sorted runs.  Events with equal timestamps
+        are ordered by station index and then by event index.
+
         :param event_tables: a list of HiSPARC event tables, usually from
             different stations.
         :param shifts: a list of time shifts in seconds, use 'None' for no
             shift.
         :param limit: limit the number of events which are processed.
 
-        :return: list of tuples.  Each tuple consists of a timestamp followed
-            by an index into the stations list which designates the detector
-            station which measured the event, and finally an index of the
-            event into the station's event table.
+        :return: structured array (see :data:`TIMESTAMPS_DTYPE`) sorted by
+            timestamp.  Each row consists of a timestamp followed by an index
+            into the stations list which designates the detector station which
+            measured the event, and finally an index of the event into the
+            station's event table.
 
         """
-        # calculate the shifts in nanoseconds and cast them to int.
-        # (prevent upcasting timestamps to float64 further on)
-        if shifts is not None:
-            shifts = [int(shift * 1e9) if shift is not None else shift
-                      for shift in shifts]
+        shifts = _shifts_in_ns(shifts, len(event_tables))
 
-        timestamps = []
+        station_timestamps = []
         for s_id, event_table in enumerate(event_tables):
-            ts = [(x, s_id, j) for j, x in
-                  enumerate(event_table.col('ext_timestamp')[:limit])]
-            try:
-                # shift data. carefully avoid upcasting (we're adding two
-                # ints, which is an int, and casting that back to uint64. if
-                # we're not careful, an intermediate value will be a float64,
-                # which doesn't hold the precision to store nanoseconds.
-                ts = [(np.uint64(int(x) + shifts[i]), i, j)
-                      for x, i, j in ts]
-            except (TypeError, IndexError):
-                # shift is None or doesn't exist
-                pass
-            timestamps.extend(ts)
-
-        # sort the timestamps
-        timestamps.sort()
+            ts = np.array(event_table.col('ext_timestamp')[:limit],
+                          dtype=np.uint64)
+            if shifts[s_id] is not None:
+                ts = shift_timestamps(ts, shifts[s_id])
+            station_timestamps.append(_station_timestamps(ts, s_id))
 
-        return timestamps
+        return _merge_station_timestamps(station_timestamps)
 
     def _do_search_coincidences(self, timestamps, window):
         """Search for coincidences in a set of timestamps
@@ -440,8 +463,8 @@ class Coincidences(object):
         for events which occured almost at the same time and thus might be the
         result of an extended air shower.
 
-        :param timestamps: a list of tuples (timestamp, station_idx,
-            event_idx) which will be searched
+        :param timestamps: structured array as returned by
+            :meth:`_retrieve_timestamps` which will be searched.
         :param window: the time window in nanoseconds which will be searched
             for coincidences.  Events falling outside this window will not be
             part of the coincidence.
@@ -493,6 +516,29 @@ class Coincidences(object):
 
         return coincidences
 
+    def _do_search_coincidences_vectorized(self, timestamps, window):
+        """Search for coincidences in a set of timestamps using NumPy
+
+        This gives exactly the same result as :meth:`_do_search_coincidences`,
+        but uses a sweep-line over the sorted timestamps (see
+        :func:`search_sorted_timestamps`) instead of a nested Python loop.
+
+        :param timestamps: structured array as returned by
+            :meth:`_retrieve_timestamps` which will be searched.
+        :param window: the time window in nanoseconds which will be searched
+            for coincidences.  Events falling outside this window will not be
+            part of the coincidence.
+
+        :return: a list of coincidences, which each consist of a list with
+            indexes into the timestamps array as a pointer to the events
+            making up the coincidence
+
+        """
+        starts, stops = search_sorted_timestamps(timestamps['timestamp'],
+                                                 window)
+        return [list(range(start, stop))
+                for start, stop in zip(starts.tolist(), stops.tolist())]
+
     def __repr__(self):
         if not self.data.isopen:
             return "<finished %s>" % self.__class__.__name__
@@ -577,8 +623,48 @@ class CoincidencesESD(Coincidences):
     Coincidences stored by this class can easily be searched by using
     a :class:`~sapphire.analysis.coincidence_queries.CoincidenceQuery` object.
 
+    If new data is regularly added to the station groups, for instance by
+    downloading each day using :func:`~sapphire.esd.download_data`, the
+    coincidences can be updated incrementally.  Only coincidences starting
+    in the new events are searched and appended to the existing tables::
+
+        >>> with CoincidencesESD('data.h5', '/coincidences', groups,
+        ...                      incremental=True) as coin:
+        ...     coin.search_and_store_coincidences(station_numbers=[501, 503])
+
     """
 
+    def __init__(self, data, coincidence_group, station_groups,
+                 overwrite=False, progress=True, incremental=False):
+        """Initialize the class.
+
+        :param data: either a PyTables file or path to a HDF5 file.
+        :param coincidence_group: the destination group. If None the results
+            can not be stored, but coincidences can still be searched for.
+        :param station_groups: a list of groups containing the station data.
+        :param overwrite: if True overwrite a previous coincidences group.
+        :param progress: if True show a progressbar while storing coincidences.
+        :param incremental: if True use an existing coincidences group, if
+            any, and append new coincidences to it when calling
+            :meth:`search_and_store_coincidences`.
+
+        """
+        self.incremental = incremental
+        super(CoincidencesESD, self).__init__(data, coincidence_group,
+                                              station_groups, overwrite,
+                                              progress)
+
+    def _create_coincidence_group(self, coincidence_group, overwrite):
+        """Create the destination group, or get it in incremental mode"""
+
+        if self.incremental and not overwrite:
+            try:
+                return self.data.get_node(coincidence_group)
+            except tables.NoSuchNodeError:
+                pass
+        return super(CoincidencesESD, self)._create_coincidence_group(
+            coincidence_group, overwrite)
+
     def search_and_store_coincidences(self, window=10000,
                                       station_numbers=None):
         """Search and store coincidences.
@@ -586,11 +672,138 @@ class CoincidencesESD(Coincidences):
         This is a semi-automatic method to search for coincidences
         and then store the results in the coincidences group.
 
+        In incremental mode only new coincidences are searched and
+        appended, see :meth:`_search_and_store_new_coincidences`.
+
         """
-        self.search_coincidences(window=window)
+        if self.incremental:
+            self._search_and_store_new_coincidences(window, station_numbers)
+        else:
+            self.search_coincidences(window=window)
+            self.store_coincidences(station_numbers=station_numbers)
+
+    def _search_and_store_new_coincidences(self, window, station_numbers):
+        """Search for new coincidences and append them to the group.
+
+        The group attributes keep track of the search.  For each station
+        the ``high_water_marks`` attribute contains the ext_timestamp of
+        the last event which has been searched as the start of a
+        coincidence.  Only events after these high-water marks are read.
+
+        New events may still be added to a station, so a coincidence can
+        only be stored if all events within its window are available.
+        Coincidences are therefore only searched up to one window before
+        the last event of the station whose data ends first.  The
+        remaining events are searched in the next update.  Stations
+        without events, or without new events since the previous update
+        (e.g. a station which stopped sending data), are ignored.  Events
+        of such a station which are added later, but are older than the
+        events searched in the meantime, are not part of coincidences.
+
+        The event tables need to be sorted by timestamp, and new events
+        need to be appended after the existing events.
+
+        :param window: the coincidence window in nanoseconds, this must be
+            the same for each update.
+        :param station_numbers: optional list of station_numbers, see
+            :meth:`store_coincidences`.  After the first update the stored
+            station numbers are used.
+
+        """
+        attrs = self.coincidence_group._v_attrs
+        event_tables = []
+        for station_group in self.station_groups:
+            try:
+                event_tables.append(self.data.get_node(station_group,
+                                                       'events'))
+            except tables.NoSuchNodeError:
+                raise RuntimeError("Incremental coincidence search requires "
+                                   "an events table in each station group.")
+
+        if 'coincidences' in self.coincidence_group:
+            if 'window' not in attrs:
+                raise RuntimeError("The coincidences in the group were not "
+                                   "stored by an incremental search.")
+            if attrs.window != window:
+                raise RuntimeError("The coincidence window (%d) must be equal "
+                                   "to that of the previous search (%d)." %
+                                   (window, attrs.window))
+            if list(attrs.station_groups) != list(self.station_groups):
+                raise RuntimeError("The station groups must be equal to those "
+                                   "of the previous search.")
+            station_numbers = attrs.station_numbers
+            high_water_marks = attrs.high_water_marks
+            last_event = attrs.last_coincidence_event
+            previous_last_timestamps = getattr(
+                attrs, 'last_timestamps', [None] * len(event_tables))
+        else:
+            high_water_marks = [None] * len(event_tables)
+            last_event = None
+            previous_last_timestamps = [None] * len(event_tables)
+
+        # index of the first new event and the timestamp of the last event
+        first_events = []
+        last_timestamps = []
+        for event_table, high_water_mark in zip(event_tables,
+                                                high_water_marks):
+            ts = event_table.cols.ext_timestamp
+            if high_water_mark is None:
+                first_events.append(0)
+            else:
+                first_events.append(bisect_right(
+                    ts, np.uint64(high_water_mark), 0, len(event_table)))
+            if len(event_table):
+                last_timestamps.append(int(ts[len(event_table) - 1]))
+            else:
+                last_timestamps.append(None)
+
+        # Ignore stations without new events since the previous update,
+        # such that a station which stopped does not block the search.
+        active = [last for last, previous
+                  in zip(last_timestamps, previous_last_timestamps)
+                  if last is not None and last != previous]
+        if not active or min(active) < window:
+            return
+        stop = min(active) - window + 1
+
+        shifts = [None] * len(event_tables)
+        events, idx, starts, stops, _ = _search_chunk(
+            event_tables, shifts, None, window, 0, stop, first_events)
+
+        # drop a coincidence which is part of the last stored coincidence
+        if len(stops) and last_event is not None:
+            first_end = events[idx.searchsorted(stops[0] - 1)]
+            if (int(first_end['station_idx']),
+                    int(first_end['event_idx'])) == tuple(last_event):
+                starts = starts[1:]
+                stops = stops[1:]
+
+        self._src_timestamps = events
+        self._src_c_index = [list(range(first, first + n))
+                             for first, n in zip(idx.searchsorted(starts),
+                                                 stops - starts)]
         self.store_coincidences(station_numbers=station_numbers)
 
-    def search_coincidences(self, window=10000, shifts=None, limit=None):
+        for s_id, (event_table, first_event) in enumerate(zip(event_tables,
+                                                              first_events)):
+            ts = event_table.cols.ext_timestamp
+            last_searched = bisect_left(ts, np.uint64(stop), first_event,
+                                        len(event_table)) - 1
+            if last_searched >= first_event:
+                high_water_marks[s_id] = int(ts[last_searched])
+        if len(self._src_c_index):
+            last = events[self._src_c_index[-1][-1]]
+            last_event = (int(last['station_idx']), int(last['event_idx']))
+
+        attrs.window = window
+        attrs.station_groups = list(self.station_groups)
+        attrs.station_numbers = self.station_numbers
+        attrs.high_water_marks = high_water_marks
+        attrs.last_coincidence_event = last_event
+        attrs.last_timestamps = last_timestamps
+
+    def search_coincidences(self, window=10000, shifts=None, limit=None,
+                            vectorized=True, chunk_size=None, workers=None):
         """Search for coincidences.
 
         Search all data in the station_groups for coincidences, and store
@@ -603,10 +816,12 @@ class CoincidencesESD(Coincidences):
         attributes ``_src_c_index`` and ``_src_timestamps``.  The
         former is a list of coincidences, which each consist of a list with
         indexes into the timestamps array as a pointer to the events making up
-        the coincidence. The latter is a list of tuples.  Each tuple consists
-        of a timestamp followed by an index into the stations list which
-        designates the detector station which measured the event, and finally
-        an index into that station's event table.
+        the coincidence. The latter is a structured array with the fields
+        ``timestamp``, ``station_idx`` and ``event_idx`` (see
+        :data:`TIMESTAMPS_DTYPE`), giving for each event the timestamp, an
+        index into the stations list which designates the detector station
+        which measured the event, and an index into that station's event
+        table.
 
         :param window: the coincidence time window.  All events with delta
             t's smaller than this window will be considered a coincidence.
@@ -615,12 +830,141 @@ class CoincidencesESD(Coincidences):
             Expects a list of shifts, one for each station.
         :param limit: optionally limit the search for this number of
             events.
+        :param vectorized: if True (default) use the NumPy search engine,
+            otherwise use the (slow) pure Python search. Both give
+            identical results.
+        :param chunk_size: optionally search the data in consecutive chunks
+            of this duration (in seconds), instead of reading all
+            timestamps at once.  If there is a coincidence group, the
+            results of each chunk are appended to the ``_src_c_index``
+            VLArray and ``_src_timestamps`` table in that group as soon as
+            the chunk has been searched.  This bounds the memory usage for
+            long time ranges.  Without a coincidence group the results are
+            kept in memory.  The station event tables need to be sorted by
+            timestamp (which is the case for ESD data).  The same
+            coincidences are found, but ``_src_timestamps`` will only
+            contain the events which are part of a coincidence.
+        :param workers: optionally search the chunks in parallel using
+            this number of worker processes.  If no `chunk_size` is given
+            the time range is split into four chunks per worker.  The
+            result is identical to a serial search.
 
         """
-        c_index, timestamps = self._search_coincidences(window, shifts, limit)
+        if chunk_size is not None or workers is not None:
+            c_index, timestamps = self._search_coincidences_chunked(
+                window, shifts, limit, chunk_size, workers)
+        else:
+            c_index, timestamps = self._search_coincidences(
+                window, shifts, limit, vectorized)
         self._src_timestamps = timestamps
         self._src_c_index = c_index
 
+    def _search_coincidences_chunked(self, window, shifts, limit, chunk_size,
+                                     workers=None):
+        """Search for coincidences in consecutive chunks of time
+
+        The full time range of the data is split into chunks of
+        `chunk_size` seconds.  For each chunk the timestamps of events in
+        that chunk, plus those in the following coincidence window, are
+        read from the event tables.  Coincidences starting in the chunk are
+        then searched and stitched to those of the previous chunks, see
+        :func:`_stitch_chunks`.
+
+        If workers are used, each worker opens the data file read-only and
+        searches whole chunks.  The results of the chunks are kept in
+        memory until all workers are done, and are then stitched in the
+        order of the chunks and stored.  The result does not depend on the
+        number of workers.
+
+        :param window: the time window in nanoseconds.
+        :param shifts: a list of time shifts in seconds, use 'None' for no
+            shift.
+        :param limit: limit the number of events which are processed.
+        :param chunk_size: duration of the chunks in seconds, if None the
+            time range is split into four chunks per worker.
+        :param workers: number of worker processes, if None the chunks are
+            searched in this process.
+
+        :return: coincidences, timestamps. As for
+            :meth:`_search_coincidences`, but the timestamps only contain
+            events which are part of a coincidence.  These are nodes in
+            the coincidence group if there is one, see
+            :meth:`_store_chunks`.
+
+        """
+        event_tables = self._get_event_tables()
+        shifts = _shifts_in_ns(shifts, len(event_tables))
+        if chunk_size is None:
+            n_chunks = 4 * workers
+        else:
+            n_chunks = None
+            chunk_size = int(chunk_size * 1e9)
+        chunks = _time_chunks(event_tables, shifts, limit, chunk_size,
+                              n_chunks)
+
+        if workers is None:
+            results = (_search_chunk(event_tables, shifts, limit, window,
+                                     start, stop)
+                       for start, stop in chunks)
+            return self._store_chunks(_stitch_chunks(
+                pbar(results, length=len(chunks), show=self.progress)))
+
+        self.data.flush()
+        station_groups = [event_table._v_parent._v_pathname
+                          for event_table in event_tables]
+        tasks = [(self.data.filename, station_groups, shifts, limit, window,
+                  start, stop)
+                 for start, stop in chunks]
+        pool = get_process_pool(workers)
+        try:
+            # The workers read the file, so nothing may be written to it
+            # until all chunks have been searched.
+            results = list(pbar(pool.imap(_search_chunk_in_file, tasks),
+                                length=len(chunks), show=self.progress))
+        finally:
+            pool.close()
+            pool.join()
+        return self._store_chunks(_stitch_chunks(results))
+
+    def _store_chunks(self, chunks):
+        """Store the coincidences found in consecutive chunks
+
+        If there is a coincidence group, the coincidences and timestamps
+        of each chunk are appended to the ``_src_c_index`` VLArray and
+        ``_src_timestamps`` table in the group, replacing those of a
+        previous search.  Only the results of one chunk are then kept in
+        memory.  Otherwise the results are combined in memory.
+
+        :param chunks: iterable with the results of consecutive chunks,
+            see :func:`_stitch_chunks`.
+        :return: coincidences, timestamps.  Either the nodes in the
+            coincidence group or a list and an array.
+
+        """
+        if getattr(self, 'coincidence_group', None) is None:
+            coincidences = []
+            timestamps = [np.empty(0, dtype=TIMESTAMPS_DTYPE)]
+            for chunk_coincidences, chunk_timestamps in chunks:
+                coincidences.extend(chunk_coincidences)
+                timestamps.append(chunk_timestamps)
+            return coincidences, np.concatenate(timestamps)
+
+        for name in ('_src_c_index', '_src_timestamps'):
+            if name in self.coincidence_group:
+                self.data.remove_node(self.coincidence_group, name)
+        c_index = self.data.create_vlarray(self.coincidence_group,
+                                           '_src_c_index', tables.UInt32Atom())
+        timestamps = self.data.create_table(self.coincidence_group,
+                                            '_src_timestamps',
+                                            TIMESTAMPS_DTYPE)
+        for chunk_coincidences, chunk_timestamps in chunks:
+            for coincidence in chunk_coincidences:
+                c_index.append(coincidence)
+            timestamps.append(chunk_timestamps)
+        c_index.flush()
+        timestamps.flush()
+        return c_index, timestamps
+
     def store_coincidences(self, station_numbers=None):
         """Store the previously found coincidences.
 
@@ -629,6 +973,9 @@ class CoincidencesESD(Coincidences):
         method. It also created a ``c_index`` and ``s_index`` table to
         find the source events.
 
+        In incremental mode, if the tables already exist, the coincidences
+        are appended to the existing tables.
+
         :param station_numbers: optional list of station_numbers.
             If given these will be used to attach correct numbers to the
             station column names in the coincidences table. Otherwise
@@ -649,23 +996,21 @@ class CoincidencesESD(Coincidences):
             s_columns = {'s%d' % n: tables.BoolCol(pos=(n + 12))
                          for n, _ in enumerate(self.station_groups)}
 
+        if self.incremental and 'coincidences' in self.coincidence_group:
+            self.coincidences = self.coincidence_group.coincidences
+            c_index = self.coincidence_group.c_index
+            self._store_coincidences_in_chunks(c_index)
+            return
+
         description = storage.Coincidence
         description.columns.update(s_columns)
         self.coincidences = self.data.create_table(
             self.coincidence_group, 'coincidences', description,
             expectedrows=n_coincidences)
-
-        self.c_index = []
-
-        for coincidence in pbar(self._src_c_index, show=self.progress):
-            self._store_coincidence(coincidence)
-
         c_index = self.data.create_vlarray(
             self.coincidence_group, 'c_index', tables.UInt32Col(shape=2),
             expectedrows=n_coincidences)
-        for observables_idx in pbar(self.c_index, show=self.progress):
-            c_index.append(observables_idx)
-        c_index.flush()
+        self._store_coincidences_in_chunks(c_index)
 
         s_index = self.data.create_vlarray(
             self.coincidence_group, 's_index', tables.VLStringAtom(),
@@ -674,42 +1019,389 @@ class CoincidencesESD(Coincidences):
             s_index.append(station_group.encode('utf-8'))
         s_index.flush()
 
-    def _store_coincidence(self, coincidence):
-        """Store a single coincidence in the coincidence group.
+    def _store_coincidences_in_chunks(self, c_index):
+        """Store the coincidences in chunks of STORE_CHUNK_SIZE
 
-        Stores coincidence in the coincidences table and references
-        to the observables making up each coincidence in ``c_index``.
+        :param c_index: the ``c_index`` VLArray.
 
         """
-        row = self.coincidences.row
-        coincidence_id = len(self.coincidences)
-        row['id'] = coincidence_id
-        row['N'] = len(coincidence)
+        chunks = range(0, len(self._src_c_index), STORE_CHUNK_SIZE)
+        for start in pbar(chunks, show=self.progress):
+            self._store_coincidences_chunk(
+                self._src_c_index[start:start + STORE_CHUNK_SIZE], c_index)
+        self.coincidences.flush()
+        c_index.flush()
 
-        observables_idx = []
-        timestamps = []
-        for index in coincidence:
-            event_desc = self._src_timestamps[index]
-            station_id = event_desc[1]
-            event_index = event_desc[2]
+    def _store_coincidences_chunk(self, coincidences, c_index):
+        """Store a chunk of coincidences in the coincidence group.
+
+        The coincidence rows are built column-wise and appended to the
+        coincidences table at once.  The timestamps of the events are read
+        from each station's event table with a single read per column.
+        References to the events making up each coincidence are appended
+        to ``c_index``.
+
+        :param coincidences: list of coincidences, each a list of indexes
+            into ``_src_timestamps``.
+        :param c_index: the ``c_index`` VLArray.
+
+        """
+        if not len(coincidences):
+            return
+
+        lengths = np.array([len(c) for c in coincidences])
+        # index of the first event of each coincidence in the flat arrays
+        starts = np.concatenate(([0], lengths.cumsum()[:-1]))
+        events = self._src_timestamps[np.concatenate(coincidences)]
+        station_ids = events['station_idx']
+        event_ids = events['event_idx']
+
+        ext_timestamps = np.empty(len(events), dtype=np.uint64)
+        timestamps = np.empty(len(events), dtype=np.uint32)
+        nanoseconds = np.empty(len(events), dtype=np.uint32)
+        for station_id in np.unique(station_ids):
+            is_station = station_ids == station_id
+            idx, inverse = np.unique(event_ids[is_station],
+                                     return_inverse=True)
+            group = self.data.get_node(self.station_groups[station_id])
+            for column, values in [('ext_timestamp', ext_timestamps),
+                                   ('timestamp', timestamps),
+                                   ('nanoseconds', nanoseconds)]:
+                values[is_station] = group.events.read_coordinates(
+                    idx, field=column)[inverse]
+
+        # the first event is the event with the lowest timestamp
+        coincidence_ids = np.repeat(np.arange(len(coincidences)), lengths)
+        order = np.lexsort((nanoseconds, timestamps, ext_timestamps,
+                            coincidence_ids))
+        first = order[starts]
+
+        rows = np.zeros(len(coincidences), dtype=self.coincidences.dtype)
+        for column, default in self.coincidences.coldflts.items():
+            rows[column] = default
+        rows['id'] = np.arange(len(coincidences)) + len(self.coincidences)
+        rows['N'] = lengths
+        rows['ext_timestamp'] = ext_timestamps[first]
+        rows['timestamp'] = timestamps[first]
+        rows['nanoseconds'] = nanoseconds[first]
+        for station_id in np.unique(station_ids):
             if self.station_numbers is not None:
-                station_number = self.station_numbers[station_id]
-                row['s%d' % station_number] = True
+                column = 's%d' % self.station_numbers[station_id]
             else:
-                row['s%d' % station_id] = True
+                column = 's%d' % station_id
+            rows[column] = np.add.reduceat(station_ids == station_id,
+                                           starts) > 0
+        self.coincidences.append(rows)
 
-            group = self.data.get_node(self.station_groups[station_id])
-            event = group.events[event_index]
-            observables_idx.append((station_id, event_index))
-            timestamps.append((event['ext_timestamp'], event['timestamp'],
-                               event['nanoseconds']))
+        observables_idx = np.column_stack((station_ids, event_ids))
+        for observables in np.split(observables_idx.astype(np.uint32),
+                                    starts[1:]):
+            c_index.append(observables)
 
-        first_timestamp = sorted(timestamps)[0]
-        row['ext_timestamp'], row['timestamp'], row['nanoseconds'] = \
-            first_timestamp
-        row.append()
-        self.c_index.append(observables_idx)
-        self.coincidences.flush()
+
+def _get_event_tables(data, station_groups):
+    """Get the 'events' tables from the groups or groupnames"""
+
+    event_tables = []
+    for station_group in station_groups:
+        station_group = data.get_node(station_group)
+        if 'events' in station_group:
+            event_tables.append(data.get_node(station_group, 'events'))
+    return event_tables
+
+
+def _shifts_in_ns(shifts, n_stations):
+    """Get the time shift for each station in nanoseconds
+
+    The shifts are cast to int to prevent upcasting timestamps to float64
+    further on.
+
+    :param shifts: a list of time shifts in seconds, use 'None' for no
+        shift.  May be shorter than the number of stations, or None.
+    :param n_stations: number of stations.
+    :return: list with for each station the shift in ns, or None.
+
+    """
+    if shifts is None:
+        return [None] * n_stations
+    shifts = [int(shift * 1e9) if shift is not None else shift
+              for shift in shifts]
+    return (shifts + [None] * n_stations)[:n_stations]
+
+
+def _station_timestamps(timestamps, station_idx, first_event_idx=0):
+    """Create timestamps array for events from a single station
+
+    :param timestamps: array of (shifted) timestamps of the events.
+    :param station_idx: index of the station.
+    :param first_event_idx: index of the first event in the event table.
+    :return: structured array (see :data:`TIMESTAMPS_DTYPE`).
+
+    """
+    station_timestamps = np.empty(len(timestamps), dtype=TIMESTAMPS_DTYPE)
+    station_timestamps['timestamp'] = timestamps
+    station_timestamps['station_idx'] = station_idx
+    station_timestamps['event_idx'] = np.arange(len(timestamps))
+    station_timestamps['event_idx'] += first_event_idx
+    return station_timestamps
+
+
+def _merge_station_timestamps(station_timestamps):
+    """Merge the timestamps arrays of several stations
+
+    A stable sort is used, so events with equal timestamps are ordered by
+    station index and then by event index.
+
+    :param station_timestamps: list of arrays created by
+        :func:`_station_timestamps`, ordered by station index.
+    :return: structured array sorted by timestamp.
+
+    """
+    if not station_timestamps:
+        return np.empty(0, dtype=TIMESTAMPS_DTYPE)
+
+    timestamps = np.concatenate(station_timestamps)
+    order = timestamps['timestamp'].argsort(kind='stable')
+
+    return timestamps[order]
+
+
+def _n_events(event_table, limit):
+    """Number of events in an event table, optionally limited"""
+
+    if limit is None:
+        return len(event_table)
+    return min(len(event_table), limit)
+
+
+def _time_chunks(event_tables, shifts, limit, chunk_size, n_chunks=None):
+    """Split the time range of the (shifted) events into chunks
+
+    :param event_tables: a list of event tables, sorted by timestamp.
+    :param shifts: list of shifts in nanoseconds, see :func:`_shifts_in_ns`.
+    :param limit: limit the number of events which are processed.
+    :param chunk_size: duration of the chunks in nanoseconds.
+    :param n_chunks: if given, ignore chunk_size and split the time range
+        into this number of chunks.
+    :return: list of (start, stop) timestamps for each chunk.
+
+    """
+    first = []
+    last = []
+    for event_table, shift in zip(event_tables, shifts):
+        n_events = _n_events(event_table, limit)
+        if not n_events:
+            continue
+        ts = event_table.cols.ext_timestamp
+        first.append(int(ts[0]) + (shift or 0))
+        last.append(int(ts[n_events - 1]) + (shift or 0))
+
+    if not first:
+        return []
+
+    if n_chunks is not None:
+        # ceil division, to cover the full range with n_chunks chunks
+        chunk_size = max(1, -(-(max(last) + 1 - min(first)) // n_chunks))
+
+    return [(start, start + chunk_size)
+            for start in range(min(first), max(last) + 1, chunk_size)]
+
+
+def _read_timestamps(event_tables, shifts, limit, start, stop,
+                     first_events=None):
+    """Read all (shifted) timestamps in a time range
+
+    The event tables need to be sorted by timestamp.  The events in the
+    range are found using a binary search, so only the timestamps in the
+    range are read.
+
+    :param event_tables: a list of event tables, sorted by timestamp.
+    :param shifts: list of shifts in nanoseconds, see :func:`_shifts_in_ns`.
+    :param limit: limit the number of events which are processed.
+    :param start,stop: the range of (shifted) timestamps to read, stop is
+        excluded.
+    :param first_events: optionally, for each station the index of the
+        first event which may be read.
+    :return: structured array (see :data:`TIMESTAMPS_DTYPE`) sorted by
+        timestamp.
+
+    """
+    if first_events is None:
+        first_events = [0] * len(event_tables)
+
+    station_timestamps = []
+    for s_id, (event_table, shift) in enumerate(zip(event_tables, shifts)):
+        n_events = _n_events(event_table, limit)
+        ts = event_table.cols.ext_timestamp
+        lo, hi = [bisect_left(ts, np.uint64(max(0, t - (shift or 0))),
+                              first_events[s_id], n_events)
+                  for t in (start, stop)]
+        timestamps = event_table.read(lo, hi, field='ext_timestamp')
+        if shift is not None:
+            timestamps = shift_timestamps(timestamps, shift)
+        station_timestamps.append(_station_timestamps(timestamps, s_id, lo))
+
+    return _merge_station_timestamps(station_timestamps)
+
+
+def _search_chunk(event_tables, shifts, limit, window, start, stop,
+                  first_events=None):
+    """Search for coincidences starting in a chunk of time
+
+    Events up to one coincidence window after the end of the chunk are
+    also read, such that coincidences starting in the chunk are complete.
+
+    :param event_tables: a list of event tables, sorted by timestamp.
+    :param shifts: list of shifts in nanoseconds, see :func:`_shifts_in_ns`.
+    :param limit: limit the number of events which are processed.
+    :param window: the coincidence window in nanoseconds.
+    :param start,stop: the time range of the chunk.
+    :param first_events: optionally, for each station the index of the
+        first event which may be read.
+    :return: the events which are part of a coincidence, their indexes into
+        the events read for this chunk, the start and stop index into those
+        events for each coincidence and the number of events in the chunk
+        itself (excluding the extra window).
+
+    """
+    timestamps = _read_timestamps(event_tables, shifts, limit, start,
+                                  stop + window, first_events)
+    n_chunk = int(timestamps['timestamp'].searchsorted(np.uint64(stop)))
+    starts, stops = search_sorted_timestamps(timestamps['timestamp'][:n_chunk],
+                                             window,
+                                             timestamps['timestamp'])
+
+    # mark all events which are part of a coincidence
+    in_coincidence = np.zeros(len(timestamps) + 1, dtype=int)
+    np.add.at(in_coincidence, starts, 1)
+    np.add.at(in_coincidence, stops, -1)
+    idx = np.flatnonzero(in_coincidence.cumsum()[:-1])
+
+    return timestamps[idx], idx, starts, stops, n_chunk
+
+
+def _search_chunk_in_file(task):
+    """Search for coincidences in a chunk, reading from a file
+
+    This opens the file read-only, to be used in a worker process.
+
+    :param task: tuple of the path to the data file, the paths to the
+        station groups, and the remaining arguments for
+        :func:`_search_chunk`.
+    :return: the result of :func:`_search_chunk`.
+
+    """
+    filename, station_groups = task[:2]
+    with tables.open_file(filename, 'r') as data:
+        event_tables = _get_event_tables(data, station_groups)
+        return _search_chunk(event_tables, *task[2:])
+
+
+def _stitch_chunks(results):
+    """Combine the coincidences found in consecutive chunks of time
+
+    The chunks overlap by one coincidence window.  A coincidence starting
+    in the previous chunk may therefore end in the overlap with the current
+    chunk.  If the first coincidence of the current chunk ends at the same
+    event, it is a subset of that previous coincidence and it is dropped.
+    Events shared with coincidences of the previous chunk are stored only
+    once.
+
+    The chunks are stitched one at a time, only the position of the last
+    coincidence and event is kept between chunks.
+
+    :param results: iterable with results of :func:`_search_chunk` for
+        consecutive chunks.
+    :return: generator yielding for each chunk with coincidences the new
+        coincidences and the new timestamps.  Concatenated, these are as
+        returned by :meth:`Coincidences._search_coincidences`, but the
+        timestamps only contain events which are part of a coincidence.
+
+    """
+    # index of the first event of the chunk in the full (virtual) array of
+    # timestamps, stop of the last coincidence, and the index of the last
+    # stored event in that array.
+    offset = 0
+    last_stop = -1
+    last_event = -1
+    n_stored = 0
+
+    for events, idx, starts, stops, n_chunk in results:
+        if len(stops) and offset + stops[0] == last_stop:
+            starts = starts[1:]
+            stops = stops[1:]
+
+        if len(stops):
+            event_idx = offset + idx
+            is_new = event_idx > last_event
+            positions = np.where(is_new,
+                                 n_stored + is_new.cumsum() - 1,
+                                 n_stored - 1 - (last_event - event_idx))
+            first_positions = positions[idx.searchsorted(starts)]
+            coincidences = [list(range(first, first + stop - start))
+                            for first, start, stop
+                            in zip(first_positions.tolist(), starts.tolist(),
+                                   stops.tolist())]
+            n_stored += int(is_new.sum())
+            last_event = int(event_idx[-1])
+            last_stop = offset + int(stops[-1])
+            yield coincidences, events[is_new]
+
+        offset += n_chunk
+
+
+def shift_timestamps(timestamps, shift):
+    """Shift an array of timestamps by an integer number of nanoseconds
+
+    Carefully avoid upcasting, an intermediate float64 does not hold the
+    precision to store nanoseconds.
+
+    :param timestamps: array of timestamps in nanoseconds (uint64).
+    :param shift: shift in nanoseconds (int), may be negative.
+    :return: shifted timestamps (uint64).
+
+    """
+    if shift >= 0:
+        return timestamps + np.uint64(shift)
+    else:
+        return timestamps - np.uint64(-shift)
+
+
+def search_sorted_timestamps(timestamps, window, all_timestamps=None):
+    """Find coincidences in an array of sorted timestamps
+
+    Each coincidence is a contiguous range of the timestamps array.  For
+    every timestamp the end of its coincidence window is determined.  A
+    timestamp starts a coincidence if at least one other timestamp is
+    within the window and the window does not end at the same position as
+    that of the previous coincidence.  Because the window ends are
+    non-decreasing, such a coincidence would be a subset of the previous
+    one.
+
+    :param timestamps: sorted array of timestamps in nanoseconds (uint64).
+    :param window: the coincidence window in nanoseconds.
+    :param all_timestamps: optionally, an extended sorted array of which
+        timestamps is the start.  Coincidences may then extend beyond the
+        end of timestamps.
+    :return: arrays with the start (inclusive) and stop (exclusive) index
+        into the timestamps array for each coincidence.
+
+    """
+    timestamps = np.asarray(timestamps, dtype=np.uint64)
+    if all_timestamps is None:
+        all_timestamps = timestamps
+    # window end for each timestamp: first index with t - t0 >= window.
+    # Use uint64 for the window to prevent upcasting to float64.
+    stops = all_timestamps.searchsorted(timestamps + np.uint64(window),
+                                        side='left')
+    starts = np.arange(len(timestamps))
+    candidates = (stops - starts) > 1
+    starts = starts[candidates]
+    stops = stops[candidates]
+    # keep only the first candidate for each distinct window end
+    is_new = np.ones(len(stops), dtype=bool)
+    is_new[1:] = stops[1:] != stops[:-1]
+    return starts[is_new], stops[is_new]
 
 
 def get_events(data, stations, coincidence, timestamps, get_raw_traces=False):
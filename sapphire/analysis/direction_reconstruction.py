@@ -16,10 +16,11 @@
 
 """
 import warnings
-from itertools import combinations
+from itertools import combinations, islice
 
 from six.moves import zip_longest
 from six import itervalues
+import numpy as np
 from numpy import (nan, isnan, arcsin, arccos, arctan2, sin, cos, tan,
                    sqrt, where, pi, inf, array, cross, dot, sum, zeros)
 from scipy.optimize import minimize
@@ -29,12 +30,14 @@ from .event_utils import (station_arrival_time, detector_arrival_time,
                           relative_detector_arrival_times)
 from ..simulations.showerfront import CorsikaStationFront
 from ..utils import (pbar, norm_angle, c, make_relative, vector_length,
-                     floor_in_base, memoize)
+                     floor_in_base, memoize, get_active_index, ERR)
 from ..api import Station
 
 
 NO_OFFSET = [0., 0., 0., 0.]
 NO_STATION_OFFSET = (0., 100.)
+#: Number of events which are reconstructed at once by the batch methods
+CHUNK_SIZE = 100000
 
 
 class EventDirectionReconstruction(object):
@@ -105,9 +108,17 @@ class EventDirectionReconstruction(object):
         :param progress: if True show a progress bar while reconstructing.
         :param initials: list of dictionaries with already reconstructed shower
                          parameters.
-        :return: list of theta, phi, and detector ids.
+        :return: tuples of theta, phi, and detector ids.
+
+        If the events are a table or structured array, no initials are
+        given and the default algorithms are used, the events are
+        reconstructed in chunks using :meth:`batch_reconstruct_events`.
 
         """
+        if self._use_batch(events, initials):
+            theta, phi, ids = self.batch_reconstruct_events(
+                events, detector_ids, offsets, progress)
+            return tuple(theta), tuple(phi), tuple(ids)
         if initials is None:
             initials = []
         events = pbar(events, show=progress)
@@ -120,6 +131,154 @@ class EventDirectionReconstruction(object):
             theta, phi, ids = ((), (), ())
         return theta, phi, ids
 
+    def batch_reconstruct_events(self, events, detector_ids=None,
+                                 offsets=NO_OFFSET, progress=True):
+        """Reconstruct events using array operations
+
+        This gives the same results as :meth:`reconstruct_events` with the
+        :class:`DirectAlgorithmCartesian3D` and :class:`RegressionAlgorithm3D`
+        algorithms.  The arrival times of chunks of events are read as
+        columns, the events are grouped by the layout of the station which
+        was valid at the time, and all events in a chunk are reconstructed
+        at once.
+
+        :param events: the events table for the station from an ESD data
+            file, or a structured array with the same columns.
+        :param detector_ids: detectors to use for the reconstructions.
+        :param offsets: time offsets for each detector or a
+            :class:`~sapphire.api.Station` object.
+        :param progress: if True show a progress bar while reconstructing.
+        :return: array of theta, array of phi, and list of detector ids.
+
+        """
+        if detector_ids is None:
+            detector_ids = range(4)
+        detector_ids = list(detector_ids)
+        n_events = len(events)
+
+        theta = np.empty(n_events)
+        phi = np.empty(n_events)
+        valid = np.empty((n_events, len(detector_ids)), dtype=bool)
+        starts = range(0, n_events, CHUNK_SIZE)
+        for start in pbar(starts, show=progress):
+            stop = min(start + CHUNK_SIZE, n_events)
+            chunk = events[start:stop]
+            t, x, y, z, mask = self._event_columns(chunk, detector_ids,
+                                                   offsets)
+            theta[start:stop], phi[start:stop] = self._batch_reconstruct(
+                t, x, y, z, mask)
+            valid[start:stop] = mask
+
+        # Lists of detector ids for each combination of detections
+        codes = valid.dot(1 << np.arange(len(detector_ids)))
+        id_lists = {code: [id for i, id in enumerate(detector_ids)
+                           if code & (1 << i)]
+                    for code in np.unique(codes)}
+        ids = [list(id_lists[code]) for code in codes]
+        return theta, phi, ids
+
+    def _use_batch(self, events, initials):
+        """Check if the events can be reconstructed in batches
+
+        :param events: the events to reconstruct.
+        :param initials: the initials for the reconstructions.
+        :return: True if the events can be read as columns, no initials
+                 are given and the default algorithms are used.
+
+        """
+        return (not initials and
+                self.direct is DirectAlgorithmCartesian3D and
+                self.fit is RegressionAlgorithm3D and
+                getattr(getattr(events, 'dtype', None), 'names', None)
+                is not None)
+
+    def _event_columns(self, events, detector_ids, offsets):
+        """Get the arrival times and detector positions of events
+
+        :param events: structured array of events.
+        :param detector_ids: detectors to use for the reconstructions.
+        :param offsets: time offsets for each detector or a
+            :class:`~sapphire.api.Station` object.
+        :return: arrays of arrival times and x, y, z positions with shape
+                 (events, detectors) and a mask of valid arrival times.
+
+        """
+        timestamps = events['timestamp']
+        if isinstance(offsets, Station):
+            offset_table = offsets.detector_timing_offsets
+            idx = np.searchsorted(offset_table['timestamp'], timestamps,
+                                  side='right') - 1
+            idx = idx.clip(0)
+            t_offsets = np.column_stack([offset_table['offset%d' % (id + 1)]
+                                         [idx] for id in detector_ids])
+        else:
+            t_offsets = np.array([offsets[id] for id in detector_ids],
+                                 dtype=float)
+
+        t = np.column_stack([events['t%d' % (id + 1)]
+                             for id in detector_ids]).astype(float)
+        mask = ~np.isin(t, ERR)
+        t = np.where(mask, t - t_offsets, nan)
+        mask &= ~isnan(t)
+
+        x, y, z = np.zeros((3,) + t.shape)
+        layouts = self._layout_index(timestamps)
+        for layout in np.unique(layouts):
+            in_layout = layouts == layout
+            self.station.cluster.set_timestamp(
+                timestamps[in_layout.argmax()])
+            for i, id in enumerate(detector_ids):
+                coordinates = self.station.detectors[id].get_coordinates()
+                x[in_layout, i], y[in_layout, i], z[in_layout, i] = coordinates
+        return t, x, y, z, mask
+
+    def _layout_index(self, timestamps):
+        """Get the index of the station layout valid for each timestamp
+
+        :param timestamps: array of timestamps in seconds.
+        :return: index into the sorted timestamps at which the position of
+                 the station or one of its detectors changed.
+
+        """
+        changes = self.station.get_layout_timestamps()
+        return (np.searchsorted(changes, timestamps, side='right') -
+                1).clip(0)
+
+    def _batch_reconstruct(self, t, x, y, z, mask):
+        """Reconstruct the directions of events with valid arrival times
+
+        Events with three detections are reconstructed using the direct
+        algorithm, events with more detections using the fit.
+
+        :param t: arrival times with shape (events, detectors).
+        :param x,y,z: positions of the detectors, same shape as t.
+        :param mask: boolean array indicating valid arrival times.
+        :return: arrays of theta and phi.
+
+        """
+        theta = np.full(len(t), nan)
+        phi = np.full(len(t), nan)
+        n = mask.sum(axis=1)
+
+        three = n == 3
+        if three.any():
+            # Column indices of the detections, in order
+            cols = np.argsort(~mask[three], axis=1, kind='stable')[:, :3]
+            rows = np.arange(len(cols))[:, None]
+            dt, dx, dy, dz = [(v[three][rows, cols] -
+                               v[three][rows, cols[:, :1]])
+                              for v in (t, x, y, z)]
+            theta[three], phi[three] = self.direct.batch_reconstruct(
+                dt[:, 1], dt[:, 2], dx[:, 1], dx[:, 2], dy[:, 1], dy[:, 2],
+                dz[:, 1], dz[:, 2])
+
+        more = n > 3
+        if more.any():
+            theta[more], phi[more] = self.fit.batch_reconstruct(
+                t[more], x[more], y[more], z[more], mask[more])
+
+        return theta, phi
+
     def __repr__(self):
         return ("<%s, station: %r, direct: %r, fit: %r>" %
                 (self.__class__.__name__, self.station, self.direct, self.fit))
@@ -217,7 +376,14 @@ class CoincidenceDirectionReconstruction(object):
                          parameters.
         :return: list of theta, phi, and station numbers.
 
+        If no initials are given and the default algorithms are used, the
+        coincidences are reconstructed in chunks using
+        :meth:`batch_reconstruct_coincidences`.
+
         """
+        if self._use_batch(initials):
+            return self.batch_reconstruct_coincidences(
+                coincidences, station_numbers, offsets, progress)
         if offsets is None:
             offsets = {}
         if initials is None:
@@ -233,6 +399,143 @@ class CoincidenceDirectionReconstruction(object):
             theta, phi, nums = ((), (), ())
         return theta, phi, nums
 
+    def batch_reconstruct_coincidences(self, coincidences,
+                                       station_numbers=None, offsets=None,
+                                       progress=True):
+        """Reconstruct coincidences using array operations
+
+        This gives the same results as :meth:`reconstruct_coincidences`
+        with the :class:`DirectAlgorithmCartesian3D` and
+        :class:`RegressionAlgorithm3D` algorithms, without initials.  The
+        coincidences in a chunk are grouped by the participating stations
+        (in order) and the layout of the cluster at the time.  The
+        directions of all coincidences in a group are reconstructed at
+        once, using arrays of station arrival times.
+
+        :param coincidences: a list of coincidence events, each consisting
+                             of three or more (station_number, event) tuples.
+        :param station_numbers: list of station numbers, to only use
+                                events from those stations.
+        :param offsets: dictionary with detector offsets for each station.
+        :param progress: if True show a progress bar while reconstructing.
+        :return: array of theta, array of phi, and list of station numbers.
+
+        """
+        if offsets is None:
+            offsets = {}
+        changes = self.cluster.get_layout_timestamps()
+
+        theta = [np.array([])]
+        phi = [np.array([])]
+        nums = []
+        coincidences = iter(pbar(coincidences, show=progress))
+        while True:
+            chunk = list(islice(coincidences, CHUNK_SIZE))
+            if not chunk:
+                break
+            c_theta, c_phi, c_nums = self._batch_reconstruct(
+                chunk, station_numbers, offsets, changes)
+            theta.append(c_theta)
+            phi.append(c_phi)
+            nums.extend(c_nums)
+        return np.concatenate(theta), np.concatenate(phi), nums
+
+    def _use_batch(self, initials):
+        """Check if the coincidences can be reconstructed in batches
+
+        :param initials: the initials for the reconstructions.
+        :return: True if no initials are given and the default algorithms
+                 are used.
+
+        """
+        return (not initials and
+                self.direct is DirectAlgorithmCartesian3D and
+                self.fit is RegressionAlgorithm3D)
+
+    def _batch_reconstruct(self, coincidences, station_numbers, offsets,
+                           changes):
+        """Reconstruct a chunk of coincidences
+
+        :param coincidences: list of coincidence events.
+        :param station_numbers: list of station numbers, to only use
+                                events from those stations.
+        :param offsets: dictionary with detector offsets for each station.
+        :param changes: sorted timestamps at which the cluster layout
+                        changed.
+        :return: array of theta, array of phi, and list of station numbers.
+
+        """
+        theta = np.full(len(coincidences), nan)
+        phi = np.full(len(coincidences), nan)
+        nums = []
+
+        groups = {}
+        for i, coincidence_events in enumerate(coincidences):
+            if len(coincidence_events) < 3:
+                nums.append([])
+                continue
+            ts0 = int(coincidence_events[0][1]['timestamp'])
+            t, c_nums = self._station_arrival_times(
+                coincidence_events, station_numbers, offsets, ts0)
+            nums.append(c_nums)
+            if len(t) >= 3:
+                key = (tuple(c_nums), get_active_index(changes, ts0))
+                groups.setdefault(key, (ts0, [], []))
+                groups[key][1].append(i)
+                groups[key][2].append(t)
+
+        for (group_nums, _), (ts0, idx, t) in groups.items():
+            self.cluster.set_timestamp(ts0)
+            xyz = [self.cluster.get_station(number)
+                   .calc_center_of_mass_coordinates()
+                   for number in group_nums]
+            t = np.array(t)
+            x, y, z = [np.tile(v, (len(t), 1)) for v in zip(*xyz)]
+            if len(group_nums) == 3:
+                dt, dx, dy, dz = [v - v[:, :1] for v in (t, x, y, z)]
+                theta[idx], phi[idx] = self.direct.batch_reconstruct(
+                    dt[:, 1], dt[:, 2], dx[:, 1], dx[:, 2], dy[:, 1],
+                    dy[:, 2], dz[:, 1], dz[:, 2])
+            else:
+                mask = np.ones(t.shape, dtype=bool)
+                theta[idx], phi[idx] = self.fit.batch_reconstruct(
+                    t, x, y, z, mask)
+
+        return theta, phi, nums
+
+    def _station_arrival_times(self, coincidence_events, station_numbers,
+                               offsets, ts0):
+        """Get the station arrival times for a coincidence
+
+        :param coincidence_events: a coincidence list consisting of
+            (station_number, event) tuples.
+        :param station_numbers: list of station numbers, to only use
+            events from those stations.
+        :param offsets: dictionary with detector offsets for each station.
+        :param ts0: timestamp of the first event in the coincidence.
+        :return: list of arrival times relative to the first event, and
+                 the station numbers for the arrival times.
+
+        """
+        ets0 = ts0 * int(1e9)
+        t, nums = ([], [])
+
+        offsets = self.get_station_offsets(coincidence_events, station_numbers,
+                                           offsets, ts0)
+
+        for station_number, event in coincidence_events:
+            if station_numbers is not None:
+                if station_number not in station_numbers:
+                    continue
+            t_off = offsets.get(station_number, NO_OFFSET)
+            station = self.cluster.get_station(station_number)
+            t_first = station_arrival_time(event, ets0, offsets=t_off,
+                                           station=station)
+            if not isnan(t_first):
+                t.append(t_first)
+                nums.append(station_number)
+        return t, nums
+
     def get_station_offsets(self, coincidence_events, station_numbers,
                             offsets, ts0):
         if offsets and isinstance(next(itervalues(offsets)), Station):
@@ -349,6 +652,11 @@ class CoincidenceDirectionReconstructionDetectors(
 
     """
 
+    def _use_batch(self, initials):
+        """Detector arrival times are not reconstructed in batches"""
+
+        return False
+
     def reconstruct_coincidence(self, coincidence_events, station_numbers=None,
                                 offsets=None, initial=None):
         """Reconstruct a single coincidence
@@ -794,6 +1102,54 @@ class DirectAlgorithmCartesian3D(BaseDirectionAlgorithm):
 
         return theta, phi
 
+    @staticmethod
+    def batch_reconstruct(dt1, dt2, dx1, dx2, dy1, dy2, dz1, dz2):
+        """Reconstruct angles from 3 detections for many events
+
+        Array version of :meth:`reconstruct`.
+
+        :param dt#: arrays of arrival times in detector 1 and 2 relative to
+                    detector 0 in ns.
+        :param dx#,dy#,dz#: arrays of positions of detector 1 and 2 relative
+                            to detector 0 in m.
+        :return: arrays of theta and phi.
+
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ux = c * (dt2 * dx1 - dt1 * dx2)
+            uy = c * (dt2 * dy1 - dt1 * dy2)
+            uz = c * (dt2 * dz1 - dt1 * dz2)
+            vx = dy1 * dz2 - dz1 * dy2
+            vy = dz1 * dx2 - dx1 * dz2
+            vz = dx1 * dy2 - dy1 * dx2
+            uxvx = uy * vz - uz * vy
+            uxvy = uz * vx - ux * vz
+            uxvz = ux * vy - uy * vx
+
+            usquared = ux * ux + uy * uy + uz * uz
+            vsquared = vx * vx + vy * vy + vz * vz
+            underroot = vsquared - usquared
+
+            root = sqrt(np.where(underroot > 0, underroot, nan))
+            solutions = []
+            for sign in (1, -1):
+                nx = (uxvx + sign * vx * root) / vsquared
+                ny = (uxvy + sign * vy * root) / vsquared
+                nz = (uxvz + sign * vz * root) / vsquared
+                theta = arccos(nz)
+                theta[isnan(theta)] = pi
+                solutions.append((theta, arctan2(ny, nx)))
+        (thetaplus, phiplus), (thetamin, phimin) = solutions
+
+        # Allow solution only if it is the only one above horizon
+        valid = (underroot > 0) & (vsquared != 0)
+        use_plus = valid & (thetaplus <= pi / 2.) & (thetamin > pi / 2.)
+        use_min = valid & (thetaplus > pi / 2.) & (thetamin <= pi / 2.)
+        theta = np.select([use_plus, use_min], [thetaplus, thetamin], nan)
+        phi = np.select([use_plus, use_min], [phiplus, phimin], nan)
+
+        return theta, phi
+
 
 class SphereAlgorithm(object):
 
@@ -1090,6 +1446,67 @@ class RegressionAlgorithm(BaseDirectionAlgorithm):
 
         return theta, phi
 
+    @classmethod
+    def batch_reconstruct(cls, t, x, y, mask):
+        """Reconstruct angles for many events
+
+        Array version of :meth:`reconstruct`, each row contains the
+        detections of one event.
+
+        :param t: arrival times in the detectors in ns, with shape
+                  (events, detectors).
+        :param x,y: positions of the detectors in m, same shape as t.
+        :param mask: boolean array indicating which detections to use.
+        :return: arrays of theta and phi.
+
+        """
+        passed = batch_logic_checks(t, x, y, np.zeros_like(x), mask)
+
+        k = mask.sum(axis=1)
+        t = np.where(mask, t, 0.)
+        x = np.where(mask, x, 0.)
+        y = np.where(mask, y, 0.)
+
+        xs = np.zeros(len(t))
+        ys = np.zeros(len(t))
+        ts = np.zeros(len(t))
+        xx = np.zeros(len(t))
+        yy = np.zeros(len(t))
+        tx = np.zeros(len(t))
+        ty = np.zeros(len(t))
+        xy = np.zeros(len(t))
+
+        for ti, xi, yi in zip(t.T, x.T, y.T):
+            xs += xi
+            ys += yi
+            ts += ti
+            xx += xi ** 2
+            yy += yi ** 2
+            tx += ti * xi
+            ty += ti * yi
+            xy += xi * yi
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            denom = (k * xy ** 2 + xs ** 2 * yy + ys ** 2 * xx -
+                     k * xx * yy - 2 * xs * ys * xy)
+            denom[denom == 0] = nan
+
+            numer = (tx * (k * yy - ys ** 2) + xy * (ts * ys - k * ty) +
+                     xs * ys * ty - ts * xs * yy)
+            nx = c * numer / denom
+
+            numer = (ty * (k * xx - xs ** 2) + xy * (ts * xs - k * tx) +
+                     xs * ys * tx - ts * ys * xx)
+            ny = c * numer / denom
+
+            horiz = nx ** 2 + ny ** 2
+            invalid = ~passed | (horiz > 1.)
+            nz = sqrt(1 - nx ** 2 - ny ** 2)
+            phi = np.where(invalid, nan, arctan2(ny, nx))
+            theta = np.where(invalid, nan, arccos(nz))
+
+        return theta, phi
+
 
 class RegressionAlgorithm3D(BaseDirectionAlgorithm):
 
@@ -1156,6 +1573,48 @@ class RegressionAlgorithm3D(BaseDirectionAlgorithm):
 
         return theta, phi
 
+    @classmethod
+    def batch_reconstruct(cls, t, x, y, z, mask):
+        """Reconstruct angles for many events
+
+        Array version of :meth:`reconstruct`, each row contains the
+        detections of one event.  The iterations continue only for the
+        events which have not yet converged.
+
+        :param t: arrival times in the detectors in ns, with shape
+                  (events, detectors).
+        :param x,y,z: positions of the detectors in m, same shape as t.
+        :param mask: boolean array indicating which detections to use.
+        :return: arrays of theta and phi.
+
+        """
+        passed = batch_logic_checks(t, x, y, z, mask)
+
+        theta, phi = RegressionAlgorithm.batch_reconstruct(t, x, y, mask)
+        theta[~passed] = nan
+        phi[~passed] = nan
+
+        converging = ~isnan(theta)
+        for _ in range(cls.MAX_ITERATIONS):
+            idx = np.flatnonzero(converging)
+            if not len(idx):
+                break
+            with np.errstate(invalid='ignore', divide='ignore'):
+                nxnz = (tan(theta[idx]) * cos(phi[idx]))[:, None]
+                nynz = (tan(theta[idx]) * sin(phi[idx]))[:, None]
+                nz = cos(theta[idx])[:, None]
+                x_proj = x[idx] - z[idx] * nxnz
+                y_proj = y[idx] - z[idx] * nynz
+                t_proj = t[idx] + z[idx] / (c * nz)
+            theta_prev = theta[idx]
+            theta[idx], phi[idx] = RegressionAlgorithm.batch_reconstruct(
+                t_proj, x_proj, y_proj, mask[idx])
+            converging[idx] = abs(theta[idx] - theta_prev) > 0.001
+        theta[converging] = nan
+        phi[converging] = nan
+
+        return theta, phi
+
 
 class CurvedMixin(object):
 
@@ -1414,5 +1873,69 @@ def logic_checks(t, x, y, z):
     return True
 
 
+def batch_logic_checks(t, x, y, z, mask):
+    """Check for impossible reconstructions for many events
+
+    Array version of :func:`logic_checks`, each row contains the
+    detections of one event.
+
+    :param t: arrival times in the detectors in ns, with shape
+              (events, detectors).
+    :param x,y,z: positions of the detectors in m, same shape as t.
+    :param mask: boolean array indicating which detections to use.
+    :return: boolean array, True where the checks pass.
+
+    """
+    failed = np.zeros(len(t), dtype=bool)
+    three = mask.sum(axis=1) == 3
+    columns = range(t.shape[1])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Check for identical positions and if the time difference is
+        # larger than expected by c
+        for i, j in combinations(columns, 2):
+            pair = three & mask[:, i] & mask[:, j]
+            dt = abs(t[:, i] - t[:, j])
+            dx = x[:, i] - x[:, j]
+            dy = y[:, i] - y[:, j]
+            dz = z[:, i] - z[:, j]
+            identical = (dx == 0) & (dy == 0) & (dz == 0)
+            dt_max = vector_length(dx, dy, dz) / c
+            failed |= pair & (identical | (dt_max < dt))
+
+        # Check if all the positions are (almost) on a single line
+        largest_of_smallest_angles = np.zeros(len(t))
+        for i, j, k in combinations(columns, 3):
+            triple = mask[:, i] & mask[:, j] & mask[:, k]
+            dx1 = x[:, i] - x[:, j]
+            dy1 = y[:, i] - y[:, j]
+            dz1 = z[:, i] - z[:, j]
+            dx2 = x[:, i] - x[:, k]
+            dy2 = y[:, i] - y[:, k]
+            dz2 = z[:, i] - z[:, k]
+            dx3 = dx2 - dx1
+            dy3 = dy2 - dy1
+            dz3 = dz2 - dz1
+            lenvec01 = vector_length(dx1, dy1, dz1)
+            lenvec02 = vector_length(dx2, dy2, dz2)
+            lenvec12 = vector_length(dx3, dy3, dz3)
+
+            area = abs(dx1 * dy2 - dx2 * dy1 + dy1 * dz2 - dy2 * dz1 +
+                       dz1 * dx2 - dz2 * dx1)
+            failed |= triple & (area < 1e-7)
+
+            sin1 = area / lenvec01 / lenvec02
+            sin2 = area / lenvec01 / lenvec12
+            sin3 = area / lenvec02 / lenvec12
+            smallest_angle = np.minimum(np.minimum(sin1, sin2), sin3)
+            largest_of_smallest_angles = np.where(
+                triple, np.maximum(largest_of_smallest_angles, smallest_angle),
+                largest_of_smallest_angles)
+
+    failed |= largest_of_smallest_angles < 0.1
+
+    return ~failed
+
+
 def warning_only_three():
     warnings.warn('Only the first three detections will be used')
@@ -29,22 +29,25 @@
 """
 import zlib
 
-import operator
 import os
+import tempfile
 import warnings
+from bisect import bisect_left
 
 import tables
 import numpy as np
 from six.moves import range, zip
 
 from ..api import Station
-from ..utils import pbar, ERR
+from ..utils import pbar, get_process_pool, ActiveIndexCache, ERR
 from .find_mpv import FindMostProbableValueInSpectrum
 from .process_traces import (ADC_TIME_PER_SAMPLE, ADC_LOW_THRESHOLD,
                              ADC_HIGH_THRESHOLD)
 
 ADC_THRESHOLD = 20  #: Threshold for arrival times, relative to the baseline
 ADC_LIMIT = 2 ** 12
+#: Default number of events (rows) which are read and processed at once
+CHUNK_SIZE = 100000
 
 #: Default trigger for 2-detector station
 #: 2 low and no high, no external
@@ -88,7 +91,15 @@ class ProcessEvents(object):
         'n4': tables.Float32Col(pos=20, dflt=-1),
         't_trigger': tables.Float32Col(pos=21, dflt=-1)}
 
-    def __init__(self, data, group, source=None, progress=True):
+    workers = None
+    chunk_size = CHUNK_SIZE
+    #: Row of the source table from which the events are processed
+    first_event = 0
+    #: Whether results can be updated using ``incremental=True``
+    supports_incremental = True
+
+    def __init__(self, data, group, source=None, progress=True,
+                 workers=None):
         """Initialize the class.
 
         :param data: the PyTables datafile
@@ -98,16 +109,20 @@ class ProcessEvents(object):
             meaning the default name 'events'.
         :param progress: if True show a progressbar while copying and
                          processing events.
+        :param workers: number of worker processes used to process the
+            traces.  Default: None, meaning the traces are processed in
+            this process.
 
         """
         self.data = data
         self.group = data.get_node(group)
         self.source = self._get_source(source)
         self.progress = progress
+        self.workers = workers
         self.limit = None
 
     def process_and_store_results(self, destination=None, overwrite=False,
-                                  limit=None):
+                                  limit=None, incremental=False):
         """Process events and store the results.
 
         :param destination: name of the table where the results will be
@@ -115,10 +130,30 @@ class ProcessEvents(object):
         :param overwrite: if True, overwrite previously obtained results.
         :param limit: the maximum number of events that will be stored.
             The default, None, corresponds to no limit.
+        :param incremental: if True and results were stored previously,
+            only process the events which have since been appended to the
+            source table and append them to the results.  The number of
+            particles of these new events is determined using the
+            pulseintegrals of all events, those of previously processed
+            events are not updated.  If the new events can not simply be
+            appended all events are processed, overwriting the previous
+            results.  Events downloaded with
+            :func:`~sapphire.publicdb.download_data` after processing
+            are appended to the source table.  Not all classes support
+            this, see :attr:`supports_incremental`.
 
         """
+        if incremental and not self.supports_incremental:
+            raise RuntimeError("Incremental processing is not supported "
+                               "by %s." % self.__class__.__name__)
+
         self.limit = limit
 
+        if incremental:
+            if self._process_and_store_new_results(destination):
+                return
+            overwrite = True
+
         self._check_destination(destination, overwrite)
 
         self._clean_events_table()
@@ -126,8 +161,62 @@ class ProcessEvents(object):
         self._create_results_table()
         self._store_results_from_traces()
         self._store_number_of_particles()
+        self._store_last_processed_event()
         self._move_results_table_into_destination()
 
+    def _process_and_store_new_results(self, destination=None):
+        """Process events appended to the source and append the results
+
+        The id and ext_timestamp of the last processed event are stored
+        on the results table.  Events after that one are cleaned,
+        processed and appended to the results.
+
+        :param destination: name of the table containing the results.
+        :return: False if all events need to be processed instead.
+
+        """
+        self._check_destination(destination, overwrite=True)
+        if self.destination not in self.group:
+            # No previous results
+            return False
+        results = self.group._f_get_child(self.destination)
+        if results is self.source:
+            return False
+
+        try:
+            first_event = results.attrs.last_event_id + 1
+        except AttributeError:
+            warnings.warn('Unknown last processed event, processing all '
+                          'events.')
+            return False
+
+        if not self._source_matches_results(results):
+            warnings.warn('Source table does not match previous results, '
+                          'processing all events.')
+            return False
+
+        if not self._clean_new_events(first_event):
+            warnings.warn('New events are older than processed events, '
+                          'processing all events.')
+            return False
+
+        if first_event == len(self.source):
+            # No new events
+            return True
+
+        self.first_event = first_event
+        try:
+            self._create_results_table()
+            self._store_results_from_traces()
+            self._store_number_of_particles()
+            self._store_last_processed_event()
+            self._copy_rows(self._tmp_events, results)
+            self._tmp_events.attrs._f_copy(results)
+            self._tmp_events.remove()
+        finally:
+            self.first_event = 0
+        return True
+
     def get_traces_for_event(self, event):
         """Return the traces from an event.
 
@@ -135,12 +224,11 @@ class ProcessEvents(object):
         :return: the traces: an array of pulseheight values.
 
         """
-        traces = [list(self._get_trace(idx)) for idx in event['traces']
-                  if idx >= 0]
+        traces = self._get_traces([idx for idx in event['traces']
+                                   if idx >= 0])
 
         # Make traces follow NumPy conventions
-        traces = np.array(traces).T
-        return traces
+        return traces.T.astype(int)
 
     def get_traces_for_event_index(self, idx):
         """Return the traces from event #idx.
@@ -194,44 +282,216 @@ class ProcessEvents(object):
         Remove duplicate events and sort the table by ext_timestamp.
 
         """
-        events = self.source
+        new_events = self._sort_and_remove_duplicates(self.source,
+                                                      'ext_timestamp')
+        self.source = new_events
+        self._normalize_event_ids(new_events)
 
-        enumerated_timestamps = list(enumerate(events.col('ext_timestamp')))
-        enumerated_timestamps.sort(key=operator.itemgetter(1))
+    def _sort_and_remove_duplicates(self, table, colname):
+        """Sort a table by a column and remove rows with duplicate values
 
-        unique_sorted_ids = self._find_unique_row_ids(enumerated_timestamps)
+        If the table is already sorted and unique it is not rewritten.
+        Otherwise, the values are sorted in chunks which are stored in a
+        temporary file and then merged, so that only `chunk_size` values
+        need to be in memory at once.  Of rows with equal values only the
+        first row is kept.
 
-        new_events = self._replace_table_with_selected_rows(events,
-                                                            unique_sorted_ids)
-        self.source = new_events
-        self._normalize_event_ids(new_events)
+        :param table: the table to clean.
+        :param colname: name of the column to sort by.
+        :return: the cleaned table.
 
-    def _find_unique_row_ids(self, enumerated_timestamps):
-        """Find the unique row_ids from enumerated timestamps."""
+        """
+        column = table.cols._f_col(colname)
+        if self._is_sorted_and_unique(column):
+            return self._replace_table_with_selected_rows(table, None)
 
-        prev_timestamp = 0
-        unique_sorted_ids = []
-        for row_id, timestamp in enumerated_timestamps:
-            if timestamp != prev_timestamp:
-                # event is unique, so add it
-                unique_sorted_ids.append(row_id)
-            prev_timestamp = timestamp
+        fd, path = tempfile.mkstemp('.h5')
+        os.close(fd)
+        try:
+            with tables.open_file(path, 'w') as tmp:
+                row_ids = self._find_unique_sorted_row_ids(column, tmp)
+                return self._replace_table_with_selected_rows(table, row_ids)
+        finally:
+            os.remove(path)
+
+    def _is_sorted_and_unique(self, column):
+        """Check if the values in a column are strictly increasing
 
-        return unique_sorted_ids
+        :param column: table column to check, read in chunks.
+
+        """
+        previous = None
+        for start in range(0, len(column), self.chunk_size):
+            values = column[start:start + self.chunk_size]
+            if previous is not None and values[0] <= previous:
+                return False
+            if (values[1:] <= values[:-1]).any():
+                return False
+            previous = values[-1]
+        return True
+
+    def _find_unique_sorted_row_ids(self, column, tmp):
+        """Find the row ids of the unique values, sorted by value
+
+        For each value the first row with that value is selected.
+
+        :param column: table column whose values to sort.
+        :param tmp: temporary PyTables file in which sorted chunks are
+            stored if the column does not fit in a single chunk.
+        :return: array, or EArray in the temporary file, with the row ids.
+
+        """
+        if len(column) <= self.chunk_size:
+            values = column[:]
+            order = values.argsort(kind='mergesort')
+            return order[_is_first_of_equal(values[order])]
+
+        row_ids = tmp.create_earray(tmp.root, 'row_ids', tables.Int64Atom(),
+                                    (0,), expectedrows=len(column))
+        runs = self._store_sorted_runs(column, tmp)
+        for unique_row_ids in self._merge_unique_sorted_runs(runs):
+            row_ids.append(unique_row_ids)
+        row_ids.flush()
+        return row_ids
+
+    def _store_sorted_runs(self, column, tmp):
+        """Sort chunks of a column and store them in a temporary file
+
+        :param column: table column whose values to sort.
+        :param tmp: temporary PyTables file.
+        :return: list of tables with the value and row id, sorted by value.
+            Rows with equal values are sorted by row id.
+
+        """
+        dtype = np.dtype([('value', column.dtype), ('row_id', np.int64)])
+        runs = []
+        for start in range(0, len(column), self.chunk_size):
+            values = column[start:start + self.chunk_size]
+            order = values.argsort(kind='mergesort')
+            run = np.empty(len(values), dtype=dtype)
+            run['value'] = values[order]
+            run['row_id'] = order + start
+            table = tmp.create_table(tmp.root, 'run_%d' % len(runs), dtype,
+                                     expectedrows=len(run))
+            table.append(run)
+            table.flush()
+            runs.append(table)
+        return runs
+
+    def _merge_unique_sorted_runs(self, runs):
+        """Merge sorted runs, keeping only the first row of equal values
+
+        A block of each run is read.  All values up to the smallest last
+        value of blocks of runs which are not exhausted can be merged,
+        because the remaining values are larger.  The last unique value
+        is kept for the next blocks, since these may still contain rows
+        with that value.
+
+        :param runs: list of tables with sorted values and row ids.
+        :return: generator yielding arrays of row ids sorted by value.
+
+        """
+        block_size = max(self.chunk_size // len(runs), 1)
+        positions = [0] * len(runs)
+        last = np.empty(0, dtype=runs[0].dtype)
+
+        while True:
+            blocks = [run.read(position, position + block_size)
+                      for run, position in zip(runs, positions)]
+            limits = [block['value'][-1]
+                      for run, position, block in zip(runs, positions, blocks)
+                      if position + len(block) < len(run)]
+            merged = [last]
+            for i, block in enumerate(blocks):
+                if limits:
+                    block = block[:block['value'].searchsorted(min(limits),
+                                                               side='right')]
+                positions[i] += len(block)
+                merged.append(block)
+            merged = np.concatenate(merged)
+            if len(merged) == len(last):
+                break
+            merged = merged[np.lexsort((merged['row_id'], merged['value']))]
+            unique = merged[_is_first_of_equal(merged['value'])]
+            yield unique['row_id'][:-1]
+            last = unique[-1:]
+
+        yield last['row_id']
+
+    def _source_matches_results(self, results):
+        """Check if the results were obtained from the source events
+
+        :param results: table with previous results.
+        :return: True if the last processed event is in the source.
+
+        """
+        last_event_id = results.attrs.last_event_id
+        if last_event_id + 1 != len(results):
+            return False
+        elif last_event_id < 0:
+            return True
+        elif last_event_id >= len(self.source):
+            return False
+        ext_timestamp = self.source[last_event_id]['ext_timestamp']
+        return ext_timestamp == results.attrs.last_ext_timestamp
+
+    def _clean_new_events(self, first_event):
+        """Clean events appended to the (cleaned) events table
+
+        Remove duplicate events from the new events, and sort them by
+        ext_timestamp.  The event ids of new events are normalized.
+
+        :param first_event: row id of the first new event.
+        :return: False if new events are older than the last previous
+                 event, the events can then not simply be appended.
+
+        """
+        events = self.source
+        new_events = events.read(first_event)
+        if not len(new_events):
+            return True
+
+        new_events = new_events[new_events['ext_timestamp'].argsort(
+            kind='mergesort')]
+        ext_timestamps = new_events['ext_timestamp']
+        is_unique = _is_first_of_equal(ext_timestamps)
+
+        # Find new events that were already stored
+        first_new = bisect_left(events.cols.ext_timestamp, ext_timestamps[0],
+                                hi=first_event)
+        previous = events.read(first_new, first_event, field='ext_timestamp')
+        idx = previous.searchsorted(ext_timestamps)
+        is_stored = idx < len(previous)
+        stored_idx = idx[is_stored]
+        is_stored[is_stored] = (
+            previous[stored_idx] == ext_timestamps[is_stored])
+        new_events = new_events[is_unique & ~is_stored]
+
+        if len(new_events) and len(previous):
+            if new_events['ext_timestamp'][0] < previous[-1]:
+                return False
+
+        new_events['event_id'] = range(first_event,
+                                       first_event + len(new_events))
+        events.truncate(first_event)
+        events.append(new_events)
+        events.flush()
+        return True
 
     def _replace_table_with_selected_rows(self, table, row_ids):
         """Replace events table with selected rows.
 
         :param table: original table to be replaced.
         :param row_ids: row ids of the selected rows which should go in
-            the destination table.
+            the destination table.  If None, all rows are selected and
+            the table is kept as is.
 
         """
+        if row_ids is None:
+            return table
         tmptable = self.data.create_table(self.group, 't__events',
                                           description=table.description)
-        selected_rows = table.read_coordinates(row_ids)
-        tmptable.append(selected_rows)
-        tmptable.flush()
+        self._copy_rows(table, tmptable, row_ids)
         self.data.rename_node(tmptable, table.name, overwrite=True)
         return tmptable
 
@@ -246,8 +506,13 @@ class ProcessEvents(object):
         :param events: the events table to normalize.
 
         """
-        row_ids = list(range(len(events)))
-        events.modify_column(column=row_ids, colname='event_id')
+        for start in range(0, len(events), self.chunk_size):
+            stop = min(start + self.chunk_size, len(events))
+            row_ids = np.arange(start, stop)
+            event_ids = events.read(start, stop, field='event_id')
+            if (event_ids != row_ids).any():
+                events.modify_column(start, stop, column=row_ids,
+                                     colname='event_id')
 
     def _create_results_table(self):
         """Create results table containing the events."""
@@ -255,34 +520,109 @@ class ProcessEvents(object):
         self._tmp_events = self._create_empty_results_table()
         self._copy_events_into_table()
 
-    def _create_empty_results_table(self):
-        """Create empty results table with correct length."""
+    def _get_event_range(self):
+        """Get the range of rows of the source table to process
+
+        :return: start and stop row.
+
+        """
+        start = self.first_event
+        stop = len(self.source)
+        if self.limit is not None:
+            stop = min(stop, start + self.limit)
+        return start, stop
+
+    def _store_last_processed_event(self):
+        """Store the id and ext_timestamp of the last processed event
 
-        if self.limit:
-            length = self.limit
+        These are stored as attributes of the results table, to allow
+        processing newly added events later.
+
+        """
+        start, stop = self._get_event_range()
+        attrs = self._tmp_events.attrs
+        attrs.last_event_id = stop - 1
+        if stop:
+            attrs.last_ext_timestamp = self.source[stop - 1]['ext_timestamp']
         else:
-            length = len(self.source)
+            attrs.last_ext_timestamp = 0
+
+    def _create_empty_results_table(self):
+        """Create an empty results table
+
+        The table has no rows, the events are appended to it later.  The
+        number of events is passed as ``expectedrows`` to optimize the
+        table layout.
+
+        """
+
+        start, stop = self._get_event_range()
+        length = stop - start
 
         if '_t_events' in self.group:
             self.data.remove_node(self.group, '_t_events')
         table = self.data.create_table(self.group, '_t_events',
                                        self.processed_events_description,
                                        expectedrows=length)
-
-        for _ in range(length):
-            table.row.append()
-        table.flush()
-
         return table
 
     def _copy_events_into_table(self):
-        table = self._tmp_events
-        source = self.source
+        start, stop = self._get_event_range()
+        self._copy_rows(self.source, self._tmp_events, start=start,
+                        stop=stop)
 
-        for col in pbar(source.colnames, show=self.progress):
-            table.modify_column(stop=self.limit, colname=col,
-                                column=getattr(source.cols, col)[:self.limit])
-        table.flush()
+    def _copy_rows(self, source, destination, row_ids=None, start=0,
+                   stop=None):
+        """Append rows from a table to another table, in chunks
+
+        Blocks of at most `chunk_size` rows are read and appended.
+        Columns of the destination which are not in the source get their
+        default value.
+
+        :param source: table from which to copy the rows.
+        :param destination: table to which the rows are appended.
+        :param row_ids: ids of the rows which should be copied, in order.
+            The default, None, corresponds to all rows.
+        :param start,stop: the range of rows which will be copied, if
+            no row ids are given.
+
+        """
+        if row_ids is None:
+            if stop is None:
+                stop = len(source)
+        else:
+            start, stop = 0, len(row_ids)
+
+        chunk_starts = range(start, stop, self.chunk_size)
+        for chunk_start in pbar(chunk_starts, show=self.progress):
+            chunk_stop = min(chunk_start + self.chunk_size, stop)
+            if row_ids is None:
+                rows = source.read(chunk_start, chunk_stop)
+            else:
+                rows = source.read_coordinates(
+                    row_ids[chunk_start:chunk_stop])
+            if rows.dtype != destination.dtype:
+                rows = self._convert_rows(rows, destination)
+            destination.append(rows)
+        destination.flush()
+
+    @staticmethod
+    def _convert_rows(rows, table):
+        """Convert rows to the row format of a table
+
+        :param rows: array of rows.
+        :param table: table whose format to convert to.
+        :return: array of rows in the format of the table, columns which
+                 are not in rows are set to their default value.
+
+        """
+        converted = np.empty(len(rows), dtype=table.dtype)
+        for name in table.colnames:
+            if name in rows.dtype.names:
+                converted[name] = rows[name]
+            else:
+                converted[name] = table.coldflts[name]
+        return converted
 
     def _store_results_from_traces(self):
         table = self._tmp_events
@@ -298,13 +638,13 @@ class ProcessEvents(object):
     def process_traces(self):
         """Process traces to yield pulse timing information."""
 
-        if self.limit is not None:
-            events = self.source.iterrows(stop=self.limit)
-        else:
-            events = self.source
+        start, stop = self._get_event_range()
+        if self.workers:
+            return self._process_traces_in_pool(np.arange(start, stop))
 
+        events = self.source.iterrows(start, stop)
         timings = self._process_traces_from_event_list(events,
-                                                       length=self.limit)
+                                                       length=stop - start)
         return timings
 
     def _process_traces_from_event_list(self, events, length=None):
@@ -325,6 +665,42 @@ class ProcessEvents(object):
 
         return timings
 
+    def _process_traces_in_pool(self, indexes):
+        """Process traces of events using a pool of worker processes
+
+        The events are split into chunks, four per worker.  Each worker
+        opens the datafile read-only and processes a chunk of events, the
+        results are combined in the original order.
+
+        :param indexes: indexes of the events to process.
+        :return: array with the results for each event.
+
+        """
+        self.data.flush()
+        attributes = {key: value for key, value in vars(self).items()
+                      if not isinstance(value, (tables.Node, tables.File))}
+        # The indexes of each chunk are passed separately
+        attributes.pop('indexes', None)
+        chunks = [chunk
+                  for chunk in np.array_split(indexes, 4 * self.workers)
+                  if len(chunk)]
+        tasks = [(self.__class__, self.data.filename, self.group._v_pathname,
+                  self.source._v_pathname, attributes, chunk)
+                 for chunk in chunks]
+
+        pool = get_process_pool(self.workers)
+        try:
+            results = pool.imap(_process_traces_in_file, tasks)
+            timings = list(pbar(results, length=len(chunks),
+                                show=self.progress))
+        finally:
+            pool.close()
+            pool.join()
+
+        if not timings:
+            return np.array([])
+        return np.concatenate(timings)
+
     def _reconstruct_time_from_traces(self, event):
         """Reconstruct arrival times for a single event.
 
@@ -359,20 +735,47 @@ class ProcessEvents(object):
         Decompress a trace from the blobs array.
 
         :param idx: index into the blobs array
-        :return: iterator over the pulseheight values
+        :return: array of the pulseheight values
 
         """
         blobs = self._get_blobs()
+        return self._decode_trace(blobs[idx])
+
+    def _get_traces(self, idxs, out=None):
+        """Returns multiple traces given indexes into the blobs array.
+
+        :param idxs: indexes into the blobs array.
+        :param out: optional preallocated array in which to store the
+            traces, with a row for each trace.  It must be long enough to
+            contain the longest trace.  It is cleared before use.
+        :return: 2D array with a row of pulseheight values for each
+            trace, shorter traces are padded with zeros.
+
+        """
+        blobs = self._get_blobs()
+        traces = [self._decode_trace(blobs[idx]) for idx in idxs]
+        if out is None:
+            length = max([len(trace) for trace in traces] or [0])
+            out = np.zeros((len(traces), length), dtype=np.int16)
+        else:
+            out[...] = 0
+        for row, trace in zip(out, traces):
+            row[:len(trace)] = trace
+        return out
+
+    @staticmethod
+    def _decode_trace(blob):
+        """Decompress and parse a trace blob
 
+        :param blob: compressed comma separated pulseheight values.
+        :return: array of the pulseheight values.
+
+        """
         try:
-            trace = zlib.decompress(blobs[idx]).decode('utf-8').split(',')
+            trace = zlib.decompress(blob)
         except zlib.error:
-            trace = (zlib.decompress(blobs[idx][1:-1])
-                     .decode('utf-8').split(','))
-        if trace[-1] == '':
-            del trace[-1]
-        trace = (int(x) for x in trace)
-        return trace
+            trace = zlib.decompress(blob[1:-1])
+        return np.fromstring(trace, dtype=np.int16, sep=',')
 
     def _get_blobs(self):
         return self.group.blobs
@@ -404,7 +807,12 @@ class ProcessEvents(object):
                  threshold.
 
         """
-        return next((i for i, x in enumerate(trace) if x >= threshold), -999)
+        if not hasattr(trace, '__len__'):
+            trace = list(trace)
+        above = np.asarray(trace) >= threshold
+        if not above.any():
+            return -999
+        return int(above.argmax())
 
     def _store_number_of_particles(self):
         """Store number of particles in the detectors.
@@ -415,49 +823,70 @@ class ProcessEvents(object):
         """
         table = self._tmp_events
 
-        n_particles = self._process_pulseintegrals()
-        for idx in range(4):
-            col = 'n%d' % (idx + 1)
-            table.modify_column(column=n_particles[:, idx], colname=col)
+        all_mpv = self._find_pulseintegral_mpvs()
+        first, last = self._get_event_range()
+        for start in range(first, last, self.chunk_size):
+            stop = min(start + self.chunk_size, last)
+            integrals = self.source.read(start, stop, field='integrals')
+            n_particles = self._normalize_pulseintegrals(integrals, all_mpv)
+            for idx in range(4):
+                col = 'n%d' % (idx + 1)
+                table.modify_column(start - first, stop - first,
+                                    colname=col, column=n_particles[:, idx])
         table.flush()
 
-    def _process_pulseintegrals(self):
-        """Find MPVs using pulseintegrals to estimate number of particles
+    def _find_pulseintegral_mpvs(self):
+        """Find the MPV of the pulseintegrals for each detector
 
-        :return: array with estimated number of particles per detector per
-                 event.
+        The histograms of the pulseintegrals are built from chunks of
+        events.
+
+        :return: array with the MPV for each detector, nan if the fit
+                 failed or there are no pulseintegrals.
 
         """
-        n_particles = []
+        bins = np.linspace(0, 50000, 201)
+        histograms = np.zeros((4, len(bins) - 1), dtype=np.int64)
+        has_integrals = np.zeros(4, dtype=bool)
+        for start in range(0, len(self.source), self.chunk_size):
+            integrals = self.source.read(start, start + self.chunk_size,
+                                         field='integrals')
+            has_integrals |= (integrals >= 0).any(axis=0)
+            for idx, detector_integrals in enumerate(integrals.T):
+                histograms[idx] += np.histogram(detector_integrals,
+                                                bins=bins)[0]
 
-        integrals = self.source.col('integrals')
         all_mpv = []
-        for detector_integrals in integrals.T:
-            if (detector_integrals < 0).all():
+        for n, detector_has_integrals in zip(histograms, has_integrals):
+            if not detector_has_integrals:
                 all_mpv.append(np.nan)
             else:
-                n, bins = np.histogram(detector_integrals,
-                                       bins=np.linspace(0, 50000, 201))
                 find_mpv = FindMostProbableValueInSpectrum(n, bins)
                 mpv, is_fitted = find_mpv.find_mpv()
                 if is_fitted:
                     all_mpv.append(mpv)
                 else:
                     all_mpv.append(np.nan)
-        all_mpv = np.array(all_mpv)
+        return np.array(all_mpv)
 
-        for event in self.source[:self.limit]:
-            pulseintegrals = event['integrals']
-            # retain -1, -999 status flags
-            pulseintegrals = np.where(pulseintegrals >= 0,
-                                      pulseintegrals / all_mpv,
-                                      pulseintegrals)
-            # if mpv fit failed, value is nan.  Make it -999
-            pulseintegrals = np.where(np.isnan(pulseintegrals), -999,
-                                      pulseintegrals)
-            n_particles.append(pulseintegrals)
+    @staticmethod
+    def _normalize_pulseintegrals(integrals, all_mpv):
+        """Estimate the number of particles from pulseintegrals
 
-        return np.array(n_particles)
+        :param integrals: array with pulseintegrals for each detector for
+                          each event.
+        :param all_mpv: MPV of the pulseintegrals for each detector.
+        :return: array with estimated number of particles per detector per
+                 event.
+
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # retain -1, -999 status flags
+            n_particles = np.where(integrals >= 0, integrals / all_mpv,
+                                   integrals)
+        # if mpv fit failed, value is nan.  Make it -999
+        n_particles[np.isnan(n_particles)] = -999
+        return n_particles
 
     def _move_results_table_into_destination(self):
         if self.source.name == 'events':
@@ -488,7 +917,10 @@ class ProcessIndexedEvents(ProcessEvents):
 
     """
 
-    def __init__(self, data, group, indexes, source=None, progress=True):
+    supports_incremental = False
+
+    def __init__(self, data, group, indexes, source=None, progress=True,
+                 workers=None):
         """Initialize the class.
 
         :param data: the PyTables datafile
@@ -499,10 +931,13 @@ class ProcessIndexedEvents(ProcessEvents):
             meaning the default name 'events'.
         :param progress: if True show a progressbar while copying and
                          processing events.
+        :param workers: number of worker processes used to process the
+            traces.  Default: None, meaning the traces are processed in
+            this process.
 
         """
         super(ProcessIndexedEvents, self).__init__(data, group, source,
-                                                   progress)
+                                                   progress, workers)
         self.indexes = indexes
 
     def _store_results_from_traces(self):
@@ -526,6 +961,9 @@ class ProcessIndexedEvents(ProcessEvents):
         This method makes use of the indexes to build a list of events.
 
         """
+        if self.workers:
+            return self._process_traces_in_pool(self.indexes)
+
         events = self.source.itersequence(self.indexes)
         length = len(self.indexes)
         timings = self._process_traces_from_event_list(events, length=length)
@@ -557,7 +995,7 @@ class ProcessEventsWithLINT(ProcessEvents):
 
         """
         threshold = baseline + ADC_THRESHOLD
-        trace = list(trace)
+        trace = np.asarray(trace, dtype=int)
         i = self.first_above_threshold(trace, threshold)
 
         if i == 0:
@@ -632,7 +1070,11 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
 
     """
 
-    def __init__(self, data, group, source=None, progress=True, station=None):
+    _trigger_index = None
+    _trigger_settings_idx = None
+
+    def __init__(self, data, group, source=None, progress=True, station=None,
+                 workers=None):
         """Initialize the class.
 
         :param data: the PyTables datafile
@@ -643,10 +1085,14 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
         :param progress: if True show a progressbar while copying and
                          processing events.
         :param station: station number of station to which the data belongs.
+        :param workers: number of worker processes used to process the
+            traces.  Default: None, meaning the traces are processed in
+            this process.
 
         """
         super(ProcessEventsWithTriggerOffset, self).__init__(data, group,
-                                                             source, progress)
+                                                             source, progress,
+                                                             workers)
         if station is None:
             self.station = None
             self.thresholds = [(ADC_LOW_THRESHOLD, ADC_HIGH_THRESHOLD)] * 4
@@ -683,14 +1129,7 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
 
         """
         if self.station is not None:
-            timestamp = event['timestamp']
-            try:
-                self.thresholds, self.trigger = self.station.trigger(timestamp)
-            except Exception:
-                warnings.warn('Unknown trigger settings, not reconstructing '
-                              'trigger offset.')
-                # Do not reconstruct t_trigger by pretending external trigger.
-                self.trigger = [0, 0, 0, 1]
+            self._update_trigger_settings(event['timestamp'])
 
         n_low, n_high, and_or, external = self.trigger
 
@@ -746,15 +1185,39 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
                    for time in timings]
         return timings
 
+    def _update_trigger_settings(self, timestamp):
+        """Get the trigger settings of the station valid for the timestamp
+
+        The settings are only looked up when the timestamp is outside of
+        the period for which the current settings are valid.
+
+        :param timestamp: timestamp of the event.
+
+        """
+        try:
+            if self._trigger_index is None:
+                self._trigger_index = ActiveIndexCache(
+                    self.station.triggers['timestamp'])
+            idx = self._trigger_index(timestamp)
+            if idx != self._trigger_settings_idx:
+                self.thresholds, self.trigger = self.station.trigger(
+                    timestamp)
+                self._trigger_settings_idx = idx
+        except Exception:
+            warnings.warn('Unknown trigger settings, not reconstructing '
+                          'trigger offset.')
+            # Do not reconstruct t_trigger by pretending external trigger.
+            self.trigger = [0, 0, 0, 1]
+            self._trigger_settings_idx = None
+
     @classmethod
     def _first_above_thresholds(cls, trace, thresholds, max_signal):
         """Check for multiple thresholds when the traces crosses it
 
-        First the thresholds are sorted to make sure they are looked for
-        in the correct order, because the trace is a generator you can
-        not go back. The results will match the original order.
+        The crossings of all thresholds are determined at once.
+        Thresholds above the expected max signal are skipped.
 
-        :param trace: generator over the trace.
+        :param trace: the trace, an array or iterable.
         :param thresholds: list of three thresholds.
         :param max_signal: expected max value in trace, based on
                            baseline and pulseheight.
@@ -763,20 +1226,19 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
 
         """
         results = [-999, -999, -999]
-        ordered_thresholds = sorted([(x, i) for i, x in enumerate(thresholds)])
-        last_value = None
-        t = 0
-
-        for threshold, i in ordered_thresholds:
-            if max_signal < threshold:
-                break
-            elif last_value is not None and last_value >= threshold:
-                results[i] = t
-            else:
-                if last_value is not None:
-                    t += 1
-                t, last_value = cls._first_value_above_threshold(trace,
-                                                                 threshold, t)
+        if not hasattr(trace, '__len__'):
+            trace = list(trace)
+        trace = np.asarray(trace)
+        thresholds = np.asarray(thresholds)
+        if not len(trace):
+            return results
+
+        above = trace[:, np.newaxis] >= thresholds
+        first = above.argmax(axis=0)
+        found = above.any(axis=0) & (thresholds <= max_signal)
+        for i, (t, is_found) in enumerate(zip(first.tolist(),
+                                              found.tolist())):
+            if is_found:
                 results[i] = t
         return results
 
@@ -791,8 +1253,11 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
                  threshold, and the value.
 
         """
-        return next(((i, x) for i, x in enumerate(trace, t) if x >= threshold),
-                    (-999, 0))
+        trace = np.asarray(trace)
+        i = ProcessEvents.first_above_threshold(trace, threshold)
+        if i == -999:
+            return -999, 0
+        return i + t, trace[i]
 
     def _reconstruct_trigger(self, low_idx, high_idx):
         """Reconstruct the moment of trigger from the threshold info
@@ -854,6 +1319,41 @@ class ProcessEventsWithTriggerOffset(ProcessEvents):
                      self.progress, self.station.number))
 
 
+def _is_first_of_equal(values):
+    """Find the first of each run of equal values
+
+    :param values: sorted array of values.
+    :return: boolean array, True for the first of equal values.
+
+    """
+    is_first = np.ones(len(values), dtype=bool)
+    is_first[1:] = values[1:] != values[:-1]
+    return is_first
+
+
+def _process_traces_in_file(task):
+    """Process traces of a chunk of events, reading from a file
+
+    This opens the file read-only, to be used in a worker process.
+
+    :param task: tuple of the class used to process the events, the path
+        to the data file, the paths to the group and the events table, the
+        other attributes of the instance, and the indexes of the events.
+    :return: array with the results for each event.
+
+    """
+    cls, filename, group, source, attributes, indexes = task
+    with tables.open_file(filename, 'r') as data:
+        process = cls.__new__(cls)
+        process.__dict__.update(attributes)
+        process.data = data
+        process.group = data.get_node(group)
+        process.source = data.get_node(source)
+        process.progress = False
+        events = process.source.itersequence(indexes)
+        return process._process_traces_from_event_list(events)
+
+
 class ProcessEventsFromSource(ProcessEvents):
 
     """Process HiSPARC events from a different source.
@@ -865,6 +1365,8 @@ class ProcessEventsFromSource(ProcessEvents):
 
     """
 
+    supports_incremental = False
+
     def __init__(self, source_file, dest_file, source_group, dest_group,
                  progress=False):
         """Initialize the class.
@@ -923,27 +1425,24 @@ class ProcessEventsFromSource(ProcessEvents):
         """
         new_events = self.dest_file.create_table(self.dest_group, '_events',
                                                  description=table.description)
-        selected_rows = table.read_coordinates(row_ids)
-        new_events.append(selected_rows)
-        new_events.flush()
+        self._copy_rows(table, new_events, row_ids)
         return new_events
 
     def _create_empty_results_table(self):
-        """Create empty results table with correct length."""
+        """Create an empty results table
 
-        if self.limit:
-            length = self.limit
-        else:
-            length = len(self.source)
+        The table has no rows, the events are appended to it later.  The
+        number of events is passed as ``expectedrows`` to optimize the
+        table layout.
+
+        """
+
+        start, stop = self._get_event_range()
+        length = stop - start
 
         table = self.dest_file.create_table(self.dest_group, 'events',
                                             self.processed_events_description,
                                             expectedrows=length)
-
-        for _ in range(length):
-            table.row.append()
-        table.flush()
-
         return table
 
     def _move_results_table_into_destination(self):
@@ -1096,15 +1595,7 @@ class ProcessDataTable(ProcessEvents):
         Remove duplicate events and sort the table by timestamp.
 
         """
-        data = self.source
-
-        enumerated_timestamps = list(enumerate(data.col('timestamp')))
-        enumerated_timestamps.sort(key=operator.itemgetter(1))
-
-        unique_sorted_ids = self._find_unique_row_ids(enumerated_timestamps)
-
-        new_data = self._replace_table_with_selected_rows(data,
-                                                          unique_sorted_ids)
+        new_data = self._sort_and_remove_duplicates(self.source, 'timestamp')
         self.source = new_data
         self._normalize_event_ids(new_data)
 
@@ -1113,15 +1604,15 @@ class ProcessDataTable(ProcessEvents):
 
         :param table: original table to be replaced.
         :param row_ids: row ids of the selected rows which should go in
-            the destination table.
+            the destination table.  If None, all rows are selected.
 
         """
+        if row_ids is None and table.name == self.destination:
+            return table
         tmptable = self.data.create_table(self.group,
                                           '_t_%s' % self.table_name,
                                           description=table.description)
-        selected_rows = table.read_coordinates(row_ids)
-        tmptable.append(selected_rows)
-        tmptable.flush()
+        self._copy_rows(table, tmptable, row_ids)
         self.data.rename_node(tmptable, self.destination, overwrite=True)
         return tmptable
 
@@ -1137,6 +1628,8 @@ class ProcessDataTableFromSource(ProcessDataTable):
 
     """
 
+    supports_incremental = False
+
     def __init__(self, source_file, dest_file, source_group, dest_group,
                  progress=False):
         """Initialize the class.
@@ -1182,9 +1675,7 @@ class ProcessDataTableFromSource(ProcessDataTable):
         new_table = self.dest_file.create_table(self.dest_group,
                                                 self.table_name,
                                                 description=table.description)
-        selected_rows = table.read_coordinates(row_ids)
-        new_table.append(selected_rows)
-        new_table.flush()
+        self._copy_rows(table, new_table, row_ids)
         return new_table
 
     def __repr__(self):
@@ -6,9 +6,13 @@
     The :class:`MeanFilter` is meant to mimic the filter in the HiSPARC DAQ.
     It is reproduced here to make it easy to read the algorithm.
 
+    The :class:`BatchTraceObservables` determines the same observables as
+    :class:`TraceObservables`, but for the traces of many events at once.
+
 """
 from six.moves import range
-from numpy import around, convolve, ones, where
+import numpy as np
+from numpy import around, ones, where
 from lazy import lazy
 
 
@@ -170,6 +174,161 @@ class TraceObservables(object):
         return n_peaks + self.missing
 
 
+class BatchTraceObservables(object):
+
+    """Reconstruct trace observables for many events at once
+
+    This gives the same results as :class:`TraceObservables`, but for an
+    array containing the traces of multiple events.  The observables are
+    returned as arrays with a row for each event.  Each row contains at
+    least 4 elements, if there are less than 4 traces the row is padded
+    with the code for missing detectors: -1.
+
+    The same caveats as for :class:`TraceObservables` apply.
+
+    """
+
+    def __init__(self, traces, threshold=ADC_BASELINE_THRESHOLD,
+                 padding=DATA_REDUCTION_PADDING):
+        """Initialize the class
+
+        :param traces: a NumPy array of traces with shape (events, samples,
+                       detectors), so ``traces[i]`` contains the traces of
+                       one event as used by :class:`TraceObservables`.
+        :param threshold: value of the threshold to use, in ADC counts.
+        :param padding: number of samples which should be usuable to determine
+                        the baseline.
+
+        """
+        self.traces = traces
+        self.threshold = threshold
+        self.padding = padding
+        self.n = self.traces.shape[2]
+        if self.n not in [2, 4]:
+            raise Exception('Unsupported number of detectors')
+
+    def _add_missing(self, values):
+        """Pad the observables with -1 for missing detectors
+
+        :param values: array of observables with shape (events, detectors).
+        :return: array with at least 4 columns.
+
+        """
+        missing = -ones((len(values), 4 - self.n), dtype=values.dtype)
+        return np.hstack([values, missing])
+
+    @lazy
+    def _baselines(self):
+        """Baselines of the existing detectors, as int64"""
+
+        return around(self.traces[:, :self.padding].mean(axis=1)).astype(
+            'int64')
+
+    @lazy
+    def _signals(self):
+        """Traces relative to the baselines, as int64"""
+
+        return self.traces - self._baselines[:, np.newaxis, :]
+
+    @lazy
+    def baselines(self):
+        """Mean value of the first part of the traces
+
+        See :attr:`TraceObservables.baselines`.
+
+        :return: the baselines in ADC count.
+
+        """
+        return self._add_missing(self._baselines)
+
+    @lazy
+    def std_dev(self):
+        """Standard deviation of the first part of the traces
+
+        :return: the standard deviations in milli ADC count.
+
+        """
+        std_dev = around(self.traces[:, :self.padding].std(axis=1) * 1000)
+        return self._add_missing(std_dev.astype('int64'))
+
+    @lazy
+    def pulseheights(self):
+        """Maximum peak to baseline value in the traces
+
+        :return: the pulseheights in ADC count.
+
+        """
+        return self._add_missing(self._signals.max(axis=1))
+
+    @lazy
+    def integrals(self):
+        """Integrals of the traces for all values over threshold
+
+        :return: the pulse integrals in ADC count * sample.
+
+        """
+        signals = self._signals
+        integrals = where(signals > self.threshold, signals, 0).sum(axis=1)
+        return self._add_missing(integrals)
+
+    @lazy
+    def n_peaks(self):
+        """Number of peaks in the traces
+
+        See :attr:`TraceObservables.n_peaks`, the same hysteresis is
+        applied to all traces simultaneously.
+
+        :return: the number of peaks.
+
+        """
+        low_baselines = (self._baselines < 100).all(axis=1)
+        peak_thresholds = where(low_baselines, ADC_LOW_THRESHOLD_III - 30,
+                                ADC_LOW_THRESHOLD - 200)
+
+        # All traces side by side, with the samples along the first axis
+        n_samples = self.traces.shape[1]
+        signals = self._signals.transpose(1, 0, 2).reshape(n_samples, -1)
+        peak_thresholds = peak_thresholds.repeat(self.n)
+        n_peaks = self._count_peaks(signals, peak_thresholds)
+        return self._add_missing(n_peaks.reshape(-1, self.n))
+
+    @staticmethod
+    def _count_peaks(signals, peak_thresholds):
+        """Count the peaks in traces
+
+        This is the state machine of :attr:`TraceObservables.n_peaks`,
+        the samples are processed one at a time but for all traces at once.
+
+        :param signals: array of traces relative to the baseline, ordered
+                        such that the first element is the first sample of
+                        each trace.
+        :param peak_thresholds: peak threshold for each trace.
+        :return: number of peaks in each trace.
+
+        """
+        n_traces = signals.shape[1]
+        n_peaks = np.zeros(n_traces, dtype='int64')
+        in_peak = np.zeros(n_traces, dtype=bool)
+        local_minimum = np.zeros(n_traces, dtype='int64')
+        local_maximum = np.zeros(n_traces, dtype='int64')
+
+        for values in signals:
+            # enough signal over local minimum to be in a peak
+            peak_start = ~in_peak & (values - local_minimum > peak_thresholds)
+            # enough signal decrease to be out of peak
+            peak_end = in_peak & (local_maximum - values > peak_thresholds)
+
+            new_minimum = (~in_peak & (values < local_minimum)) | peak_end
+            local_minimum[new_minimum] = values[new_minimum].clip(0)
+            new_maximum = (in_peak & (values > local_maximum)) | peak_start
+            local_maximum[new_maximum] = values[new_maximum]
+
+            n_peaks += peak_start
+            in_peak ^= peak_start | peak_end
+
+        return n_peaks
+
+
 class MeanFilter(object):
 
     """Filter raw traces
@@ -197,9 +356,11 @@ class MeanFilter(object):
         """
         if use_threshold:
             self.filter = self.mean_filter_with_threshold
+            self.array_filter = self._mean_filter_with_threshold
             self.threshold = threshold
         else:
             self.filter = self.mean_filter_without_threshold
+            self.array_filter = self._mean_filter_without_threshold
 
     def filter_traces(self, raw_traces):
         """Apply the mean filter to multiple traces
@@ -232,55 +393,111 @@ class MeanFilter(object):
         filtered_trace = self.filter(recombined_trace)
         return filtered_trace
 
-    def mean_filter_with_threshold(self, trace):
-        """The mean filter in case use_threshold is True"""
+    def batch_filter_traces(self, raw_traces):
+        """Apply the mean filter to an array of traces
 
-        moving_average = convolve(trace, ones(4) / 4)
-        rounded_average = around(moving_average).astype(int)
+        This gives the same result as :meth:`filter_trace` for each trace,
+        but filters all traces at once.
 
-        filtered_trace = []
-        local_mean = moving_average[3]
-        local_mean_rounded = rounded_average[3]
+        :param raw_traces: array of raw traces of equal length, with the
+                           samples along the last axis.  The traces should
+                           contain at least 8 samples.
+        :return: array of filtered traces.  If the traces have an odd
+                 number of samples the last sample is dropped, like
+                 :meth:`filter_trace` does.
 
-        if all([abs(v - local_mean) <= self.threshold for v in trace[:4]]):
-            filtered_trace.extend([local_mean_rounded] * 4)
-        else:
-            filtered_trace.extend(trace[:4])
-
-        for i in range(4, len(trace)):
-            local_mean = moving_average[i]
-            if abs(trace[i] - trace[i - 1]) > 2 * self.threshold:
-                filtered_trace.append(trace[i])
-            elif (trace[i] > local_mean) == (trace[i - 1] > local_mean):
-                # Both values on same side of the local_mean
-                filtered_trace.append(trace[i])
-            elif abs(trace[i] - local_mean) > self.threshold:
-                filtered_trace.append(trace[i])
-            else:
-                filtered_trace.append(rounded_average[i])
+        """
+        raw_traces = np.asarray(raw_traces)
+        length = raw_traces.shape[-1] // 2 * 2
 
-        return filtered_trace
+        filtered_even = self.array_filter(raw_traces[..., :length:2])
+        filtered_odd = self.array_filter(raw_traces[..., 1:length:2])
+
+        recombined_traces = np.empty(filtered_even.shape[:-1] + (length,),
+                                     dtype=filtered_even.dtype)
+        recombined_traces[..., ::2] = filtered_even
+        recombined_traces[..., 1::2] = filtered_odd
+        return self.array_filter(recombined_traces)
+
+    def mean_filter_with_threshold(self, trace):
+        """The mean filter in case use_threshold is True"""
+
+        return self._mean_filter_with_threshold(np.asarray(trace)).tolist()
 
     def mean_filter_without_threshold(self, trace):
         """The mean filter in case use_threshold is False"""
 
-        moving_average = convolve(trace, ones(4) / 4)
-        rounded_average = around(moving_average).astype(int)
+        return self._mean_filter_without_threshold(np.asarray(trace)).tolist()
 
-        local_mean = moving_average[3]
-        local_mean_rounded = rounded_average[3]
+    def _mean_filter_with_threshold(self, traces):
+        """The mean filter in case use_threshold is True, for arrays
 
-        filtered_trace = [local_mean_rounded] * 4
+        :param traces: array of traces with the samples along the last axis,
+                       with at least 4 samples.
+        :return: array of filtered traces.
 
-        for i in range(4, len(trace)):
-            local_mean = moving_average[i]
-            if (trace[i] > local_mean) == (trace[i - 1] > local_mean):
-                # Both values on same side of the local_mean
-                filtered_trace.append(trace[i])
-            else:
-                filtered_trace.append(rounded_average[i])
+        """
+        moving_average, rounded_average = self._moving_average(traces)
+
+        # The first 4 values are replaced by the first full local mean
+        local_mean = moving_average[..., :1]
+        first = traces[..., :4]
+        is_small = (abs(first - local_mean) <= self.threshold).all(axis=-1)
+        filtered_traces = np.empty(traces.shape, dtype=rounded_average.dtype)
+        filtered_traces[..., :4] = where(is_small[..., np.newaxis],
+                                         rounded_average[..., :1], first)
+
+        current = traces[..., 4:]
+        previous = traces[..., 3:-1]
+        local_mean = moving_average[..., 1:]
+        # Large jump between values
+        keep = abs(current - previous) > 2 * self.threshold
+        # Both values on same side of the local_mean
+        keep |= (current > local_mean) == (previous > local_mean)
+        # Value far from the local mean
+        keep |= abs(current - local_mean) > self.threshold
+        filtered_traces[..., 4:] = where(keep, current,
+                                         rounded_average[..., 1:])
+
+        return filtered_traces
+
+    def _mean_filter_without_threshold(self, traces):
+        """The mean filter in case use_threshold is False, for arrays
+
+        :param traces: array of traces with the samples along the last axis,
+                       with at least 4 samples.
+        :return: array of filtered traces.
 
-        return filtered_trace
+        """
+        moving_average, rounded_average = self._moving_average(traces)
+
+        filtered_traces = np.empty(traces.shape, dtype=rounded_average.dtype)
+        filtered_traces[..., :4] = rounded_average[..., :1]
+
+        current = traces[..., 4:]
+        previous = traces[..., 3:-1]
+        local_mean = moving_average[..., 1:]
+        # Both values on same side of the local_mean
+        keep = (current > local_mean) == (previous > local_mean)
+        filtered_traces[..., 4:] = where(keep, current,
+                                         rounded_average[..., 1:])
+
+        return filtered_traces
+
+    def _moving_average(self, traces):
+        """Mean of each sample and the 3 preceding samples
+
+        :param traces: array of traces with the samples along the last axis.
+        :return: the moving average and the moving average rounded to
+                 integers, starting at the fourth sample.
+
+        """
+        moving_sum = traces[..., 3:].astype('float64')
+        for shift in range(1, 4):
+            moving_sum += traces[..., 3 - shift:-shift]
+        moving_average = moving_sum / 4
+        rounded_average = around(moving_average).astype(int)
+        return moving_average, rounded_average
 
     def __repr__(self):
         try:
@@ -335,6 +552,80 @@ class DataReduction(object):
         else:
             return traces[left:right]
 
+    def batch_reduce_traces(self, traces, baselines=None, return_offset=False):
+        """Apply data reduction to the traces of many events
+
+        The reduced traces of all events are concatenated, event ``i`` is
+        given by ``reduced_traces[offsets[i]:offsets[i + 1]]``.
+
+        :param traces: a NumPy array of traces with shape (events, samples,
+                       detectors), so ``traces[i]`` contains the traces of
+                       one event as used by :meth:`reduce_traces`.
+        :param baselines: array of baselines with shape (events,
+            detectors), if None the baselines will be determined using
+            :class:`BatchTraceObservables`.
+        :param return_offset: if True the left cuts will also be returned.
+        :return: the concatenated data reduced traces, the offsets of the
+                 events in those traces (with the total length as last
+                 element), and the left cuts if return_offset is True.
+
+        """
+        traces = np.asarray(traces)
+        n_events, length, n_detectors = traces.shape
+        if baselines is None:
+            baselines = BatchTraceObservables(traces).baselines
+            baselines = baselines[:, :n_detectors]
+        left, right = self.batch_determine_cuts(traces, baselines)
+        left, right = self.batch_add_padding(left, right, length)
+
+        samples = np.arange(length)
+        keep = samples >= left[:, np.newaxis]
+        keep &= samples < right[:, np.newaxis]
+        reduced_traces = traces[keep]
+        offsets = np.zeros(n_events + 1, dtype='int64')
+        np.cumsum(right - left, out=offsets[1:])
+
+        if return_offset:
+            return reduced_traces, offsets, left
+        else:
+            return reduced_traces, offsets
+
+    def batch_determine_cuts(self, traces, baselines):
+        """Determine the left and right cuts for many events
+
+        See :meth:`determine_cuts`.
+
+        :param traces: array of traces with shape (events, samples,
+                       detectors).
+        :param baselines: array of baselines with shape (events, detectors).
+        :return: arrays with the left and right cuts for each event.
+
+        """
+        baselines = np.asarray(baselines)[:, np.newaxis, :]
+        over_threshold = (traces - baselines > self.threshold).any(axis=2)
+        has_signal = over_threshold.any(axis=1)
+        length = over_threshold.shape[1]
+        left = where(has_signal, over_threshold.argmax(axis=1), 0)
+        right = length - where(has_signal,
+                               over_threshold[:, ::-1].argmax(axis=1), 0)
+        return left, right
+
+    def batch_add_padding(self, left, right, length=None):
+        """Add padding around the cuts of many events
+
+        See :meth:`add_padding`.
+
+        :param left,right: arrays with the left and right cuts.
+        :param length: optionally the length of the traces.
+        :return: arrays with the indices into the traces where to cut them.
+
+        """
+        left = np.maximum(left - self.padding, 0)
+        right = right + self.padding
+        if length is not None:
+            right = np.minimum(right, length)
+        return left, right
+
     def determine_cuts(self, traces, baselines):
         """Determine the left and right cuts for an event
 
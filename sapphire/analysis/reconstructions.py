@@ -22,8 +22,10 @@ from __future__ import print_function
 
 import os
 import warnings
+from itertools import chain
 
-from six.moves import zip_longest, zip
+from six.moves import zip
+import numpy as np
 import tables
 
 from ..storage import ReconstructedEvent, ReconstructedCoincidence
@@ -35,7 +37,10 @@ from .core_reconstruction import (EventCoreReconstruction,
                                   CoincidenceCoreReconstruction)
 from .coincidence_queries import CoincidenceQuery
 from .calibration import determine_detector_timing_offsets
-from ..utils import pbar
+from ..utils import pbar, get_process_pool
+
+#: Number of reconstructions which are stored at once
+CHUNK_SIZE = 100000
 
 
 class ReconstructESDEvents(object):
@@ -68,7 +73,7 @@ class ReconstructESDEvents(object):
     def __init__(self, data, station_group, station,
                  overwrite=False, progress=True, verbose=False,
                  destination='reconstructions',
-                 force_fresh=False, force_stale=False):
+                 force_fresh=False, force_stale=False, workers=None):
         """Initialize the class.
 
         :param data: the PyTables datafile.
@@ -83,6 +88,9 @@ class ReconstructESDEvents(object):
         :param progress: if True show a progressbar while reconstructing.
         :param verbose: if True be verbose about station metadata usage.
         :param destination: alternative name for reconstruction table.
+        :param workers: number of worker processes used for the
+            reconstructions.  Default: None, meaning the events are
+            reconstructed in this process.
 
         """
         self.data = data
@@ -94,6 +102,7 @@ class ReconstructESDEvents(object):
         self.destination = destination
         self.force_fresh = force_fresh
         self.force_stale = force_stale
+        self.workers = workers
 
         self.offsets = [0., 0., 0., 0.]
 
@@ -128,9 +137,13 @@ class ReconstructESDEvents(object):
                         for x, y in zip(self.core_x, self.core_y))
         else:
             initials = []
-        angles = self.direction.reconstruct_events(self.events, detector_ids,
-                                                   self.offsets, self.progress,
-                                                   initials)
+        if self.workers and self.events.nrows:
+            angles = self._reconstruct_in_pool(
+                self.direction, (detector_ids, self.offsets), initials)
+        else:
+            angles = self.direction.reconstruct_events(
+                self.events, detector_ids, self.offsets, self.progress,
+                initials)
         self.theta, self.phi, self.detector_ids = angles
 
     def reconstruct_cores(self, detector_ids=None):
@@ -144,10 +157,38 @@ class ReconstructESDEvents(object):
                         for theta, phi in zip(self.theta, self.phi))
         else:
             initials = []
-        cores = self.core.reconstruct_events(self.events, detector_ids,
-                                             self.progress, initials)
+        if self.workers and self.events.nrows:
+            cores = self._reconstruct_in_pool(self.core, (detector_ids,),
+                                              initials)
+        else:
+            cores = self.core.reconstruct_events(self.events, detector_ids,
+                                                 self.progress, initials)
         self.core_x, self.core_y = cores
 
+    def _reconstruct_in_pool(self, reconstruction, args, initials):
+        """Reconstruct the events using a pool of worker processes
+
+        The events table is split into ranges of rows, four per worker.
+        Each worker opens the datafile read-only and reconstructs a range
+        of events, the results are combined in the original order.
+
+        :param reconstruction: direction or core reconstruction object.
+        :param args: arguments for its `reconstruct_events` method, after
+                     the events.
+        :param initials: already reconstructed shower parameters.
+        :return: the combined results of `reconstruct_events`.
+
+        """
+        self.events._v_file.flush()
+        initials = list(initials)
+        tasks = [(reconstruction, 'reconstruct_events',
+                  self.events._v_file.filename, self.events._v_pathname,
+                  args, start, stop, initials[start:stop])
+                 for start, stop in _split_rows(self.events.nrows,
+                                                self.workers)]
+        return _reconstruct_in_pool(_reconstruct_events_in_file, tasks,
+                                    self.workers, self.progress)
+
     def prepare_output(self):
         """Prepare output table"""
 
@@ -222,41 +263,37 @@ class ReconstructESDEvents(object):
         self.detector_offsets.flush()
 
     def store_reconstructions(self):
-        """Loop over list of reconstructed data and store results
+        """Store the reconstructed data
 
-        Unsuccessful reconstructions are also stored but with the NumPy
-        NaN as reconstructed value.
+        The results are converted to rows in chunks, which are appended
+        to the table.  Unsuccessful reconstructions are also stored but
+        with the NumPy NaN as reconstructed value.
 
         """
-        for event, core_x, core_y, theta, phi, detector_ids in zip_longest(
-                self.events, self.core_x, self.core_y,
-                self.theta, self.phi, self.detector_ids):
-            self._store_reconstruction(event, core_x, core_y, theta, phi,
-                                       detector_ids)
+        n_events = self.events.nrows
+        for start in range(0, n_events, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, n_events)
+            events = self.events.read(start, stop)
+            rows = np.zeros(len(events), dtype=self.reconstructions.dtype)
+            rows['id'] = events['event_id']
+            rows['ext_timestamp'] = events['ext_timestamp']
+            rows['x'] = self.core_x[start:stop]
+            rows['y'] = self.core_y[start:stop]
+            rows['zenith'] = self.theta[start:stop]
+            rows['azimuth'] = self.phi[start:stop]
+
+            detectors = _membership(self.detector_ids[start:stop], range(4))
+            n = np.column_stack([events['n%d' % (id + 1)]
+                                 for id in range(4)])
+            # If no detectors were used min_n is -999.
+            rows['min_n'] = np.where(detectors, n, np.inf).min(axis=1)
+            rows['min_n'][~detectors.any(axis=1)] = -999.
+            for id in range(4):
+                rows['d%d' % (id + 1)] = detectors[:, id]
+
+            self.reconstructions.append(rows)
         self.reconstructions.flush()
 
-    def _store_reconstruction(self, event, core_x, core_y, theta, phi,
-                              detector_ids):
-        """Store single reconstruction"""
-
-        row = self.reconstructions.row
-        row['id'] = event['event_id']
-        row['ext_timestamp'] = event['ext_timestamp']
-        try:
-            row['min_n'] = min([event['n%d' % (id + 1)] for id in
-                                detector_ids])
-        except ValueError:
-            # sometimes, all arrival times are -999 or -1, and then
-            # detector_ids = []. So min([]) gives a ValueError.
-            row['min_n'] = -999.
-        row['x'] = core_x
-        row['y'] = core_y
-        row['zenith'] = theta
-        row['azimuth'] = phi
-        for id in detector_ids:
-            row['d%d' % (id + 1)] = True
-        row.append()
-
     def _get_or_create_station_object(self, station):
             if isinstance(station, Station):
                 self.station = station
@@ -279,7 +316,7 @@ class ReconstructESDEventsFromSource(ReconstructESDEvents):
     def __init__(self, source_data, dest_data, source_group, dest_group,
                  station, overwrite=False, progress=True, verbose=False,
                  destination='reconstructions',
-                 force_fresh=False, force_stale=False):
+                 force_fresh=False, force_stale=False, workers=None):
         """Initialize the class.
 
         :param data: the PyTables datafile.
@@ -293,11 +330,13 @@ class ReconstructESDEventsFromSource(ReconstructESDEvents):
         :param progress: if True show a progressbar while reconstructing.
         :param verbose: if True be verbose about station metadata usage.
         :param destination: alternative name for reconstruction table.
+        :param workers: number of worker processes used for the
+            reconstructions.
 
         """
         super(ReconstructESDEventsFromSource, self).__init__(
             source_data, source_group, station, overwrite, progress, verbose,
-            destination, force_fresh, force_stale)
+            destination, force_fresh, force_stale, workers)
         self.dest_data = dest_data
         self.dest_group = dest_group
 
@@ -398,7 +437,7 @@ class ReconstructESDCoincidences(object):
     def __init__(self, data, coincidences_group='/coincidences',
                  overwrite=False, progress=True, verbose=False,
                  destination='reconstructions', cluster=None,
-                 force_fresh=False, force_stale=False):
+                 force_fresh=False, force_stale=False, workers=None):
         """Initialize the class.
 
         :param data: the PyTables datafile.
@@ -408,6 +447,9 @@ class ReconstructESDCoincidences(object):
         :param verbose: if True be verbose about station metadata usage.
         :param destination: alternative name for reconstruction table.
         :param cluster: a Cluster object to use for the reconstructions.
+        :param workers: number of worker processes used for the
+            reconstructions.  Default: None, meaning the coincidences are
+            reconstructed in this process.
 
         """
         self.data = data
@@ -419,6 +461,7 @@ class ReconstructESDCoincidences(object):
         self.destination = destination
         self.force_fresh = force_fresh
         self.force_stale = force_stale
+        self.workers = workers
         self.offsets = {}
 
         self.cq = CoincidenceQuery(data, self.coincidences_group)
@@ -453,11 +496,16 @@ class ReconstructESDCoincidences(object):
                         for x, y in zip(self.core_x, self.core_y))
         else:
             initials = []
-        coincidences = pbar(self.cq.all_coincidences(iterator=True),
-                            length=self.coincidences.nrows, show=self.progress)
-        angles = self.direction.reconstruct_coincidences(
-            self.cq.all_events(coincidences, n=0), station_numbers,
-            self.offsets, progress=False, initials=initials)
+        if self.workers and self.coincidences.nrows:
+            angles = self._reconstruct_in_pool(
+                self.direction, (station_numbers, self.offsets), initials)
+        else:
+            coincidences = pbar(self.cq.all_coincidences(iterator=True),
+                                length=self.coincidences.nrows,
+                                show=self.progress)
+            angles = self.direction.reconstruct_coincidences(
+                self.cq.all_events(coincidences, n=0), station_numbers,
+                self.offsets, progress=False, initials=initials)
         self.theta, self.phi, self.station_numbers = angles
 
     def reconstruct_cores(self, station_numbers=None):
@@ -471,13 +519,43 @@ class ReconstructESDCoincidences(object):
                         for theta, phi in zip(self.theta, self.phi))
         else:
             initials = []
-        coincidences = pbar(self.cq.all_coincidences(iterator=True),
-                            length=self.coincidences.nrows, show=self.progress)
-        cores = self.core.reconstruct_coincidences(
-            self.cq.all_events(coincidences, n=0), station_numbers,
-            progress=False, initials=initials)
+        if self.workers and self.coincidences.nrows:
+            cores = self._reconstruct_in_pool(self.core, (station_numbers,),
+                                              initials)
+        else:
+            coincidences = pbar(self.cq.all_coincidences(iterator=True),
+                                length=self.coincidences.nrows,
+                                show=self.progress)
+            cores = self.core.reconstruct_coincidences(
+                self.cq.all_events(coincidences, n=0), station_numbers,
+                progress=False, initials=initials)
         self.core_x, self.core_y = cores
 
+    def _reconstruct_in_pool(self, reconstruction, args, initials):
+        """Reconstruct the coincidences using a pool of worker processes
+
+        The coincidences table is split into ranges of rows, four per
+        worker.  Each worker opens the datafile read-only and reconstructs
+        a range of coincidences, the results are combined in the original
+        order.
+
+        :param reconstruction: direction or core reconstruction object.
+        :param args: arguments for its `reconstruct_coincidences` method,
+                     after the coincidences.
+        :param initials: already reconstructed shower parameters.
+        :return: the combined results of `reconstruct_coincidences`.
+
+        """
+        self.data.flush()
+        initials = list(initials)
+        tasks = [(reconstruction, 'reconstruct_coincidences',
+                  self.data.filename, self.coincidences_group._v_pathname,
+                  args, start, stop, initials[start:stop])
+                 for start, stop in _split_rows(self.coincidences.nrows,
+                                                self.workers)]
+        return _reconstruct_in_pool(_reconstruct_coincidences_in_file, tasks,
+                                    self.workers, self.progress)
+
     def prepare_output(self):
         """Prepare output table"""
 
@@ -527,44 +605,41 @@ class ReconstructESDCoincidences(object):
                 print('Using timing offsets from public database.')
 
     def store_reconstructions(self):
-        """Loop over list of reconstructed data and store results
+        """Store the reconstructed data
 
-        Unsuccessful reconstructions are also stored but with the NumPy
-        NaN as reconstructed value.
+        The results are converted to rows in chunks, which are appended
+        to the table.  Unsuccessful reconstructions are also stored but
+        with the NumPy NaN as reconstructed value.
 
         """
-        for coincidence, x, y, theta, phi, station_numbers in zip_longest(
-                self.coincidences, self.core_x, self.core_y,
-                self.theta, self.phi, self.station_numbers):
-            self._store_reconstruction(coincidence, x, y, theta, phi,
-                                       station_numbers)
+        numbers = [station.number for station in self.cluster.stations]
+        n_coincidences = self.coincidences.nrows
+        for start in range(0, n_coincidences, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, n_coincidences)
+            coincidences = self.coincidences.read(start, stop)
+            rows = np.zeros(len(coincidences),
+                            dtype=self.reconstructions.dtype)
+            rows['id'] = coincidences['id']
+            rows['ext_timestamp'] = coincidences['ext_timestamp']
+            rows['x'] = self.core_x[start:stop]
+            rows['y'] = self.core_y[start:stop]
+            rows['zenith'] = self.theta[start:stop]
+            rows['azimuth'] = self.phi[start:stop]
+
+            rows['reference_x'] = coincidences['x']
+            rows['reference_y'] = coincidences['y']
+            rows['reference_zenith'] = coincidences['zenith']
+            rows['reference_azimuth'] = coincidences['azimuth']
+            rows['reference_size'] = coincidences['size']
+            rows['reference_energy'] = coincidences['energy']
+
+            stations = _membership(self.station_numbers[start:stop], numbers)
+            for i, number in enumerate(numbers):
+                rows['s%d' % number] = stations[:, i]
+
+            self.reconstructions.append(rows)
         self.reconstructions.flush()
 
-    def _store_reconstruction(self, coincidence, core_x, core_y, theta, phi,
-                              station_numbers):
-        """Store single reconstruction"""
-
-        row = self.reconstructions.row
-
-        row['id'] = coincidence['id']
-        row['ext_timestamp'] = coincidence['ext_timestamp']
-        row['x'] = core_x
-        row['y'] = core_y
-        row['zenith'] = theta
-        row['azimuth'] = phi
-
-        row['reference_x'] = coincidence['x']
-        row['reference_y'] = coincidence['y']
-        row['reference_zenith'] = coincidence['zenith']
-        row['reference_azimuth'] = coincidence['azimuth']
-        row['reference_size'] = coincidence['size']
-        row['reference_energy'] = coincidence['energy']
-
-        for number in station_numbers:
-            row['s%d' % number] = True
-
-        row.append()
-
     def _get_or_create_cluster_object(self, cluster):
         """Create cluster object from public database"""
 
@@ -605,7 +680,7 @@ class ReconstructESDCoincidencesFromSource(ReconstructESDCoincidences):
     def __init__(self, source_data, dest_data, source_group, dest_group,
                  overwrite=False, progress=True, verbose=False,
                  destination='reconstructions', cluster=None,
-                 force_fresh=False, force_stale=False):
+                 force_fresh=False, force_stale=False, workers=None):
         """Initialize the class.
 
         :param data: the PyTables datafile.
@@ -619,11 +694,13 @@ class ReconstructESDCoincidencesFromSource(ReconstructESDCoincidences):
         :param progress: if True show a progressbar while reconstructing.
         :param verbose: if True be verbose about station metadata usage.
         :param destination: alternative name for reconstruction table.
+        :param workers: number of worker processes used for the
+            reconstructions.
 
         """
         super(ReconstructESDCoincidencesFromSource, self).__init__(
             source_data, source_group, overwrite, progress, verbose,
-            destination, cluster, force_fresh, force_stale)
+            destination, cluster, force_fresh, force_stale, workers)
         self.dest_data = dest_data
         self.dest_group = dest_group
 
@@ -703,3 +780,105 @@ class ReconstructSimulatedCoincidences(ReconstructESDCoincidences):
             if self.verbose:
                 print('Using cluster %s for metadata.' % self.cluster)
         return cluster
+
+
+def _membership(members, keys):
+    """Convert lists of members to a boolean array
+
+    :param members: list with a list of members (e.g. detector ids or
+                    station numbers) for each row.
+    :param keys: all possible members, one for each column.
+    :return: boolean array with shape (rows, keys), True where the key
+             is one of the members of the row.
+
+    """
+    keys = np.asarray(keys)
+    order = keys.argsort()
+    lengths = np.fromiter(map(len, members), int, len(members))
+    values = np.fromiter(chain.from_iterable(members), keys.dtype,
+                         lengths.sum())
+    idx = order[np.searchsorted(keys, values, sorter=order)
+                .clip(0, max(len(keys) - 1, 0))]
+    if not np.array_equal(keys[idx], values):
+        raise KeyError('Unknown members: %s' %
+                       np.setdiff1d(values, keys).tolist())
+    membership = np.zeros((len(members), len(keys)), dtype=bool)
+    membership[np.arange(len(members)).repeat(lengths), idx] = True
+    return membership
+
+
+def _split_rows(n_rows, workers):
+    """Split a number of rows into ranges, four per worker
+
+    :param n_rows: total number of rows.
+    :param workers: number of worker processes.
+    :return: list of (start, stop) tuples of non-empty ranges.
+
+    """
+    bounds = np.linspace(0, n_rows, 4 * workers + 1).astype(int)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])
+            if stop > start]
+
+
+def _reconstruct_in_pool(function, tasks, workers, progress):
+    """Perform reconstruction tasks in a pool of worker processes
+
+    :param function: function which performs a single task.
+    :param tasks: list of tasks.
+    :param workers: number of worker processes.
+    :param progress: if True show a progressbar for the finished tasks.
+    :return: list with the combined values of each of the results of
+             the tasks, in order.
+
+    """
+    pool = get_process_pool(workers)
+    try:
+        results = list(pbar(pool.imap(function, tasks), length=len(tasks),
+                            show=progress))
+    finally:
+        pool.close()
+        pool.join()
+
+    return [list(chain.from_iterable(parts)) for parts in zip(*results)]
+
+
+def _reconstruct_events_in_file(task):
+    """Reconstruct a range of events, reading from a file
+
+    This opens the file read-only, to be used in a worker process.
+
+    :param task: tuple of the reconstruction object, the name of the
+        method to call, the path to the data file, the path to the events
+        table, the other arguments for the method, the range of rows and
+        the initials for those rows.
+    :return: the results of the reconstruction.
+
+    """
+    (reconstruction, method, filename, events, args, start, stop,
+     initials) = task
+    with tables.open_file(filename, 'r') as data:
+        events = data.get_node(events).read(start, stop)
+        return getattr(reconstruction, method)(
+            events, *args, progress=False, initials=initials)
+
+
+def _reconstruct_coincidences_in_file(task):
+    """Reconstruct a range of coincidences, reading from a file
+
+    This opens the file read-only, to be used in a worker process.
+
+    :param task: tuple of the reconstruction object, the name of the
+        method to call, the path to the data file, the path to the
+        coincidences group, the other arguments for the method, the range
+        of rows and the initials for those rows.
+    :return: the results of the reconstruction.
+
+    """
+    (reconstruction, method, filename, group, args, start, stop,
+     initials) = task
+    with tables.open_file(filename, 'r') as data:
+        cq = CoincidenceQuery(data, group)
+        coincidences = cq.coincidences.read(start, stop)
+        return getattr(reconstruction, method)(
+            cq.all_events(coincidences, n=0), *args, progress=False,
+            initials=initials)
@@ -25,7 +25,7 @@ import numpy as np
 
 from .transformations import axes, geographic
 from . import api
-from .utils import get_active_index, distance_between
+from .utils import get_active_index, ActiveIndexCache, distance_between
 
 
 class Detector(object):
@@ -96,6 +96,10 @@ class Detector(object):
         return x, y
 
     def get_coordinates(self):
+        geometry = _get_geometry(self.station.cluster)
+        if geometry is not None:
+            return geometry.get_detector_coordinates(self)
+
         X, Y, Z, alpha = self.station.get_coordinates()
 
         sina = sin(alpha)
@@ -143,6 +147,10 @@ class Detector(object):
         :return: coordinates of detector corners, list of (x, y) tuples.
 
         """
+        geometry = _get_geometry(self.station.cluster)
+        if geometry is not None:
+            return geometry.get_detector_corners(self)
+
         X, Y, _, alpha = self.station.get_coordinates()
 
         x = self.x[self.index]
@@ -256,6 +264,18 @@ class Station(object):
             detector._update_timestamp(timestamp)
         self.index = get_active_index(self.timestamps, timestamp)
 
+    def get_layout_timestamps(self):
+        """Get the timestamps at which the layout of the station changed
+
+        :return: sorted list of timestamps at which the position of the
+                 station or one of its detectors changed.
+
+        """
+        changes = set(self.timestamps)
+        for detector in self.detectors:
+            changes.update(detector.timestamps)
+        return sorted(changes)
+
     def _add_detector(self, position, orientation, detector_timestamps):
         """Add detector to station
 
@@ -304,6 +324,10 @@ class Station(object):
                  relative to absolute coordinate system
 
         """
+        geometry = _get_geometry(self.cluster)
+        if geometry is not None:
+            return geometry.get_station_coordinates(self)
+
         X, Y, Z, alpha = self.cluster.get_coordinates()
 
         sina = sin(alpha)
@@ -377,8 +401,12 @@ class Station(object):
             absolute coordinate system
 
         """
-        x, y, z = zip(*[detector.get_coordinates()
-                      for detector in self.detectors])
+        geometry = _get_geometry(self.cluster)
+        if geometry is not None:
+            x, y, z = geometry.get_station_detector_coordinates(self)
+        else:
+            x, y, z = zip(*[detector.get_coordinates()
+                          for detector in self.detectors])
 
         x0 = np.nanmean(x)
         y0 = np.nanmean(y)
@@ -396,6 +424,9 @@ class BaseCluster(object):
     """Base class for HiSPARC clusters"""
 
     _stations = None
+    _layout = None
+    _layout_updated = False
+    _geometry = None
 
     def __init__(self, position=(0, 0, 0), angle=0,
                  lla=(52.35592417, 4.95114402, 56.10234594)):
@@ -416,15 +447,49 @@ class BaseCluster(object):
         # 2 ** 31 - 1 == 19 Jan 2038
         self._timestamp = 2147483647
 
-    def set_timestamp(self, timestamp):
+    def set_timestamp(self, timestamp, stations=None):
         """Set the timestamp to set the active station and detector locations
 
+        The interval between layout changes (of any station or detector)
+        in which the timestamp falls is remembered.  When the next
+        timestamp is in the same interval the active locations are still
+        valid and nothing needs to be updated.
+
         :param timestamp: timestamp in seconds.
+        :param stations: optional list of station numbers, if given only
+                         these stations are updated (when needed).
 
         """
         self._timestamp = timestamp
+        if self._layout is None:
+            self._layout = ActiveIndexCache(self.get_layout_timestamps())
+        previous_index = self._layout.idx
+        index = self._layout(timestamp)
+        if index == previous_index and self._layout_updated:
+            return
+
+        if stations is None:
+            for station in self.stations:
+                station._update_timestamp(timestamp)
+            self._layout_updated = True
+        else:
+            # Other stations may still be in a different interval
+            for number in stations:
+                self.get_station(number)._update_timestamp(timestamp)
+            self._layout_updated = False
+        self._geometry = None
+
+    def get_layout_timestamps(self):
+        """Get the timestamps at which the layout of the cluster changed
+
+        :return: sorted list of timestamps at which the position of one
+                 of the stations or their detectors changed.
+
+        """
+        changes = set()
         for station in self.stations:
-            station._update_timestamp(self._timestamp)
+            changes.update(station.get_layout_timestamps())
+        return sorted(changes)
 
     def _add_station(self, position, angle=None, detectors=None,
                      station_timestamps=None, detector_timestamps=None,
@@ -466,12 +531,13 @@ class BaseCluster(object):
         self._stations.append(Station(self, station_id, position, angle,
                                       detectors, station_timestamps,
                                       detector_timestamps, number))
+        self._layout = None
+        self._layout_updated = False
+        self._geometry = None
 
     def set_center_off_mass_at_origin(self):
         """Set the cluster center of mass to (0, 0, 0)"""
-        self.x = 0
-        self.y = 0
-        self.z = 0
+        self.set_coordinates(0, 0, 0, self.alpha)
         x, y, z = self.calc_center_of_mass_coordinates()
         self.set_coordinates(-x, -y, -z, self.alpha)
 
@@ -486,6 +552,43 @@ class BaseCluster(object):
             if number == station.number:
                 return station
 
+    def _get_geometry(self):
+        """Get the coordinates of all stations and detectors
+
+        The coordinates are calculated once for the active positions and
+        reused until the cluster coordinates or the active positions
+        change.
+
+        :return: :class:`ClusterGeometry` object.
+
+        """
+        if self._geometry is None:
+            self._geometry = ClusterGeometry(self)
+        return self._geometry
+
+    def get_station_coordinates(self):
+        """Get the coordinates of all stations at once
+
+        :return: x, y, z, alpha; arrays with the coordinates and rotation
+                 of each station relative to the absolute coordinate
+                 system, in the order of the stations in the cluster.
+
+        """
+        geometry = self._get_geometry()
+        return (geometry.station_x, geometry.station_y, geometry.station_z,
+                geometry.station_alpha)
+
+    def get_detector_coordinates(self):
+        """Get the coordinates of all detectors at once
+
+        :return: x, y, z; arrays with the coordinates of each detector
+                 relative to the absolute coordinate system, ordered by
+                 station and then by detector.
+
+        """
+        geometry = self._get_geometry()
+        return geometry.detector_x, geometry.detector_y, geometry.detector_z
+
     def get_xy_coordinates(self):
         """Same as get_coordinates but without the z and alpha"""
         return self.x, self.y
@@ -548,6 +651,7 @@ class BaseCluster(object):
 
         """
         self.x, self.y, self.z, self.alpha = x, y, z, alpha
+        self._geometry = None
 
     def set_cylindrical_coordinates(self, r, phi, z, alpha):
         """Set cluster coordinates (r, phi, z, alpha).
@@ -559,6 +663,7 @@ class BaseCluster(object):
         """
         self.x, self.y, self.z = axes.cylindrical_to_cartesian(r, phi, z)
         self.alpha = alpha
+        self._geometry = None
 
     def calc_rphiz_for_stations(self, s0, s1):
         """Calculate distance between and direction of two stations
@@ -593,9 +698,7 @@ class BaseCluster(object):
             absolute coordinate system
 
         """
-        x, y, z = zip(*[detector.get_coordinates()
-                      for station in self.stations
-                      for detector in station.detectors])
+        x, y, z = self.get_detector_coordinates()
 
         x0 = np.nanmean(x)
         y0 = np.nanmean(y)
@@ -652,6 +755,142 @@ class BaseCluster(object):
         return "<%s>" % self.__class__.__name__
 
 
+class ClusterGeometry(object):
+
+    """Coordinates of all stations and detectors in a cluster
+
+    The coordinates of the active positions of all stations and detectors
+    are calculated at once and stored in arrays.  The rotations and
+    translations are the same as those in :meth:`Station.get_coordinates`,
+    :meth:`Detector.get_coordinates` and :meth:`Detector.get_corners`.
+
+    """
+
+    def __init__(self, cluster):
+        """Calculate the coordinates
+
+        :param cluster: :class:`BaseCluster` object.
+
+        """
+        stations = cluster.stations or []
+        detectors = [station.detectors or [] for station in stations]
+        self._offsets = np.cumsum([0] + [len(d) for d in detectors])
+        detectors = [detector for d in detectors for detector in d]
+        station_idx = np.repeat(np.arange(len(stations)),
+                                np.diff(self._offsets))
+
+        # Station coordinates
+        X, Y, Z, alpha = cluster.get_coordinates()
+        sina = sin(alpha)
+        cosa = cos(alpha)
+        x, y, z, angle = self._active_positions(stations, 'angle')
+        self.station_x = X + (x * cosa - y * sina)
+        self.station_y = Y + (x * sina + y * cosa)
+        self.station_z = Z + z
+        self.station_alpha = alpha + angle
+
+        # Detector coordinates
+        X = self.station_x[station_idx]
+        Y = self.station_y[station_idx]
+        sina = np.array([sin(a) for a in self.station_alpha])[station_idx]
+        cosa = np.array([cos(a) for a in self.station_alpha])[station_idx]
+        x, y, z, orientation = self._active_positions(detectors,
+                                                      'orientation')
+        self.detector_x = X + (x * cosa - y * sina)
+        self.detector_y = Y + (x * sina + y * cosa)
+        self.detector_z = self.station_z[station_idx] + z
+
+        # Detector corners, from the detector frame to the station frame
+        # to the cluster frame.
+        size = np.array([detector.detector_size for detector in detectors],
+                        dtype=float).reshape(-1, 2)
+        dx = size[:, :1] / 2
+        dy = size[:, 1:] / 2
+        cx = np.hstack([-dx, dx, dx, -dx])
+        cy = np.hstack([-dy, -dy, dy, dy])
+        coso = np.array([cos(-o) for o in orientation])[:, None]
+        sino = np.array([sin(-o) for o in orientation])[:, None]
+        xc = x[:, None] + cx * coso - cy * sino
+        yc = y[:, None] + cx * sino + cy * coso
+        self.detector_corners = np.dstack(
+            [X[:, None] + xc * cosa[:, None] - yc * sina[:, None],
+             Y[:, None] + xc * sina[:, None] + yc * cosa[:, None]])
+
+        for values in (self.station_x, self.station_y, self.station_z,
+                       self.station_alpha, self.detector_x, self.detector_y,
+                       self.detector_z, self.detector_corners):
+            values.flags.writeable = False
+
+        # Python floats for fast access by single stations and detectors
+        self._stations = list(zip(
+            self.station_x.tolist(), self.station_y.tolist(),
+            self.station_z.tolist(), self.station_alpha.tolist()))
+        self._detectors = list(zip(
+            self.detector_x.tolist(), self.detector_y.tolist(),
+            self.detector_z.tolist()))
+        self._corners = [[tuple(corner) for corner in corners]
+                         for corners in self.detector_corners.tolist()]
+
+    @staticmethod
+    def _active_positions(objects, angle):
+        """Get the active relative positions of stations or detectors
+
+        :param objects: list of :class:`Station` or :class:`Detector`
+                        objects.
+        :param angle: name of the attribute with the rotation angle.
+        :return: x, y, z, angle arrays.
+
+        """
+        positions = [(o.x[o.index], o.y[o.index], o.z[o.index],
+                      getattr(o, angle)[o.index]) for o in objects]
+        return np.array(positions, dtype=float).reshape(-1, 4).T
+
+    def _detector_row(self, detector):
+        """Get the index of a detector in the detector arrays"""
+
+        station = detector.station
+        return (self._offsets[station.station_id] +
+                station.detectors.index(detector))
+
+    def get_station_coordinates(self, station):
+        """Get the x, y, z, alpha coordinates of a station"""
+
+        return self._stations[station.station_id]
+
+    def get_station_detector_coordinates(self, station):
+        """Get the x, y, z coordinates of the detectors of a station
+
+        :return: x, y, z; arrays with the detector coordinates.
+
+        """
+        start = self._offsets[station.station_id]
+        stop = self._offsets[station.station_id + 1]
+        return (self.detector_x[start:stop], self.detector_y[start:stop],
+                self.detector_z[start:stop])
+
+    def get_detector_coordinates(self, detector):
+        """Get the x, y, z coordinates of a detector"""
+
+        return self._detectors[self._detector_row(detector)]
+
+    def get_detector_corners(self, detector):
+        """Get the x, y coordinates of the corners of a detector"""
+
+        return self._corners[self._detector_row(detector)]
+
+
+def _get_geometry(cluster):
+    """Get the cached geometry of a cluster
+
+    :param cluster: cluster of a station.
+    :return: :class:`ClusterGeometry` object, or None if the cluster is
+             not a :class:`BaseCluster`.
+
+    """
+    if isinstance(cluster, BaseCluster):
+        return cluster._get_geometry()
+
+
 class CompassStations(BaseCluster):
 
     """Add detectors to stations using compass coordinates
@@ -927,3 +1166,4 @@ def flatten_cluster(cluster):
         station.z = [0.] * len(station.z)
         for detector in station.detectors:
             detector.z = [0.] * len(detector.z)
+    cluster._geometry = None
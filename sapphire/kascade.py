@@ -196,86 +196,109 @@ class KascadeCoincidences(object):
         :param limit: limit on the number of KASCADE events investigated.
 
         """
-        h, k = self._get_cached_sorted_id_and_timestamp_arrays()
+        h, k = self._get_cached_sorted_timestamps()
+        self.coincidences = self._search_coincidences(h, k, timeshift,
+                                                      dtlimit, limit)
 
+    def sweep_timeshifts(self, timeshifts, dtlimit=None, limit=None):
+        """Search for coincidences for a range of timeshifts
+
+        This can be used to determine the offset between the HiSPARC and
+        KASCADE data, for example by looking for the timeshift which gives
+        the most coincidences.  The sorted timestamps are only read once.
+
+        :param timeshifts: iterable of timeshifts, see
+            :meth:`search_coincidences`.
+        :param dtlimit: limit on the time difference between hisparc and
+            kascade events in seconds.
+        :param limit: limit on the number of KASCADE events investigated.
+        :return: list of coincidences for each timeshift, these have the
+            same format as the coincidences found by
+            :meth:`search_coincidences`.
+
+        """
+        h, k = self._get_cached_sorted_timestamps()
+        return [self._search_coincidences(h, k, timeshift, dtlimit, limit)
+                for timeshift in timeshifts]
+
+    def _search_coincidences(self, h, k, timeshift=0, dtlimit=None,
+                             limit=None):
+        """Match each KASCADE event with the nearest HiSPARC event
+
+        The position of each KASCADE event in the HiSPARC timestamps is
+        determined using :func:`numpy.searchsorted`.  The nearest of the
+        enclosing HiSPARC events is chosen.
+
+        :param h,k: sorted HiSPARC and KASCADE timestamps in ns (int64).
+        :param timeshift,dtlimit,limit: see :meth:`search_coincidences`.
+        :return: record array with the time difference, and the index of
+            the HiSPARC and KASCADE events for each coincidence.
+
+        """
         # Shift the kascade data instead of the hisparc data. There is less of
         # it, so this is much faster.
-        k['ext_timestamp'] += int(-1e9) * timeshift
+        k = k - int(round(timeshift * 1e9))
 
         if dtlimit:
             # dtlimit in ns
             dtlimit *= 1e9
 
-        coinc_dt, coinc_h_idx, coinc_k_idx = [], [], []
-
-        # First loop through kascade data until we have the first event that
-        # occurs _after_ the first hisparc event.
-        h_idx = 0
-        for k_idx in range(len(k)):
-            if k[k_idx][1] > h[h_idx][1]:
-                break
-
+        # Start with the first kascade event that occurs _after_ the first
+        # hisparc event.
+        if len(h) < 2 or not len(k):
+            k_start = k_stop = 0
+        else:
+            k_start = min(k.searchsorted(h[0], side='right'), len(k) - 1)
+            k_stop = len(k)
         # Limit number of KASCADE events investigated
         if limit:
-            max_k_idx = k_idx + limit - 1
-        else:
-            max_k_idx = np.Inf
-
-        while k_idx <= max_k_idx:
-            # Try to get the timestamps of the kascade event and the
-            # neighbouring hisparc events.
-            try:
-                h_t = int(h[h_idx][1])
-                k_t = int(k[k_idx][1])
-                h_t_next = int(h[h_idx + 1][1])
-            except IndexError:
-                # Reached beyond the event list.
-                break
-
-            # Make sure that while the current hisparc event is _before_ the
-            # kascade event, the next hisparc event should occur _after_ the
-            # kascade event.  That way, the kascade event is enclosed by
-            # hisparc events.
-            if k_t > h_t_next:
-                h_idx += 1
-                continue
-
-            # Calculate the time differences for both neighbors. Make sure to
-            # get the sign right. Negative sign: the hisparc event is 'left'.
-            # Positive sign: the hisparc event is 'right'.
-            dt_left = h_t - k_t
-            dt_right = h_t_next - k_t
-
-            # Determine the nearest neighbor and add that to the coincidence
-            # list, if dtlimit is not exceeded
-            if dtlimit is None or min(abs(dt_left), abs(dt_right)) < dtlimit:
-                if abs(dt_left) < abs(dt_right):
-                    coinc_dt.append(dt_left)
-                    coinc_h_idx.append(h_idx)
-                else:
-                    coinc_dt.append(dt_right)
-                    coinc_h_idx.append(h_idx + 1)
-                coinc_k_idx.append(k_idx)
-
-            # Found a match for this kascade event, so continue with the next
-            # one.
-            k_idx += 1
-
-        self.coincidences = np.rec.fromarrays(
-            [coinc_dt, coinc_h_idx, coinc_k_idx], names='dt, h_idx, k_idx')
+            k_stop = min(k_stop, k_start + limit)
+        k_idx = np.arange(k_start, k_stop)
+        k_t = k[k_start:k_stop]
+
+        # Index of the hisparc event following the kascade event, such that
+        # the kascade event is enclosed by hisparc events.  Stop at the first
+        # kascade event after the last hisparc event.
+        h_idx_next = np.maximum(h.searchsorted(k_t, side='left'), 1)
+        n_enclosed = h_idx_next.searchsorted(len(h))
+        h_idx_next = h_idx_next[:n_enclosed]
+        k_idx = k_idx[:n_enclosed]
+        k_t = k_t[:n_enclosed]
+
+        # Calculate the time differences for both neighbors. Make sure to
+        # get the sign right. Negative sign: the hisparc event is 'left'.
+        # Positive sign: the hisparc event is 'right'.
+        dt_left = h[h_idx_next - 1] - k_t
+        dt_right = h[h_idx_next] - k_t
+
+        # Determine the nearest neighbor, if dtlimit is not exceeded
+        is_left = abs(dt_left) < abs(dt_right)
+        dt = np.where(is_left, dt_left, dt_right)
+        h_idx = np.where(is_left, h_idx_next - 1, h_idx_next)
+        if dtlimit is not None:
+            within_limit = abs(dt) < dtlimit
+            dt = dt[within_limit]
+            h_idx = h_idx[within_limit]
+            k_idx = k_idx[within_limit]
+
+        return np.rec.fromarrays([dt, h_idx, k_idx],
+                                 names='dt, h_idx, k_idx')
 
     def store_coincidences(self):
         self.data.create_table(self.kascade_group, 'c_index',
                                self.coincidences)
 
-    def _get_cached_sorted_id_and_timestamp_arrays(self):
+    def _get_cached_sorted_timestamps(self):
+        """Get the sorted HiSPARC and KASCADE timestamps in ns as int64"""
+
         if not hasattr(self, '_h'):
             self._h = self._get_sorted_id_and_timestamp_array(
                 self.hisparc_group)
         if not hasattr(self, '_k'):
             self._k = self._get_sorted_id_and_timestamp_array(
                 self.kascade_group)
-        return self._h.copy(), self._k.copy()
+        return (self._h['ext_timestamp'].astype(np.int64),
+                self._k['ext_timestamp'].astype(np.int64))
 
     def _get_sorted_id_and_timestamp_array(self, group):
         timestamps = group.events.col('ext_timestamp')
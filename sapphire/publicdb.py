@@ -82,6 +82,11 @@ def _store_data(dst_file, dst_group, src_filename, t0, t1):
     This function takes a file containing downloaded data and copies it to
     the destination file, based on start and end timestamps.
 
+    If the events in the destination were processed by
+    :class:`~sapphire.analysis.process_events.ProcessEvents`, the new
+    events are appended to the raw events table (``_events``), so they
+    can be processed using ``incremental=True``.
+
     """
     with tables.open_file(src_filename, 'r') as src_file:
         src_group = src_file.list_nodes('/')[0]
@@ -93,7 +98,12 @@ def _store_data(dst_file, dst_group, src_filename, t0, t1):
             len_blobs = 0
 
         for node in src_file.list_nodes(src_group):
-            dst_node = _get_or_create_node(dst_file, dst_group, node)
+            if node.name == 'events' and '_events' in dst_group:
+                # The events were processed, append to the raw events
+                # which were moved out of the way to be processed again.
+                dst_node = dst_group._events
+            else:
+                dst_node = _get_or_create_node(dst_file, dst_group, node)
 
             if node.name == 'blobs':
                 for row in node:
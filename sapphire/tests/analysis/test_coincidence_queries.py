@@ -1,7 +1,13 @@
+import os
+import tempfile
 import unittest
+import warnings
 
 from mock import sentinel, patch, call
 
+import numpy as np
+import tables
+
 from sapphire.analysis import coincidence_queries
 
 
@@ -21,7 +27,8 @@ class BaseCoincidenceQueryTest(unittest.TestCase):
         expected = [call(self.coincidences_group, 'coincidences'),
                     call(self.coincidences_group, 'c_index'),
                     call(self.coincidences_group, 's_index'),
-                    call(self.coincidences_group, 'reconstructions')]
+                    call(self.coincidences_group, 'reconstructions'),
+                    call(self.coincidences_group, 'membership_index')]
         call_list = self.mock_open_file.return_value.get_node.call_args_list
         self.assertEqual(call_list, expected)
 
@@ -107,18 +114,25 @@ class BaseCoincidenceQueryTest(unittest.TestCase):
         result = self.cq._get_s_columns([501])
         self.assertEqual(result, ['s501'])
 
-    @unittest.skip('WIP')
-    def test__get_events(self):
-        pass
-
-    @patch.object(coincidence_queries.CoincidenceQuery, '_get_events')
+    @patch.object(coincidence_queries.CoincidenceQuery, '_get_events_batch')
     def test_all_events(self, mock_get_events):
-        mock_get_events.return_value = [sentinel.event1, sentinel.event2]
-        coincidences = [sentinel.coincidence]
+        mock_get_events.return_value = [[sentinel.event1, sentinel.event2]]
+        coincidences = [{'id': sentinel.id}]
         result = list(self.cq.all_events(coincidences))
-        mock_get_events.assert_called_once_with(sentinel.coincidence)
+        mock_get_events.assert_called_once_with([sentinel.id], 'events')
         self.assertEqual(result, [[sentinel.event1, sentinel.event2]])
 
+    @patch.object(coincidence_queries, 'EVENTS_BLOCK_SIZE', 2)
+    @patch.object(coincidence_queries.CoincidenceQuery, '_get_events_batch')
+    def test__iter_events_in_blocks(self, mock_get_events):
+        mock_get_events.side_effect = lambda ids, table: ids
+        coincidences = [{'id': i} for i in range(5)]
+        result = list(self.cq._iter_events_in_blocks(coincidences))
+        self.assertEqual(result, list(range(5)))
+        mock_get_events.assert_has_calls([call([0, 1], 'events'),
+                                          call([2, 3], 'events'),
+                                          call([4], 'events')])
+
     def test_minimum_events_for_coincidence(self):
         coincidences_events = [[1], [2, 2], [3, 3, 3], [4, 4, 4, 4]]
         filtered = self.cq.minimum_events_for_coincidence(coincidences_events, 0)
@@ -130,27 +144,35 @@ class BaseCoincidenceQueryTest(unittest.TestCase):
 
     @patch.object(coincidence_queries.CoincidenceQuery, 'minimum_events_for_coincidence')
     @patch.object(coincidence_queries.CoincidenceQuery, '_events_from_stations')
-    @patch.object(coincidence_queries.CoincidenceQuery, '_get_events')
-    def test_events_from_stations(self, mock_get_events, mock_events_from, mock_minimum):
-        mock_get_events.return_value = sentinel.events
+    @patch.object(coincidence_queries.CoincidenceQuery, '_iter_events_in_blocks')
+    def test_events_from_stations(self, mock_iter_events, mock_events_from, mock_minimum):
+        mock_iter_events.return_value = [sentinel.events]
         mock_events_from.return_value = sentinel.coincidence_events
+        mock_minimum.return_value = sentinel.filtered
         coincidences = [sentinel.coincidence]
-        self.cq.events_from_stations(coincidences, sentinel.stations)
-        # mock_get_events.assert_called_once_with(sentinel.coincidence)
-        # mock_events_from.assert_called_once_with(sentinel.events, sentinel.stations)
-        # mock_minimum.assert_called_once_with([sentinel.coincidence_events])
+        result = self.cq.events_from_stations(coincidences, sentinel.stations)
+        self.assertEqual(result, sentinel.filtered)
+        mock_iter_events.assert_called_once_with(coincidences)
+        self.assertEqual(list(mock_minimum.call_args[0][0]),
+                         [sentinel.coincidence_events])
+        mock_events_from.assert_called_once_with(sentinel.events, sentinel.stations)
+        self.assertEqual(mock_minimum.call_args[0][1], 2)
 
     @patch.object(coincidence_queries.CoincidenceQuery, 'minimum_events_for_coincidence')
     @patch.object(coincidence_queries.CoincidenceQuery, '_events_from_stations')
-    @patch.object(coincidence_queries.CoincidenceQuery, '_get_reconstructions')
-    def test_reconstructions_from_stations(self, mock_get_reconstructions, mock_events_from, mock_minimum):
-        mock_get_reconstructions.return_value = sentinel.reconstructions
+    @patch.object(coincidence_queries.CoincidenceQuery, '_iter_events_in_blocks')
+    def test_reconstructions_from_stations(self, mock_iter_events, mock_events_from, mock_minimum):
+        mock_iter_events.return_value = [sentinel.reconstructions]
         mock_events_from.return_value = sentinel.coincidence_reconstructions
+        mock_minimum.return_value = sentinel.filtered
         coincidences = [sentinel.coincidence]
-        self.cq.reconstructions_from_stations(coincidences, sentinel.stations)
-        # mock_get_events.assert_called_once_with(sentinel.coincidence)
-        # mock_events_from.assert_called_once_with(sentinel.events, sentinel.stations)
-        # mock_minimum.assert_called_once_with([sentinel.coincidence_events])
+        result = self.cq.reconstructions_from_stations(coincidences, sentinel.stations)
+        self.assertEqual(result, sentinel.filtered)
+        mock_iter_events.assert_called_once_with(coincidences, 'reconstructions')
+        self.assertEqual(list(mock_minimum.call_args[0][0]),
+                         [sentinel.coincidence_reconstructions])
+        mock_events_from.assert_called_once_with(sentinel.reconstructions, sentinel.stations)
+        self.assertEqual(mock_minimum.call_args[0][1], 2)
 
     def test__events_from_stations(self):
         events = ([sentinel.station1, sentinel.event1],
@@ -182,5 +204,140 @@ class BaseCoincidenceQueryTest(unittest.TestCase):
         self.assertEqual(result, sentinel.coincidence_events)
 
 
+class GetEventsTests(unittest.TestCase):
+
+    def setUp(self):
+        self_path = os.path.dirname(__file__)
+        path = os.path.join(self_path, 'test_data/esd_coincidences.h5')
+        self.cq = coincidence_queries.CoincidenceQuery(path)
+
+    def tearDown(self):
+        self.cq.finish()
+
+    def test__get_events_batch(self):
+        events501 = self.cq.data.root.station_501.events
+        events502 = self.cq.data.root.station_502.events
+        # Station and event indexes as stored in the c_index
+        expected = {0: [(501, events501[41]), (502, events502[56])],
+                    1: [(502, events502[88]), (501, events501[59])]}
+        for ids in [[0, 1], [1, 0], [1]]:
+            result = self.cq._get_events_batch(ids)
+            self.assertEqual(len(result), len(ids))
+            for events, c_id in zip(result, ids):
+                self.assertEqual([station for station, _ in events],
+                                 [station for station, _ in expected[c_id]])
+                for (_, event), (_, expected_event) in zip(events, expected[c_id]):
+                    self.assertEqual(event, expected_event)
+
+    def test__iter_events_in_blocks(self):
+        coincidences = self.cq.all_coincidences()
+        events = list(self.cq._iter_events_in_blocks(coincidences))
+        self.assertEqual([[station for station, _ in c_events]
+                          for c_events in events],
+                         [[501, 502], [502, 501]])
+        self.assertEqual(events[0][0][1]['ext_timestamp'],
+                         self.cq.data.root.station_501.events[41]['ext_timestamp'])
+        self.assertEqual(events[1][0][1]['ext_timestamp'],
+                         self.cq.data.root.station_502.events[88]['ext_timestamp'])
+
+
+class MembershipIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data_path = self.create_tempfile_path()
+        self.data = tables.open_file(self.data_path, 'w')
+        # More than 64 stations, to require multiple words per coincidence
+        self.stations = list(range(501, 571))
+        description = {'id': tables.UInt32Col(pos=0),
+                       'timestamp': tables.UInt32Col(pos=1)}
+        for i, station in enumerate(self.stations):
+            description['s%d' % station] = tables.BoolCol(pos=i + 2)
+        coincidences = self.data.create_table('/coincidences', 'coincidences',
+                                              description, createparents=True)
+        n = 2000
+        random = np.random.RandomState(42)
+        rows = np.zeros(n, dtype=coincidences.dtype)
+        rows['id'] = range(n)
+        rows['timestamp'] = 1e9 + random.randint(0, 1000, n)
+        for station in self.stations:
+            rows['s%d' % station] = random.uniform(size=n) < .05
+        coincidences.append(rows)
+        self.data.create_vlarray('/coincidences', 'c_index',
+                                 tables.UInt32Col(shape=2))
+        s_index = self.data.create_vlarray('/coincidences', 's_index',
+                                           tables.VLStringAtom())
+        for station in self.stations:
+            s_index.append(('/station_%d' % station).encode('utf-8'))
+        self.data.flush()
+
+    def tearDown(self):
+        self.data.close()
+        os.remove(self.data_path)
+
+    def create_tempfile_path(self):
+        fd, path = tempfile.mkstemp('.h5')
+        os.close(fd)
+        return path
+
+    def test_create_membership_index(self):
+        coincidence_queries.create_membership_index(self.data)
+        index = self.data.root.coincidences.membership_index
+        self.assertEqual(index.stations.shape, (2000, 2))
+        coincidences = self.data.root.coincidences.coincidences.read()
+        timestamps = coincidences['timestamp']
+        self.assertEqual(index.timestamps.read().tolist(),
+                         sorted(timestamps))
+        self.assertEqual(timestamps[index.timestamp_order.read()].tolist(),
+                         sorted(timestamps))
+        self.assertRaises(RuntimeError,
+                          coincidence_queries.create_membership_index,
+                          self.data)
+        coincidence_queries.create_membership_index(self.data,
+                                                    overwrite=True)
+
+    def test_queries_match_without_index(self):
+        cq = coincidence_queries.CoincidenceQuery(self.data)
+        self.assertIsNone(cq.membership_index)
+        stations = [501, 520, 566, 568, 999]
+        queries = [('any', (stations,)),
+                   ('any', (stations, 1000000100, 1000000500)),
+                   ('all', (stations[:2],)),
+                   ('all', (stations[2:4], None, 1000000500)),
+                   ('at_least', (stations, 2)),
+                   ('at_least', (stations, 2, 1000000200))]
+        expected = [getattr(cq, query)(*args) for query, args in queries]
+
+        coincidence_queries.create_membership_index(self.data)
+        cq = coincidence_queries.CoincidenceQuery(self.data)
+        self.assertIsNotNone(cq.membership_index)
+        for (query, args), result in zip(queries, expected):
+            self.assertEqual(getattr(cq, query)(*args).tolist(),
+                             result.tolist())
+            rows = getattr(cq, query)(*args, iterator=True)
+            self.assertEqual([row['id'] for row in rows],
+                             result['id'].tolist())
+
+    def test_outdated_index_is_ignored(self):
+        coincidence_queries.create_membership_index(self.data)
+        coincidences = self.data.root.coincidences.coincidences
+        coincidences.append(coincidences[:1])
+        with warnings.catch_warnings(record=True) as warned:
+            warnings.simplefilter('always')
+            cq = coincidence_queries.CoincidenceQuery(self.data)
+        self.assertEqual(len(warned), 1)
+        self.assertIsNone(cq.membership_index)
+
+    @patch.object(coincidence_queries.CoincidenceQuery, '_get_events_batch')
+    def test_events_from_stations_skips_coincidences(self, mock_get_events):
+        mock_get_events.side_effect = lambda ids, table: [[]] * len(ids)
+        coincidence_queries.create_membership_index(self.data)
+        cq = coincidence_queries.CoincidenceQuery(self.data)
+        coincidences = cq.all_coincidences()
+        list(cq.events_from_stations(coincidences, [501, 502]))
+        expected = cq.any([501, 502])['id'].tolist()
+        self.assertEqual(mock_get_events.call_args[0][0], expected)
+        self.assertLess(len(expected), len(coincidences))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,6 +6,7 @@ import shutil
 from mock import sentinel, patch, Mock
 import tables
 from numpy import uint64
+import numpy as np
 
 from sapphire.analysis import coincidences
 from sapphire.tests.validate_results import validate_results
@@ -50,12 +51,13 @@ class CoincidencesTests(unittest.TestCase):
         station2.col.return_value = [uint64(1400000002000000510), uint64(1400000030000000000)][::-1]
         stations = [station1, station2]
         timestamps = self.c._retrieve_timestamps(stations)
-        self.assertEqual(timestamps,
+        self.assertEqual(timestamps.dtype, coincidences.TIMESTAMPS_DTYPE)
+        self.assertEqual(timestamps.tolist(),
                          [(uint64(1400000002000000050), 0, 0), (uint64(1400000002000000510), 1, 1),
                           (uint64(1400000018000000500), 0, 1), (uint64(1400000030000000000), 1, 0)])
         # Shift both
         timestamps = self.c._retrieve_timestamps(stations, shifts=[1, 17])
-        self.assertEqual(timestamps,
+        self.assertEqual(timestamps.tolist(),
                          [(uint64(1400000003000000050), 0, 0), (uint64(1400000019000000500), 0, 1),
                           (uint64(1400000019000000510), 1, 1), (uint64(1400000047000000000), 1, 0)])
         # Wrong value type shifts
@@ -63,36 +65,45 @@ class CoincidencesTests(unittest.TestCase):
         self.assertRaises(TypeError, self.c._retrieve_timestamps, stations, shifts=['', 90])
         # Different length shifts
         timestamps = self.c._retrieve_timestamps(stations, shifts=[110])
-        self.assertEqual(timestamps,
+        self.assertEqual(timestamps.tolist(),
                          [(uint64(1400000002000000510), 1, 1), (uint64(1400000030000000000), 1, 0),
                           (uint64(1400000112000000050), 0, 0), (uint64(1400000128000000500), 0, 1)])
         timestamps = self.c._retrieve_timestamps(stations, shifts=[None, 60])
-        self.assertEqual(timestamps,
+        self.assertEqual(timestamps.tolist(),
                          [(uint64(1400000002000000050), 0, 0), (uint64(1400000018000000500), 0, 1),
                           (uint64(1400000062000000510), 1, 1), (uint64(1400000090000000000), 1, 0)])
+        # Negative shifts
+        timestamps = self.c._retrieve_timestamps(stations, shifts=[-1, None])
+        self.assertEqual(timestamps.tolist(),
+                         [(uint64(1400000001000000050), 0, 0), (uint64(1400000002000000510), 1, 1),
+                          (uint64(1400000017000000500), 0, 1), (uint64(1400000030000000000), 1, 0)])
         # Subsecond shifts
         timestamps = self.c._retrieve_timestamps(stations, shifts=[3e-9, 5e-9])
-        self.assertEqual(timestamps,
+        self.assertEqual(timestamps.tolist(),
                          [(uint64(1400000002000000053), 0, 0), (uint64(1400000002000000515), 1, 1),
                           (uint64(1400000018000000503), 0, 1), (uint64(1400000030000000005), 1, 0)])
         # Using limits
         timestamps = self.c._retrieve_timestamps(stations, limit=1)
-        self.assertEqual(timestamps,
+        self.assertEqual(timestamps.tolist(),
                          [(uint64(1400000002000000050), 0, 0), (uint64(1400000030000000000), 1, 0)])
-        # This should fail but does not
-        self.assertEqual(timestamps,
-                         [(1400000002000000049, 0, 0), (1400000030000000000, 1, 0)])
-        # Using uint64 does work correctly
-        self.assertNotEqual(timestamps,
-                            [(uint64(1400000002000000049), 0, 0), (uint64(1400000030000000000), 1, 0)])
-        self.assertNotEqual(timestamps,
-                            [(uint64(1400000002000000051), 0, 0), (uint64(1400000030000000001), 1, 0)])
+        # Timestamps are compared exactly, without loss of precision
+        self.assertNotEqual(timestamps.tolist(),
+                            [(1400000002000000049, 0, 0), (1400000030000000000, 1, 0)])
+        self.assertNotEqual(timestamps.tolist(),
+                            [(1400000002000000051, 0, 0), (1400000030000000001, 1, 0)])
+        # Equal timestamps are ordered by station and event index
+        station1.col.return_value = [uint64(5), uint64(5)]
+        station2.col.return_value = [uint64(5)]
+        timestamps = self.c._retrieve_timestamps([station2, station1])
+        self.assertEqual(timestamps.tolist(), [(5, 0, 0), (5, 1, 0), (5, 1, 1)])
+        # No stations
+        self.assertEqual(len(self.c._retrieve_timestamps([])), 0)
 
     def test__do_search_coincidences(self):
         # [(timestamp, station_idx, event_idx), ..]
-        timestamps = [(uint64(0), 0, 0), (uint64(0), 1, 0), (uint64(10), 1, 1),
-                      (uint64(15), 2, 0), (uint64(100), 1, 2), (uint64(200), 2, 1),
-                      (uint64(250), 0, 1), (uint64(251), 0, 2)]
+        timestamps = np.array([(0, 0, 0), (0, 1, 0), (10, 1, 1), (15, 2, 0),
+                               (100, 1, 2), (200, 2, 1), (250, 0, 1), (251, 0, 2)],
+                              dtype=coincidences.TIMESTAMPS_DTYPE)
 
         c = self.c._do_search_coincidences(timestamps, window=6)
         expected_coincidences = [[0, 1], [2, 3], [6, 7]]
@@ -106,6 +117,31 @@ class CoincidencesTests(unittest.TestCase):
         expected_coincidences = [[0, 1, 2, 3, 4, 5, 6, 7]]
         self.assertEqual(c, expected_coincidences)
 
+    def test__do_search_coincidences_vectorized(self):
+        # [(timestamp, station_idx, event_idx), ..]
+        timestamps = np.array([(0, 0, 0), (0, 1, 0), (10, 1, 1), (15, 2, 0),
+                               (100, 1, 2), (200, 2, 1), (250, 0, 1), (251, 0, 2)],
+                              dtype=coincidences.TIMESTAMPS_DTYPE)
+
+        c = self.c._do_search_coincidences_vectorized(timestamps, window=6)
+        self.assertEqual(c, [[0, 1], [2, 3], [6, 7]])
+        c = self.c._do_search_coincidences_vectorized(timestamps, window=150)
+        self.assertEqual(c, [[0, 1, 2, 3, 4], [4, 5], [5, 6, 7]])
+        c = self.c._do_search_coincidences_vectorized(timestamps, window=300)
+        self.assertEqual(c, [[0, 1, 2, 3, 4, 5, 6, 7]])
+        timestamps = np.array([], dtype=coincidences.TIMESTAMPS_DTYPE)
+        self.assertEqual(self.c._do_search_coincidences_vectorized(timestamps, 300), [])
+
+    def test_vectorized_search_equals_python_search(self):
+        random = np.random.RandomState(42)
+        timestamps = np.zeros(2000, dtype=coincidences.TIMESTAMPS_DTYPE)
+        timestamps['timestamp'] = np.sort(random.randint(0, 10 ** 6, size=2000))
+        timestamps['timestamp'] += uint64(1400000000000000000)
+        for window in [1, 200, 1000, 5000]:
+            self.assertEqual(
+                self.c._do_search_coincidences_vectorized(timestamps, window),
+                self.c._do_search_coincidences(timestamps, window))
+
 
 class CoincidencesESDTests(CoincidencesTests):
 
@@ -131,14 +167,14 @@ class CoincidencesESDTests(CoincidencesTests):
     def test_search_coincidences(self, mock__search):
         mock__search.return_value = (sentinel.c_index, sentinel.timestamps)
         self.c.search_coincidences()
-        mock__search.assert_called_with(10000, None, None)
+        mock__search.assert_called_with(10000, None, None, True)
         self.assertEqual(self.c._src_timestamps, sentinel.timestamps)
         self.assertEqual(self.c._src_c_index, sentinel.c_index)
 
         self.c.search_coincidences(sentinel.window, sentinel.shifts,
-                                   sentinel.limit)
+                                   sentinel.limit, sentinel.vectorized)
         mock__search.assert_called_with(sentinel.window, sentinel.shifts,
-                                        sentinel.limit)
+                                        sentinel.limit, sentinel.vectorized)
 
 
 class CoincidencesDataTests(unittest.TestCase):
@@ -192,6 +228,182 @@ class CoincidencesESDDataTests(CoincidencesDataTests):
             c.search_and_store_coincidences(station_numbers=[501, 502])
         validate_results(self, self.get_testdata_path(), self.data_path)
 
+    @patch.object(coincidences, 'STORE_CHUNK_SIZE', 1)
+    def test_coincidencesesd_output_small_store_chunks(self):
+        with tables.open_file(self.data_path, 'a') as data:
+            c = coincidences.CoincidencesESD(data, '/coincidences',
+                                             ['/station_501', '/station_502'],
+                                             progress=False)
+            c.search_and_store_coincidences(station_numbers=[501, 502])
+        validate_results(self, self.get_testdata_path(), self.data_path)
+
+    def test_coincidencesesd_chunked_output(self):
+        with tables.open_file(self.data_path, 'a') as data:
+            c = coincidences.CoincidencesESD(data, '/coincidences',
+                                             ['/station_501', '/station_502'],
+                                             progress=False)
+            c.search_coincidences(chunk_size=10)
+            c.store_coincidences(station_numbers=[501, 502])
+        validate_results(self, self.get_testdata_path(), self.data_path)
+
+    def test_chunked_search_equals_search(self):
+        with tables.open_file(self.data_path, 'r') as data:
+            c = coincidences.CoincidencesESD(data, None,
+                                             ['/station_501', '/station_502'],
+                                             progress=False)
+            # windows larger and smaller than the chunks
+            for window, chunk_size, shifts in [(int(1e9), 0.5, None),
+                                               (int(1e9), 7, [None, -1.5]),
+                                               (int(5e9), 1, [3, 0.2]),
+                                               (int(1e8), 20, None)]:
+                c.search_coincidences(window, shifts)
+                expected = [c._src_timestamps[i].tolist() for i in c._src_c_index]
+                c.search_coincidences(window, shifts, chunk_size=chunk_size)
+                result = [c._src_timestamps[i].tolist() for i in c._src_c_index]
+                self.assertEqual(result, expected)
+                # events shared by coincidences are only included once
+                self.assertEqual(len(np.unique(c._src_timestamps)),
+                                 len(c._src_timestamps))
+
+    def test_chunked_search_stores_chunks(self):
+        with tables.open_file(self.data_path, 'a') as data:
+            c = coincidences.CoincidencesESD(data, None,
+                                             ['/station_501', '/station_502'],
+                                             progress=False)
+            c.search_coincidences(int(1e9), chunk_size=5)
+            expected_c_index = c._src_c_index
+            expected_timestamps = c._src_timestamps
+
+            c = coincidences.CoincidencesESD(data, '/coincidences',
+                                             ['/station_501', '/station_502'],
+                                             progress=False)
+            for _ in range(2):
+                # the results of a previous search are replaced
+                c.search_coincidences(int(1e9), chunk_size=5)
+                self.assertIs(c._src_c_index, data.root.coincidences._src_c_index)
+                self.assertIs(c._src_timestamps, data.root.coincidences._src_timestamps)
+                self.assertEqual([i.tolist() for i in c._src_c_index.read()], expected_c_index)
+                np.testing.assert_array_equal(c._src_timestamps.read(), expected_timestamps)
+
+    def test_parallel_search_equals_chunked_search(self):
+        with tables.open_file(self.data_path, 'a') as data:
+            c = coincidences.CoincidencesESD(data, None,
+                                             ['/station_501', '/station_502'],
+                                             progress=False)
+            c.search_coincidences(int(1e9), chunk_size=5)
+            expected_c_index = c._src_c_index
+            expected_timestamps = c._src_timestamps
+            c.search_coincidences(int(1e9), chunk_size=5, workers=2)
+            self.assertEqual(c._src_c_index, expected_c_index)
+            np.testing.assert_array_equal(c._src_timestamps, expected_timestamps)
+            # without chunk_size the time range is split for the workers
+            c.search_coincidences(int(1e9), workers=2)
+            self.assertEqual(c._src_c_index, expected_c_index)
+            np.testing.assert_array_equal(c._src_timestamps, expected_timestamps)
+
+            # the results are stored in the coincidence group
+            c = coincidences.CoincidencesESD(data, '/coincidences',
+                                             ['/station_501', '/station_502'],
+                                             progress=False)
+            c.search_coincidences(int(1e9), chunk_size=5, workers=2)
+            self.assertIs(c._src_c_index, data.root.coincidences._src_c_index)
+            self.assertEqual([i.tolist() for i in c._src_c_index.read()], expected_c_index)
+            np.testing.assert_array_equal(c._src_timestamps.read(), expected_timestamps)
+
+    def test_incremental_search_and_store(self):
+        groups = ['/station_501', '/station_502']
+        window = int(1e9)
+        with tables.open_file(self.data_path, 'a') as data:
+            c = coincidences.CoincidencesESD(data, '/reference', groups,
+                                             progress=False)
+            c.search_and_store_coincidences(window, station_numbers=[501, 502])
+            reference = data.root.reference.coincidences.read()
+            reference_c_index = data.root.reference.c_index.read()
+
+            # Copy the events in parts, updating the coincidences each time
+            events = {group: data.get_node(group, 'events').read()
+                      for group in groups}
+            for group in groups:
+                data.create_table(group.replace('station', 'new'), 'events',
+                                  events[group].dtype, createparents=True)
+            new_groups = [group.replace('station', 'new') for group in groups]
+            for timestamp in [1325376030, 1325376031, 1325376090, 1325376200]:
+                for group, new_group in zip(groups, new_groups):
+                    table = data.get_node(new_group, 'events')
+                    selection = events[group]['timestamp'] < timestamp
+                    table.append(events[group][selection][len(table):])
+                    table.flush()
+                c = coincidences.CoincidencesESD(data, '/coincidences',
+                                                 new_groups, progress=False,
+                                                 incremental=True)
+                c.search_and_store_coincidences(window,
+                                                station_numbers=[501, 502])
+
+            # Coincidences are stored up to one window before the last event
+            # of the station with the oldest data
+            result = data.root.coincidences.coincidences.read()
+            self.assertEqual(len(result), len(reference) - 1)
+            np.testing.assert_array_equal(result, reference[:len(result)])
+            for result_idx, reference_idx in zip(data.root.coincidences.c_index,
+                                                 reference_c_index):
+                np.testing.assert_array_equal(result_idx, reference_idx)
+            self.assertEqual(data.root.coincidences.s_index.read(),
+                             [group.encode('utf-8') for group in new_groups])
+
+            # The window must be the same for each update
+            c = coincidences.CoincidencesESD(data, '/coincidences', new_groups,
+                                             progress=False, incremental=True)
+            self.assertRaises(RuntimeError, c.search_and_store_coincidences,
+                              window=10000)
+
+    def test_incremental_search_station_stops(self):
+        groups = ['/station_501', '/station_502']
+        new_groups = [group.replace('station', 'new') for group in groups]
+        window = int(1e9)
+        with tables.open_file(self.data_path, 'a') as data:
+            events = {group: data.get_node(group, 'events').read()
+                      for group in groups}
+            for group, new_group in zip(groups, new_groups):
+                data.create_table(new_group, 'events', events[group].dtype,
+                                  createparents=True)
+
+            # Station 502 stops sending data, 501 continues
+            for timestamp_501, timestamp_502 in [(1325376090, 1325376090),
+                                                 (1325376150, 1325376090),
+                                                 (1325376200, 1325376090)]:
+                for group, new_group, timestamp in zip(groups, new_groups,
+                                                       [timestamp_501, timestamp_502]):
+                    table = data.get_node(new_group, 'events')
+                    selection = events[group]['timestamp'] < timestamp
+                    table.append(events[group][selection][len(table):])
+                    table.flush()
+                c = coincidences.CoincidencesESD(data, '/coincidences',
+                                                 new_groups, progress=False,
+                                                 incremental=True)
+                c.search_and_store_coincidences(window,
+                                                station_numbers=[501, 502])
+
+            c = coincidences.CoincidencesESD(data, '/reference', new_groups,
+                                             progress=False)
+            c.search_and_store_coincidences(window, station_numbers=[501, 502])
+            reference = data.root.reference.coincidences.read()
+            result = data.root.coincidences.coincidences.read()
+            # Only the last coincidence, within one window of the last
+            # event of 501, is not yet stored
+            self.assertEqual(len(result), len(reference) - 1)
+            np.testing.assert_array_equal(result, reference[:len(result)])
+
+    def test_incremental_search_after_search(self):
+        groups = ['/station_501', '/station_502']
+        with tables.open_file(self.data_path, 'a') as data:
+            c = coincidences.CoincidencesESD(data, '/coincidences', groups,
+                                             progress=False)
+            c.search_and_store_coincidences(station_numbers=[501, 502])
+            c = coincidences.CoincidencesESD(data, '/coincidences', groups,
+                                             progress=False, incremental=True)
+            self.assertRaises(RuntimeError, c.search_and_store_coincidences,
+                              station_numbers=[501, 502])
+
     def get_testdata_path(self):
         dir_path = os.path.dirname(__file__)
         return os.path.join(dir_path, TEST_DATA_ESD)
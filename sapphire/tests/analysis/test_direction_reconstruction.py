@@ -2,9 +2,12 @@ import unittest
 import warnings
 
 from mock import sentinel, patch, Mock, MagicMock
-from numpy import isnan, nan, pi, sqrt, arcsin, arctan, array
+from numpy import isnan, nan, pi, sqrt, arcsin, arctan, array, zeros
+from numpy.random import RandomState
+from numpy.testing import assert_allclose, assert_array_equal
 
 from sapphire.analysis import direction_reconstruction
+from sapphire.clusters import SingleDiamondStation, SimpleCluster
 from sapphire.simulations.showerfront import ConeFront
 
 
@@ -96,6 +99,42 @@ class EventDirectionReconstructionTest(unittest.TestCase):
                          ((), (), ()))
         self.assertEqual(mock_reconstruct_event.call_count, 2)
 
+    def test_batch_reconstruct_events(self):
+        cluster = SingleDiamondStation()
+        station = cluster.get_station(0)
+        station.detectors[3].z = [2.]
+        dirrec = direction_reconstruction.EventDirectionReconstruction(station)
+
+        random = RandomState(2)
+        events = zeros(1000, dtype=[('timestamp', 'u4'), ('t1', 'f4'), ('t2', 'f4'),
+                                    ('t3', 'f4'), ('t4', 'f4')])
+        for i in range(1, 5):
+            t = random.normal(20, 10, len(events)).round(1)
+            t[random.uniform(size=len(events)) < 0.2] = -999
+            events['t%d' % i] = t
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for offsets in ([0., 0., 0., 0.], [1., -2., 3., 0.5]):
+                theta, phi, ids = dirrec.batch_reconstruct_events(events, offsets=offsets, progress=False)
+                angles = [dirrec.reconstruct_event(event, offsets=offsets) for event in events]
+                assert_allclose(theta, [angle[0] for angle in angles], rtol=1e-12)
+                assert_allclose(phi, [angle[1] for angle in angles], rtol=1e-12)
+                self.assertEqual(ids, [angle[2] for angle in angles])
+
+        # Tables and arrays are reconstructed in batches
+        result = dirrec.reconstruct_events(events[:10], detector_ids=[0, 1, 2], progress=False)
+        self.assertEqual([type(values) for values in result], [tuple] * 3)
+        assert_array_equal(result[0], dirrec.batch_reconstruct_events(events[:10], [0, 1, 2], progress=False)[0])
+
+        # Unless initials are given, those are passed to each reconstruction
+        initials = [{'theta': sentinel.theta}] * 2
+        with patch.object(dirrec, 'reconstruct_event') as mock_reconstruct_event:
+            mock_reconstruct_event.return_value = (sentinel.theta, sentinel.phi, sentinel.ids)
+            result = dirrec.reconstruct_events(events[:2], progress=False, initials=initials)
+            mock_reconstruct_event.assert_called_with(events[1], None, direction_reconstruction.NO_OFFSET, initials[1])
+        self.assertEqual(result, ((sentinel.theta,) * 2, (sentinel.phi,) * 2, (sentinel.ids,) * 2))
+
 
 class CoincidenceDirectionReconstructionTest(unittest.TestCase):
 
@@ -193,8 +232,41 @@ class CoincidenceDirectionReconstructionTest(unittest.TestCase):
         self.assertTrue(isnan(phi))
         self.assertEqual(len(nums), 0)
 
+    def test_batch_reconstruct_coincidences(self):
+        dirrec = direction_reconstruction.CoincidenceDirectionReconstruction(SimpleCluster())
+        station = dirrec.cluster.get_station(1)
+        station.x, station.y, station.z = ([station.x[0], 0.], [station.y[0], 0.], [0., 3.])
+        station.angle, station.timestamps = ([0., 0.], [0, 500])
+
+        random = RandomState(3)
+        coincidences = []
+        for _ in range(400):
+            timestamp = random.randint(1000)
+            coincidence = []
+            for station_number in random.permutation(4)[:random.randint(2, 5)]:
+                event = {'timestamp': timestamp, 't_trigger': 500.,
+                         'ext_timestamp': timestamp * int(1e9) + random.randint(800, 1200)}
+                for i in range(1, 5):
+                    event['t%d' % i] = random.normal(20, 5) if random.uniform() > .1 else -999.
+                coincidence.append((station_number, event))
+            coincidences.append(coincidence)
+        offsets = {station_number: list(random.normal(0, 3, 4)) for station_number in range(4)}
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for station_numbers in (None, [0, 1, 3]):
+                theta, phi, nums = dirrec.batch_reconstruct_coincidences(coincidences, station_numbers, offsets,
+                                                                         progress=False)
+                angles = [dirrec.reconstruct_coincidence(coincidence, station_numbers, offsets)
+                          for coincidence in coincidences]
+                assert_allclose(theta, [angle[0] for angle in angles], rtol=1e-12)
+                assert_allclose(phi, [angle[1] for angle in angles], rtol=1e-12)
+                self.assertEqual(nums, [angle[2] for angle in angles])
+
+    @patch.object(direction_reconstruction.CoincidenceDirectionReconstruction, '_use_batch')
     @patch.object(direction_reconstruction.CoincidenceDirectionReconstruction, 'reconstruct_coincidence')
-    def test_reconstruct_coincidences(self, mock_reconstruct_coincidence):
+    def test_reconstruct_coincidences(self, mock_reconstruct_coincidence, mock_use_batch):
+        mock_use_batch.return_value = False
         mock_reconstruct_coincidence.return_value = [sentinel.theta, sentinel.phi, sentinel.nums]
         self.assertEqual(self.dirrec.reconstruct_coincidences([sentinel.coincidence, sentinel.coincidence],
                                                               sentinel.station_numbers, sentinel.offsets, progress=False),
@@ -34,6 +34,37 @@ class TraceObservablesTests(unittest.TestCase):
         self.assertEqual(self.to.n_peaks, [2, 2, -1, -1])
 
 
+class BatchTraceObservablesTests(unittest.TestCase):
+
+    def setUp(self):
+        trace = ([200] * 400 + [500] + [510] + [400] * 10 + [200] * 600 +
+                 [400] * 10 + [200])
+        trace2 = ([203, 199] * 200 + [500] + [510] + [398, 402] * 5 +
+                  [203, 199] * 300 + [400] * 10 + [200])
+        trace3 = ([30, 31] * 200 + [90, 20, 100, 25, 35] + [30] * 608 +
+                  [200, 80, 140, 60] + [30] * 6)
+        traces = array([trace, trace2, trace3, trace[::-1]]).T
+        self.traces = array([traces, traces[::-1], traces[:, ::-1],
+                             traces - 180])
+        self.to = process_traces.BatchTraceObservables(self.traces)
+
+    def test_init(self):
+        self.assertRaises(Exception, process_traces.BatchTraceObservables,
+                          self.traces[:, :, :3])
+
+    def test_observables(self):
+        for name in ['baselines', 'std_dev', 'pulseheights', 'integrals',
+                     'n_peaks']:
+            expected = [getattr(process_traces.TraceObservables(traces), name)
+                        for traces in self.traces]
+            self.assertEqual(getattr(self.to, name).tolist(), expected)
+
+    def test_two_detectors(self):
+        to = process_traces.BatchTraceObservables(self.traces[:, :, :2])
+        self.assertEqual(to.baselines[0].tolist(), [200, 201, -1, -1])
+        self.assertEqual(to.n_peaks[0].tolist(), [2, 2, -1, -1])
+
+
 class MeanFilterTests(unittest.TestCase):
 
     def setUp(self):
@@ -72,6 +103,18 @@ class MeanFilterTests(unittest.TestCase):
         mock_filter.assert_any_call([sentinel.trace_odd] * 4)
         mock_filter.assert_called_with([sentinel.filtered_even, sentinel.filtered_odd] * 2)
 
+    def test_batch_filter_traces(self):
+        traces = array([[200] * 400 + [500] + [400] * 20 + [200] * 600,
+                        [199, 201, 203, 197, 230] * 204 + [210],
+                        [200, 215, 194, 206, 203] * 204 + [200]])
+        for mf in [self.mf, process_traces.MeanFilter(use_threshold=False)]:
+            filtered_traces = mf.batch_filter_traces(traces)
+            self.assertEqual(filtered_traces.tolist(),
+                             [mf.filter_trace(trace) for trace in traces])
+            filtered_traces = mf.batch_filter_traces(array([traces] * 2))
+            self.assertEqual(filtered_traces.tolist(),
+                             [[mf.filter_trace(trace) for trace in traces]] * 2)
+
     def test_mean_filter_with_threshold(self):
         # Small deviations in first few elements
         # (199 + 201 + 199 + 201) / 4. = 200
@@ -189,6 +232,47 @@ class DataReductionTests(unittest.TestCase):
         self.assertEqual(len(reduced_traces), len(trace))
         self.assertEqual(left, 0)
 
+    def test_batch_reduce_traces(self):
+        baseline = 200
+        trace = [baseline] * 500 + [baseline + 50] * 5 + [baseline] * 1000
+        signal = array([trace, [baseline] * len(trace)]).T
+        no_signal = array([[baseline] * len(trace)] * 2).T
+        late_signal = signal[::-1] + 3
+        traces = array([signal, no_signal, late_signal])
+
+        reduced_traces, offsets, left = self.dr.batch_reduce_traces(
+            traces, return_offset=True)
+        self.assertEqual(offsets.tolist(), [0, 57, 1562, 1619])
+        self.assertEqual(left.tolist(), [474, 0, 974])
+        for i, event_traces in enumerate(traces):
+            r_traces, r_left = self.dr.reduce_traces(event_traces,
+                                                     return_offset=True)
+            self.assertEqual(
+                reduced_traces[offsets[i]:offsets[i + 1]].tolist(),
+                r_traces.tolist())
+            self.assertEqual(left[i], r_left)
+
+        # Baseline too low for last event, entire trace is over threshold
+        baselines = array([[baseline] * 2, [baseline] * 2, [180] * 2])
+        reduced_traces, offsets = self.dr.batch_reduce_traces(traces,
+                                                              baselines)
+        self.assertEqual(offsets.tolist(), [0, 57, 1562, 3067])
+        self.assertEqual(reduced_traces.shape, (3067, 2))
+
+    def test_batch_determine_cuts(self):
+        trace = [200] * 400 + [250] + [260] * 4 + [200] * 600
+        traces = array([array([trace, trace]).T, array([[200] * 1005] * 2).T])
+        left, right = self.dr.batch_determine_cuts(traces, [[200] * 2] * 2)
+        self.assertEqual(left.tolist(), [400, 0])
+        self.assertEqual(right.tolist(), [405, 1005])
+
+    def test_batch_add_padding(self):
+        left, right = self.dr.batch_add_padding(array([0, 4, 50, 50]),
+                                                array([20, 20, 2400, 2400]),
+                                                2410)
+        self.assertEqual(left.tolist(), [0, 0, 24, 24])
+        self.assertEqual(right.tolist(), [46, 46, 2410, 2410])
+
     def test_determine_cuts(self):
         pre = 400
         post = 300
@@ -1,9 +1,14 @@
 import os
+import shutil
+import tempfile
 import unittest
+import warnings
 
 from mock import sentinel, MagicMock, patch
 
 import tables
+from numpy import array, isnan, nan, zeros
+from numpy.testing import assert_array_equal
 from sapphire.analysis import reconstructions
 
 TEST_DATA_FILE = '../simulations/test_data/groundparticles_sim.h5'
@@ -127,16 +132,33 @@ class ReconstructESDEventsTest(unittest.TestCase):
         self.rec.get_detector_offsets()
         self.assertEqual(self.rec.offsets, [sentinel.offset, sentinel.offset])
 
-    def test__store_reconstruction(self):
-        event = MagicMock()
-        # _store_reconstruction calls  min(event['n1'], ...).
-        # but MagicMock is unordered in python 3!
-        # Mock a dict that always returns 42.
-        event.__getitem__.side_effect = lambda x: 42.
+    def test_store_reconstructions(self):
+        events = zeros(3, dtype=[('event_id', 'u4'), ('ext_timestamp', 'u8'),
+                                 ('n1', 'f4'), ('n2', 'f4'), ('n3', 'f4'), ('n4', 'f4')])
+        events['event_id'] = [3, 4, 5]
+        events['ext_timestamp'] = [10, 20, 30]
+        events['n1'] = [1., 2., 3.]
+        events['n2'] = [.5, 4., 5.]
+        self.rec.events = MagicMock(nrows=3)
+        self.rec.events.read.return_value = events
         self.rec.reconstructions = MagicMock()
-        self.rec._store_reconstruction(event, sentinel.core_x, sentinel.core_y,
-                                       sentinel.theta, sentinel.phi, [1, 3, 4])
-        self.rec.reconstructions.row.append.assert_called_once_with()
+        self.rec.reconstructions.dtype = tables.description.dtype_from_descr(reconstructions.ReconstructedEvent)
+        self.rec.core_x, self.rec.core_y = ([1., 2., nan], [3., 4., nan])
+        self.rec.theta, self.rec.phi = (array([.1, .2, nan]), array([.3, .4, nan]))
+        self.rec.detector_ids = [[0, 1, 2], [0, 2, 3], []]
+        self.rec.store_reconstructions()
+
+        self.rec.events.read.assert_called_once_with(0, 3)
+        rows = self.rec.reconstructions.append.call_args[0][0]
+        assert_array_equal(rows['id'], [3, 4, 5])
+        assert_array_equal(rows['ext_timestamp'], [10, 20, 30])
+        assert_array_equal(rows['min_n'], [0., 0., -999.])
+        assert_array_equal(rows['x'], array([1., 2., nan], dtype='f4'))
+        assert_array_equal(rows['azimuth'], array([.3, .4, nan], dtype='f4'))
+        assert_array_equal(rows['d1'], [True, True, False])
+        assert_array_equal(rows['d2'], [True, False, False])
+        assert_array_equal(rows['d4'], [False, True, False])
+        self.rec.reconstructions.flush.assert_called_once_with()
 
 
 class ReconstructESDEventsFromSourceTest(ReconstructESDEventsTest):
@@ -332,12 +354,35 @@ class ReconstructESDCoincidencesTest(unittest.TestCase):
             self.rec.coincidences_group, sentinel.destination, mock_description,
             expectedrows=sentinel.nrows)
 
-    def test__store_reconstruction(self):
-        coin = MagicMock()
+    def test_store_reconstructions(self):
+        coincidences = zeros(2, dtype=[('id', 'u4'), ('ext_timestamp', 'u8'), ('x', 'f4'), ('y', 'f4'),
+                                       ('zenith', 'f4'), ('azimuth', 'f4'), ('size', 'f4'), ('energy', 'f4')])
+        coincidences['id'] = [7, 8]
+        coincidences['energy'] = [1.5, 2.5]
+        self.rec.coincidences = MagicMock(nrows=2)
+        self.rec.coincidences.read.return_value = coincidences
+        self.rec.cluster.stations = [MagicMock(number=501), MagicMock(number=502), MagicMock(number=503)]
         self.rec.reconstructions = MagicMock()
-        self.rec._store_reconstruction(coin, sentinel.core_x, sentinel.core_y,
-                                       sentinel.theta, sentinel.phi, [2, 3, 4])
-        self.rec.reconstructions.row.append.assert_called_once_with()
+        self.rec.reconstructions.dtype = zeros(0, dtype=[('id', 'u4'), ('ext_timestamp', 'u8'), ('x', 'f4'),
+                                                         ('y', 'f4'), ('zenith', 'f4'), ('azimuth', 'f4'),
+                                                         ('reference_x', 'f4'), ('reference_y', 'f4'),
+                                                         ('reference_zenith', 'f4'), ('reference_azimuth', 'f4'),
+                                                         ('reference_size', 'f4'), ('reference_energy', 'f4'),
+                                                         ('s501', '?'), ('s502', '?'), ('s503', '?')]).dtype
+        self.rec.core_x, self.rec.core_y = ([1., nan], [3., nan])
+        self.rec.theta, self.rec.phi = ([.1, nan], [.3, nan])
+        self.rec.station_numbers = [[503, 501, 502], []]
+        self.rec.store_reconstructions()
+
+        rows = self.rec.reconstructions.append.call_args[0][0]
+        assert_array_equal(rows['id'], [7, 8])
+        assert_array_equal(rows['reference_energy'], [1.5, 2.5])
+        self.assertTrue(isnan(rows['zenith'][1]))
+        assert_array_equal(rows['s501'], [True, False])
+        assert_array_equal(rows['s503'], [True, False])
+
+        self.rec.station_numbers = [[504], []]
+        self.assertRaises(KeyError, self.rec.store_reconstructions)
 
 
 class ReconstructESDCoincidencesFromSourceTest(ReconstructESDCoincidencesTest):
@@ -398,5 +443,57 @@ class ReconstructSimulatedCoincidencesTest(unittest.TestCase):
         return os.path.join(dir_path, fn)
 
 
+class ReconstructInPoolTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Starting worker processes is slow, share one pool for all tests
+        cls.pool = reconstructions.get_process_pool(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+        cls.pool.join()
+
+    def setUp(self):
+        warnings.filterwarnings('ignore')
+        fd, self.data_path = tempfile.mkstemp('.h5')
+        os.close(fd)
+        dir_path = os.path.dirname(__file__)
+        shutil.copyfile(os.path.join(dir_path, TEST_DATA_FILE), self.data_path)
+        self.data = tables.open_file(self.data_path, 'a')
+
+    def tearDown(self):
+        warnings.resetwarnings()
+        self.data.close()
+        os.remove(self.data_path)
+
+    def test__split_rows(self):
+        self.assertEqual(reconstructions._split_rows(10, 1),
+                         [(0, 2), (2, 5), (5, 7), (7, 10)])
+        self.assertEqual(reconstructions._split_rows(2, 2), [(0, 1), (1, 2)])
+        self.assertEqual(reconstructions._split_rows(0, 2), [])
+
+    @patch.object(reconstructions, 'get_process_pool')
+    def test_reconstruct_in_pool(self, mock_get_pool):
+        mock_get_pool.return_value = MagicMock(imap=self.pool.imap)
+        for workers, destination in [(None, 'serial'), (2, 'pool')]:
+            rec = reconstructions.ReconstructSimulatedEvents(
+                self.data, '/cluster_simulations/station_0', 0, progress=False,
+                destination=destination, workers=workers)
+            rec.reconstruct_and_store()
+            rec = reconstructions.ReconstructSimulatedCoincidences(
+                self.data, progress=False, destination=destination, workers=workers)
+            rec.reconstruct_and_store()
+        mock_get_pool.assert_called_with(2)
+        # Directions and cores, for events and coincidences
+        self.assertEqual(mock_get_pool.call_count, 4)
+
+        for group in ['/cluster_simulations/station_0', '/coincidences']:
+            serial = self.data.get_node(group, 'serial').read()
+            pool = self.data.get_node(group, 'pool').read()
+            for name in serial.dtype.names:
+                assert_array_equal(serial[name], pool[name])
+
 if __name__ == '__main__':
     unittest.main()
@@ -323,6 +323,79 @@ class BaseClusterTests(unittest.TestCase):
             self.assertEqual(cluster._timestamp, sentinel.timestamp)
             cluster.stations[0]._update_timestamp.assert_called_with(sentinel.timestamp)
 
+    def test_set_timestamp_same_layout(self):
+        cluster = clusters.BaseCluster()
+        cluster._add_station(([0, 1], [0, 1]), (0, 0),
+                             [(([0, 1], [0, 1]), 'UD')],
+                             station_timestamps=[0, 10],
+                             detector_timestamps=[0, 20])
+        cluster._add_station((0, 0), 0, [((0, 0), 'UD')], number=2)
+        self.assertEqual(cluster.get_layout_timestamps(), [0, 10, 20])
+        station = cluster.stations[0]
+        self.assertEqual(station.get_layout_timestamps(), [0, 10, 20])
+        self.assertEqual(cluster.stations[1].get_layout_timestamps(), [0])
+        with patch.object(station, '_update_timestamp',
+                          wraps=station._update_timestamp) as update:
+            cluster.set_timestamp(12)
+            self.assertEqual(update.call_count, 1)
+            self.assertEqual(station.index, 1)
+            self.assertEqual(station.detectors[0].index, 0)
+            # Still in the interval between the layout changes at 10 and 20
+            cluster.set_timestamp(15)
+            self.assertEqual(cluster._timestamp, 15)
+            self.assertEqual(update.call_count, 1)
+            cluster.set_timestamp(5)
+            self.assertEqual(update.call_count, 2)
+            self.assertEqual(station.index, 0)
+
+            # Only update the given stations
+            cluster.set_timestamp(25, stations=[2])
+            self.assertEqual(update.call_count, 2)
+            self.assertEqual(station.index, 0)
+            cluster.set_timestamp(25)
+            self.assertEqual(update.call_count, 3)
+            self.assertEqual(station.index, 1)
+            self.assertEqual(station.detectors[0].index, 1)
+
+    def test_geometry(self):
+        cluster = clusters.BaseCluster()
+        cluster._add_station(([0, 1], [0, 1]), (0, 0),
+                             [(([0, 1], [0, 1]), 'UD'), (([2, 2], [0, 0]), 'LR')],
+                             station_timestamps=[0, 10],
+                             detector_timestamps=[0, 20])
+        cluster._add_station((5, 5), pi / 2, [((0, 0), 'UD')])
+        cluster.set_coordinates(1, 2, 3, pi / 4)
+        detectors = [d for s in cluster.stations for d in s.detectors]
+
+        cluster.set_timestamp(25)
+        x, y, z = cluster.get_detector_coordinates()
+        self.assertEqual(len(x), 3)
+        assert_array_almost_equal(array([x, y, z]).T,
+                                  [d.get_coordinates() for d in detectors])
+        assert_array_almost_equal(detectors[0].get_coordinates(),
+                                  (1, 2 + 2 * sqrt(2), 3))
+        assert_array_almost_equal(cluster.stations[0].get_coordinates(),
+                                  (1, 2 + sqrt(2), 3, pi / 4))
+        assert_array_almost_equal(
+            detectors[0].get_corners(),
+            [(1 + sqrt(.5) * .25, 2 + 2 * sqrt(2) - sqrt(.5) * .75),
+             (1 + sqrt(.5) * .75, 2 + 2 * sqrt(2) - sqrt(.5) * .25),
+             (1 - sqrt(.5) * .25, 2 + 2 * sqrt(2) + sqrt(.5) * .75),
+             (1 - sqrt(.5) * .75, 2 + 2 * sqrt(2) + sqrt(.5) * .25)])
+        x, y, z, alpha = cluster.get_station_coordinates()
+        assert_array_almost_equal(array([x, y, z, alpha]).T,
+                                  [s.get_coordinates() for s in cluster.stations])
+
+        # Cached coordinates are updated for a different layout
+        cluster.set_timestamp(0)
+        assert_array_almost_equal(detectors[0].get_coordinates(), (1, 2, 3))
+
+        # Cached coordinates are updated with the cluster coordinates
+        x, y, z = cluster.get_detector_coordinates()
+        cluster.set_cylindrical_coordinates(0, 0, 0, 0)
+        self.assertEqual(detectors[0].get_coordinates(), (0, 0, 0))
+        self.assertEqual(cluster.get_detector_coordinates()[0][0], 0)
+
     def test_attributes(self):
         with patch('sapphire.clusters.Station') as mock_station:
             mock_station_instance = Mock()
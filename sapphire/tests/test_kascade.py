@@ -36,5 +36,70 @@ class StoreKascadeDataTests(unittest.TestCase):
         return path
 
 
+class KascadeCoincidencesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.data_path = self.create_tempfile_path()
+        self.data = tables.open_file(self.data_path, 'w')
+        description = {'event_id': tables.Int64Col(),
+                       'ext_timestamp': tables.UInt64Col()}
+        hisparc_events = self.data.create_table('/hisparc', 'events',
+                                                description, createparents=True)
+        kascade_events = self.data.create_table('/kascade', 'events',
+                                                description, createparents=True)
+        t0 = 1400000000000000000
+        hisparc_events.append([(i, t0 + int(t * 1e9))
+                               for i, t in enumerate([10, 20, 30, 40])])
+        # KASCADE events are not sorted
+        kascade_events.append([(i, t0 + int(t * 1e9))
+                               for i, t in enumerate([5, 12, 26, 19, 35, 45])])
+        self.coincidences = kascade.KascadeCoincidences(self.data, '/hisparc',
+                                                        '/kascade')
+
+    def tearDown(self):
+        self.data.close()
+        os.remove(self.data_path)
+
+    def create_tempfile_path(self):
+        fd, path = tempfile.mkstemp('.h5')
+        os.close(fd)
+        return path
+
+    def assert_coincidences(self, coincidences, dt, h_idx, k_idx):
+        self.assertEqual(coincidences.dt.tolist(), [int(t * 1e9) for t in dt])
+        self.assertEqual(coincidences.h_idx.tolist(), h_idx)
+        self.assertEqual(coincidences.k_idx.tolist(), k_idx)
+
+    def test_search_coincidences(self):
+        self.coincidences.search_coincidences()
+        self.assert_coincidences(self.coincidences.coincidences,
+                                 [-2, 1, 4, 5], [0, 1, 2, 3], [1, 2, 3, 4])
+        self.coincidences.search_coincidences(dtlimit=4.5)
+        self.assert_coincidences(self.coincidences.coincidences,
+                                 [-2, 1, 4], [0, 1, 2], [1, 2, 3])
+        self.coincidences.search_coincidences(limit=2)
+        self.assert_coincidences(self.coincidences.coincidences,
+                                 [-2, 1], [0, 1], [1, 2])
+        self.coincidences.search_coincidences(timeshift=1)
+        self.assert_coincidences(self.coincidences.coincidences,
+                                 [-1, 2, 5, -4], [0, 1, 2, 2], [1, 2, 3, 4])
+
+    def test_store_coincidences(self):
+        self.coincidences.search_coincidences()
+        self.coincidences.store_coincidences()
+        c_index = self.data.root.kascade.c_index.read()
+        self.assertEqual(c_index['h_idx'].tolist(), [0, 1, 2, 3])
+        self.assertEqual(c_index['k_idx'].tolist(), [1, 2, 3, 4])
+
+    def test_sweep_timeshifts(self):
+        shifts = [0, 1, -0.5, 2.25]
+        results = self.coincidences.sweep_timeshifts(shifts, dtlimit=4.5)
+        self.assertEqual(len(results), len(shifts))
+        for shift, result in zip(shifts, results):
+            self.coincidences.search_coincidences(shift, dtlimit=4.5)
+            expected = self.coincidences.coincidences
+            self.assertEqual(result.tolist(), expected.tolist())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,12 @@
 from __future__ import print_function
+import os
 import unittest
 import types
 from six import StringIO
 
 from numpy import pi, random, exp, sqrt
 import progressbar
+from mock import patch
 
 from sapphire import utils
 
@@ -48,6 +50,21 @@ class PbarTests(unittest.TestCase):
         self.assertNotEqual(self.output.getvalue(), '')
 
 
+class ProcessPoolTests(unittest.TestCase):
+
+    def test_get_process_pool(self):
+        """Pool works and HDF5 file locking setting is restored"""
+
+        locking = os.environ.get('HDF5_USE_FILE_LOCKING')
+        pool = utils.get_process_pool(1)
+        try:
+            self.assertEqual(pool.map(abs, [-1, 2]), [1, 2])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(os.environ.get('HDF5_USE_FILE_LOCKING'), locking)
+
+
 class InBaseTests(unittest.TestCase):
 
     def test_ceil(self):
@@ -91,6 +108,19 @@ class ActiveIndexTests(unittest.TestCase):
                         (3, 5.)]:
             self.assertEqual(utils.get_active_index(timestamps, ts), idx)
 
+    def test_active_index_cache(self):
+        timestamps = [1., 2., 2., 3., 4.]
+        cache = utils.ActiveIndexCache(timestamps)
+        for ts in [0., 1., 1.5, 2., 2.1, 3.9, 4., 5., 3., 0.5, 4.]:
+            self.assertEqual(cache(ts), utils.get_active_index(timestamps, ts))
+
+        with patch.object(utils, 'get_active_index') as mock_index:
+            mock_index.return_value = 3
+            cache = utils.ActiveIndexCache(timestamps)
+            for ts in [3., 3.2, 3.9, 3.5]:
+                self.assertEqual(cache(ts), 3)
+            mock_index.assert_called_once_with(timestamps, 3.)
+
 
 class GaussTests(unittest.TestCase):
 
@@ -5,6 +5,8 @@ The module contains some commonly functions and classes.
 """
 from __future__ import division
 
+import multiprocessing
+import os
 from functools import wraps
 from bisect import bisect_right
 from distutils.spawn import find_executable
@@ -51,6 +53,37 @@ def pbar(iterable, length=None, show=True, **kwargs):
         return iterable
 
 
+def get_process_pool(workers):
+    """Get a pool of worker processes for parallel processing
+
+    The worker processes are started using 'spawn' (if available), such
+    that they do not inherit the open PyTables files of this process. HDF5
+    file locking is disabled for the workers, so they can open a file
+    read-only while it is still opened for writing by this process. Make
+    sure to flush the file before handing work to the pool.
+
+    :param workers: number of worker processes.
+    :return: a :class:`multiprocessing.Pool`, which should be closed and
+             joined when done.
+
+    """
+    try:
+        context = multiprocessing.get_context('spawn')
+    except AttributeError:
+        # Python 2
+        context = multiprocessing
+
+    locking = os.environ.get('HDF5_USE_FILE_LOCKING')
+    os.environ['HDF5_USE_FILE_LOCKING'] = 'FALSE'
+    try:
+        return context.Pool(workers)
+    finally:
+        if locking is None:
+            del os.environ['HDF5_USE_FILE_LOCKING']
+        else:
+            os.environ['HDF5_USE_FILE_LOCKING'] = locking
+
+
 def ceil_in_base(value, base):
     """Get nearest multiple of base above the value"""
 
@@ -89,6 +122,56 @@ def get_active_index(values, value):
     return idx - 1
 
 
+class ActiveIndexCache(object):
+
+    """Get the index where a value fits, remembering the last interval
+
+    Equivalent to :func:`get_active_index`, but the interval of values for
+    which the last index is valid is remembered.  For (mostly) sorted
+    values, e.g. timestamps of consecutive events, the bisection is only
+    needed when the next interval is entered.  This can be used to look up
+    time-dependent metadata, like station settings, for many events.
+
+    """
+
+    def __init__(self, values):
+        """Initialize the cache
+
+        :param values: sorted list of values (e.g. list of timestamps).
+
+        """
+        self.values = values
+        self.idx = None
+        self.start = None
+        self.stop = None
+
+    def __call__(self, value):
+        """Get the index where the value fits.
+
+        :param value: value for which to find the position.
+        :return: index into the values list.
+
+        """
+        if self.idx is None or not self._in_interval(value):
+            self.idx = get_active_index(self.values, value)
+            # The first and last index are also used outside the range
+            self.start = self.values[self.idx] if self.idx > 0 else None
+            if self.idx + 1 < len(self.values):
+                self.stop = self.values[self.idx + 1]
+            else:
+                self.stop = None
+        return self.idx
+
+    def _in_interval(self, value):
+        """Check if the value is in the interval of the last index"""
+
+        if self.start is not None and value < self.start:
+            return False
+        if self.stop is not None and value >= self.stop:
+            return False
+        return True
+
+
 def gauss(x, n, mu, sigma):
     """Gaussian distribution
 
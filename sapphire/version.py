@@ -0,0 +1,2 @@
+# Created by setup.py. Do not edit.
+__version__ = "1.5.1"